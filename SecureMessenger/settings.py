@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "app.profiling.SamplingProfilerMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -50,8 +51,13 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "app.replicas.ReplicaRoutingMiddleware",
+    "app.query_budget.QueryBudgetMiddleware",
 ]
 
+# Loads request.user together with its profile (app/roles.py)
+AUTHENTICATION_BACKENDS = ["app.roles.ProfileBackend"]
+
 ROOT_URLCONF = "SecureMessenger.urls"
 
 TEMPLATES = [
@@ -76,11 +82,79 @@ WSGI_APPLICATION = "SecureMessenger.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connections are kept open for CONN_MAX_AGE seconds. The development server
+# starts a thread per request, which defeats reuse, so it is off under DEBUG
+CONN_MAX_AGE = int(os.environ.get("SECUREMESSENGER_CONN_MAX_AGE", "0" if DEBUG else "600"))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+    }
+}
+
+# Optional read replica; locally a second SQLite file kept in sync by
+# `python manage.py sync_replica --interval 1`
+if os.environ.get("SECUREMESSENGER_REPLICA_DB"):
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ["SECUREMESSENGER_REPLICA_DB"],
+        "CONN_MAX_AGE": CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+        "TEST": {"MIRROR": "default"},
+    }
+
+# Optional horizontal sharding: Message, MessageLog and Certificate rows are
+# placed on MESSAGE_SHARDS by hash of the receiver (see app/sharding.py)
+MESSAGE_SHARDS = []
+for _index in range(int(os.environ.get("SECUREMESSENGER_SHARDS", "0"))):
+    DATABASES[f"shard_{_index}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"db_shard_{_index}.sqlite3",
+        "CONN_MAX_AGE": CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
+    }
+    MESSAGE_SHARDS.append(f"shard_{_index}")
+
+DATABASE_ROUTERS = ["app.sharding.ShardRouter", "app.replicas.ReplicaRouter"]
+
+# Applied to every new connection and the write paths (see app/database.py).
+# Compare with the untuned setup using `python manage.py bench_db_writes`
+DATABASE_TUNING = {
+    "SQLITE_PRAGMAS": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,
+    },
+    "LOCK_RETRIES": 5,
+}
+
+# The cache holds state every process must agree on: admission buckets,
+# cached roles and certificate validity. Use Redis (its INCR keeps the rate
+# limits atomic) whenever more than one process serves requests; the
+# in-process cache only suits a single development server
+if os.environ.get("SECUREMESSENGER_REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["SECUREMESSENGER_REDIS_URL"],
+        }
     }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+DATABASE_REPLICA = {
+    "ALIAS": "replica",
+    "STICKY_SECONDS": 5,  # Reads stay on the primary this long after a user writes
+    "MAX_LAG_SECONDS": 10,  # Fall back to the primary when the replica is further behind
+    "LAG_CHECK_INTERVAL": 1,
 }
 
 
@@ -156,4 +230,104 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
-}
\ No newline at end of file
+}
+
+# Request Profiler (opt-in, see app/profiling.py)
+REQUEST_PROFILER = {
+    'ENABLED': os.environ.get('SECUREMESSENGER_PROFILE', '') == '1',
+    'SAMPLE_RATE': float(os.environ.get('SECUREMESSENGER_PROFILE_SAMPLE_RATE', '0.01')),
+    'HEADER': 'X-Profile-Request',  # Signed value from `manage.py profile_report --issue-token`
+    'DIR': BASE_DIR / 'profiles',
+    'MAX_REPORTS': 200,
+}
+
+# Query Budgets (see app/query_budget.py) - overruns raise in strict mode, are logged otherwise
+QUERY_BUDGET = {
+    'ENABLED': True,
+    'STRICT': DEBUG,
+}
+
+# Message encryption backend for new messages: 'fernet', 'aesgcm' or 'chacha20'.
+# Existing rows keep decrypting whatever their backend; compare throughput
+# with `python manage.py bench_ciphers`.
+MESSAGE_CIPHER_BACKEND = 'fernet'
+
+# Decrypted previews in the inbox/outbox (see app/previews.py); users can
+# still toggle them per page with ?preview=1 / ?preview=0.
+MESSAGE_PREVIEWS = {
+    'ENABLED': False,
+    'CHARS': 80,
+    'TIME_BUDGET': 0.1,  # Seconds a page waits for its previews
+    'WORKERS': 4,
+    'FULL_DECRYPT_MAX_BYTES': 64 * 1024,  # Larger bodies only decrypt their first bytes
+}
+
+# Async views (see app/async_support.py): decryption runs in this many
+# threads, off the event loop
+ASYNC_VIEWS = {
+    'DECRYPT_WORKERS': 4,
+}
+
+# Roles resolved per session are cached (see app/roles.py); saving a user or
+# profile drops the entry
+ROLE_CACHE = {
+    'CACHE_SECONDS': 300,
+}
+
+# Bulk user provisioning (see app/provisioning.py): `python manage.py
+# provision_users users.csv`, or upload a small file from the profile admin
+USER_PROVISIONING = {
+    'HASH_WORKERS': os.cpu_count() or 1,  # Password hashing processes
+    'CHUNK_SIZE': 1000,
+    'MAX_UPLOAD_ROWS': 2000,
+}
+
+# Background jobs (see app/jobs.py) - run workers with `python manage.py worker`
+JOB_QUEUE = {
+    'EAGER': os.environ.get('SECUREMESSENGER_JOBS_EAGER', '') == '1',  # Run jobs inline, no worker needed
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_SECONDS': 5,
+    'BACKOFF_MAX_SECONDS': 3600,
+    'LEASE_SECONDS': 300,
+}
+
+# Certificate validity checks (see app/certificates.py); sweep expirations
+# with `python manage.py expire_certificates --interval 300`
+CERTIFICATE_CHECKS = {
+    'CACHE_SECONDS': 300,
+}
+
+# CA signing key for certificates (see app/certificates.py). Create one with
+# `python manage.py ca_keygen <path>`; it is required unless DEBUG is on, when
+# a development key derived from SECRET_KEY stands in (with a warning). Check
+# stored certificates with `verify_certificates`
+CA_SIGNING = {
+    'PRIVATE_KEY_FILE': os.environ.get('SECUREMESSENGER_CA_KEY_FILE') or None,
+    'TRUSTED_PUBLIC_KEYS': [],  # Base64 public keys of retired CA keys
+    'PARALLEL_THRESHOLD': 2000,  # Verify batches at least this large in a process pool
+}
+
+# Read receipts (see app/receipts.py) are buffered per process and written
+# after the response, in batches
+READ_RECEIPTS = {
+    'BATCH_SIZE': 200,
+    'MAX_DELAY': 1.0,  # Seconds a receipt may wait for its batch
+}
+
+# Admission control on message intake (see app/admission.py): token buckets
+# answer 429 with Retry-After, and a deep router/CA backlog queues new
+# messages (DEFER) or refuses them (REJECT)
+ADMISSION_CONTROL = {
+    'ENABLED': True,
+    'USER_RATE': 1.0,  # Messages per second per sender
+    'USER_BURST': 10,
+    'GLOBAL_RATE': 200.0,
+    'GLOBAL_BURST': 500,
+    'QUEUE_LIMITS': {
+        'SENT': {'DEFER': 5000, 'REJECT': 50000},
+        'ROUTER_ACCEPTED': {'DEFER': 5000, 'REJECT': 50000},
+    },
+    'DEPTH_CACHE_SECONDS': 5,
+    'RETRY_AFTER': 30,
+    'RELEASE_DELAY': 30,
+}
@@ -0,0 +1,36 @@
+"""
+Lean settings for background workers and short-lived CLI commands.
+
+Same databases, caches and app configuration as SecureMessenger.settings,
+without the apps and middleware only the web process needs (admin, messages,
+sessions, staticfiles), so `django.setup()` imports and checks less:
+
+    python manage.py worker --settings SecureMessenger.worker_settings
+
+Compare both profiles with `python manage.py bench_startup`. Do not serve
+HTTP or run `migrate` with these settings.
+"""
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+
+    "app",
+]
+
+MIDDLEWARE = []
+
+# The project URLconf pulls in the admin site
+ROOT_URLCONF = "app.urls"
+
+TEMPLATES = [
+    {
+        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "DIRS": [],
+        "APP_DIRS": False,
+        "OPTIONS": {},
+    },
+]
+
+STATICFILES_DIRS = []
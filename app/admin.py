@@ -1,3 +1,288 @@
-from django.contrib import admin
+"""
+Admin for tables with millions of rows.
 
-# Register your models here.
+Changelists order by primary key, never run the unfiltered "full result"
+COUNT, and page with EstimatedCountPaginator: an unfiltered list uses the
+database's own row estimate and a filtered one counts at most COUNT_CAP
+rows. Ciphertext columns are never loaded or shown. With sharding enabled a
+"Shard" filter picks the shard a changelist reads (the first by default)
+and objects are looked up on their home shard first. Bulk actions go
+through the batched paths in app.lifecycle, a keyset batch at a time; they
+are the only way to change a message's status, and the audit log cannot be
+edited at all.
+Profiles can be created in bulk from an uploaded CSV/NDJSON file (up to
+USER_PROVISIONING['MAX_UPLOAD_ROWS'] rows; see app/provisioning.py).
+"""
+import csv
+import io
+from itertools import islice
+
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.shortcuts import render
+from django.urls import path
+from django.utils.functional import cached_property
+
+from .forms import UserUploadForm
+from .lifecycle import certify_messages, transition_messages
+from .models import Certificate, Conversation, Message, MessageLog, RoutingRule, UserProfile, UserRole
+from .provisioning import detect_format, provision_users, provisioning_settings, read_rows
+from .roles import request_role
+from .sharding import aliases_for_id, shard_aliases, sharding_enabled
+
+
+ACTION_BATCH_SIZE = 1000
+COUNT_CAP = 10000
+
+
+def estimated_count(model, using):
+    """The database's row estimate for a table (cheap, possibly stale), or None"""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s', [table]
+            )
+        elif connection.vendor == 'sqlite':
+            # Both ends of the rowid b-tree; an overestimate once rows are deleted
+            cursor.execute(f'SELECT MAX(_rowid_) - MIN(_rowid_) + 1 FROM {connection.ops.quote_name(table)}')
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that never counts more than COUNT_CAP rows"""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > COUNT_CAP:
+                return estimate
+        return queryset[:COUNT_CAP].count()
+
+
+class ShardFilter(admin.SimpleListFilter):
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.value() or shard_aliases()[0])
+
+    def choices(self, changelist):
+        # No "All": a changelist reads exactly one shard
+        current = self.value() or shard_aliases()[0]
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': alias == current,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    ordering = ('-id',)
+    list_per_page = 50
+
+
+class ShardedAdmin(LargeTableAdmin):
+    """Admin for Message, MessageLog and Certificate (see app/sharding.py)"""
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if sharding_enabled():
+            return (ShardFilter, *list_filter)
+        return list_filter
+
+    def get_object(self, request, object_id, from_field=None):
+        try:
+            object_id = int(object_id)
+        except (TypeError, ValueError):
+            return None
+        queryset = self.get_queryset(request)
+        for alias in aliases_for_id(object_id):
+            obj = queryset.using(alias).filter(pk=object_id).first()
+            if obj is not None:
+                return obj
+        return None
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(LargeTableAdmin):
+    list_display = ('user', 'role', 'organization', 'created_at')
+    list_select_related = ('user',)
+    list_filter = ('role',)
+    search_fields = ('user__username',)
+    raw_id_fields = ('user',)
+    change_list_template = 'admin/app/userprofile/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('provision/', self.admin_site.admin_view(self.provision_view), name='app_userprofile_provision'),
+            *super().get_urls(),
+        ]
+
+    def provision_view(self, request):
+        """Upload a CSV/NDJSON file of users; small files only, the command handles large ones"""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = UserUploadForm(request.POST or None, request.FILES or None)
+        result = None
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            file_format = detect_format(upload.name)
+            max_rows = provisioning_settings()['MAX_UPLOAD_ROWS']
+            if file_format is None:
+                form.add_error('file', 'Upload a .csv, .ndjson or .jsonl file.')
+            else:
+                try:
+                    rows = list(islice(read_rows(io.TextIOWrapper(upload, encoding='utf-8-sig'), file_format), max_rows + 1))
+                except (UnicodeDecodeError, csv.Error) as error:
+                    form.add_error('file', f'Cannot read the file: {error}')
+                    rows = []
+                if len(rows) > max_rows:
+                    form.add_error('file', f'More than {max_rows} rows; use `python manage.py provision_users`.')
+                elif not rows and not form.errors:
+                    form.add_error('file', 'The file has no rows.')
+                elif rows:
+                    created, errors = provision_users(rows, dry_run=form.cleaned_data['dry_run'])
+                    result = {'created': created, 'errors': errors, 'dry_run': form.cleaned_data['dry_run']}
+        return render(request, 'admin/app/userprofile/provision.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Provision users',
+            'form': form,
+            'result': result,
+        })
+
+
+@admin.register(Message)
+class MessageAdmin(ShardedAdmin):
+    list_display = ('id', 'subject', 'sender', 'receiver', 'status', 'timestamp')
+    list_select_related = ('sender', 'receiver')
+    list_filter = ('status',)
+    autocomplete_fields = ('sender', 'receiver')
+    exclude = ('encrypted_content', 'encryption_key')
+    # Status changes go through the actions, which log them; the certificate signs the ciphertext
+    readonly_fields = ('status', 'certificate')
+    actions = ('accept_messages', 'certify_messages', 'reject_messages')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('encrypted_content', 'encryption_key')
+
+    def _apply(self, request, queryset, transition, verb):
+        """Run transition(alias, ids) over the selection in keyset batches and report"""
+        alias = queryset.db
+        selection = queryset.order_by('id').values_list('id', flat=True)
+        done = selected = after = 0
+        while True:
+            ids = list(selection.filter(id__gt=after)[:ACTION_BATCH_SIZE])
+            if not ids:
+                break
+            done += len(transition(alias, ids))
+            selected += len(ids)
+            after = ids[-1]
+
+        if done == selected:
+            self.message_user(request, f'{verb} {done} messages.', messages.SUCCESS)
+        else:
+            self.message_user(
+                request,
+                f'{verb} {done} of {selected} selected messages; '
+                f'{selected - done} were not in a state that allows it.',
+                messages.WARNING,
+            )
+
+    # Staff status alone does not make someone a router or the CA: the actions need the same roles as the views
+    def has_router_permission(self, request):
+        return request_role(request) == UserRole.ROUTER
+
+    def has_authority_permission(self, request):
+        return request_role(request) == UserRole.CLOUD_AUTHORITY
+
+    def has_reject_permission(self, request):
+        return request_role(request) in (UserRole.ROUTER, UserRole.CLOUD_AUTHORITY)
+
+    @admin.action(description='Accept selected messages (Router)', permissions=['router'])
+    def accept_messages(self, request, queryset):
+        self._apply(request, queryset, lambda alias, ids: transition_messages(
+            alias, ids, 'SENT', 'ROUTER_ACCEPTED', 'ACCEPT',
+            actor=request.user, notes='Router accepted message (admin bulk action)',
+        ), 'Accepted')
+
+    @admin.action(description='Issue certificates for selected messages (Cloud Authority)', permissions=['authority'])
+    def certify_messages(self, request, queryset):
+        self._apply(request, queryset, lambda alias, ids: certify_messages(
+            alias, ids, request.user, notes=f'Certified by {request.user.username} (admin bulk action)',
+        ), 'Certified')
+
+    @admin.action(description='Reject selected messages', permissions=['reject'])
+    def reject_messages(self, request, queryset):
+        def reject(alias, ids):
+            return [
+                message_id
+                for from_status in ('SENT', 'ROUTER_ACCEPTED')
+                for message_id in transition_messages(
+                    alias, ids, from_status, 'REJECTED', 'REJECT',
+                    actor=request.user, notes='Rejected (admin bulk action)',
+                )
+            ]
+        self._apply(request, queryset, reject, 'Rejected')
+
+
+@admin.register(MessageLog)
+class MessageLogAdmin(ShardedAdmin):
+    """Read-only: an edited entry breaks the hash chain verify_audit_log checks"""
+    list_display = ('id', 'message_id', 'log_type', 'actor', 'rule_id', 'timestamp')
+    list_select_related = ('actor',)
+    raw_id_fields = ('message', 'actor')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Certificate)
+class CertificateAdmin(ShardedAdmin):
+    list_display = ('id', 'message_id', 'issued_by', 'issued_date', 'valid_until', 'expired_at')
+    list_select_related = ('issued_by',)
+    raw_id_fields = ('message', 'issued_by')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('certificate_data')
+
+
+@admin.register(Conversation)
+class ConversationAdmin(LargeTableAdmin):
+    list_display = ('id', 'user_a', 'user_b', 'message_count', 'last_activity')
+    list_select_related = ('user_a', 'user_b')
+    raw_id_fields = ('user_a', 'user_b')
+
+
+@admin.register(RoutingRule)
+class RoutingRuleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'action', 'priority', 'enabled', 'updated_at')
+    list_editable = ('priority', 'enabled')
+    list_filter = ('action', 'enabled')
+    raw_id_fields = ('sender', 'receiver')
@@ -0,0 +1,179 @@
+"""
+Admission control for message intake.
+
+send_message asks admit() before it stores anything. Two token buckets
+bound how fast messages arrive: one per sender and one shared by everyone.
+Each is a GCRA bucket: a single "theoretical arrival time" (TAT) per key in
+the shared cache, in integer milliseconds, changed only by add() and
+incr()/decr(), which are atomic on Redis and Memcached (and within one
+process), so concurrent requests cannot both take the last token. The key
+expires as its TAT passes, so add() succeeding means the bucket was full;
+otherwise incr() claims the next slot and decr() hands it back when it is
+too far in the future. A sender over either limit is rejected with a retry
+delay (send_message answers 429 with a Retry-After header).
+
+The backlog of work waiting on routers and the CA is checked too. Counting
+it per send would put a COUNT over the Message table on every request, so
+queue_depth() caches a count capped just past the REJECT threshold for
+DEPTH_CACHE_SECONDS. Above a status's DEFER threshold new messages are
+stored as QUEUED and released into SENT by the ``release_message`` job
+once the backlog drops; above REJECT they are turned away.
+
+``manage.py check --deploy`` warns when the cache is not one whose
+increments are atomic across processes (Redis or Memcached).
+"""
+import math
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.checks import Tags, Warning, register
+
+from .sharding import scatter_count
+
+
+ACCEPT = 'accept'
+DEFER = 'defer'
+REJECT = 'reject'
+
+CACHE_PREFIX = 'admission:'
+
+Admission = namedtuple('Admission', 'action retry_after reason')
+
+SHARED_CACHE_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
+
+
+def admission_settings():
+    config = {
+        'ENABLED': True,
+        'USER_RATE': 1.0,  # Messages per second per sender (0 disables)
+        'USER_BURST': 10,
+        'GLOBAL_RATE': 200.0,  # Messages per second across all senders (0 disables)
+        'GLOBAL_BURST': 500,
+        'QUEUE_LIMITS': {
+            'SENT': {'DEFER': 5000, 'REJECT': 50000},
+            'ROUTER_ACCEPTED': {'DEFER': 5000, 'REJECT': 50000},
+        },
+        'DEPTH_CACHE_SECONDS': 5,
+        'RETRY_AFTER': 30,  # Seconds suggested to senders rejected for backlog
+        'RELEASE_DELAY': 30,  # Seconds between attempts to release a queued message
+    }
+    config.update(getattr(settings, 'ADMISSION_CONTROL', {}))
+    return config
+
+
+def _interval(rate):
+    """Milliseconds between tokens"""
+    return max(round(1000 / rate), 1)
+
+
+def _expiry(milliseconds):
+    return max(math.ceil(milliseconds / 1000), 1)
+
+
+def _take(key, rate, burst, now):
+    """Take a token from a bucket; returns 0, or the seconds until it has one"""
+    interval = _interval(rate)
+    for _ in range(2):
+        if cache.add(key, now + interval, _expiry(interval)):
+            return 0
+        try:
+            arrival = cache.incr(key, interval)
+        except ValueError:
+            continue  # Expired between add() and incr()
+        wait = arrival - interval - now - (burst - 1) * interval
+        if wait > 0:
+            _give_back(key, rate)
+            return wait / 1000
+        cache.touch(key, _expiry(arrival - now))
+        return 0
+    return 0
+
+
+def _give_back(key, rate):
+    try:
+        cache.decr(key, _interval(rate))
+    except ValueError:
+        pass  # Expired: the bucket is full anyway
+
+
+def _take_tokens(user):
+    """Take a token from the sender's and the global bucket; returns the wait if either is empty"""
+    config = admission_settings()
+    now = int(time.time() * 1000)
+    buckets = [
+        (f'{CACHE_PREFIX}user:{user.id}', config['USER_RATE'], config['USER_BURST']),
+        (f'{CACHE_PREFIX}global', config['GLOBAL_RATE'], config['GLOBAL_BURST']),
+    ]
+    taken = []
+    for key, rate, burst in buckets:
+        if not rate:
+            continue
+        wait = _take(key, rate, burst, now)
+        if wait:
+            for taken_key, taken_rate in taken:
+                _give_back(taken_key, taken_rate)
+            return wait
+        taken.append((key, rate))
+    return 0
+
+
+def queue_depth(status):
+    """Messages waiting in `status`, cached and capped just past its REJECT threshold"""
+    config = admission_settings()
+    key = f'{CACHE_PREFIX}depth:{status}'
+    depth = cache.get(key)
+    if depth is None:
+        cap = config['QUEUE_LIMITS'][status]['REJECT'] + 1
+        depth = scatter_count(lambda messages: messages.filter(status=status)[:cap])
+        cache.set(key, depth, config['DEPTH_CACHE_SECONDS'])
+    return depth
+
+
+def backlog_action():
+    """ACCEPT, DEFER or REJECT for the current backlog, with the status that decided it"""
+    action, reason = ACCEPT, ''
+    for status, limits in admission_settings()['QUEUE_LIMITS'].items():
+        depth = queue_depth(status)
+        if depth >= limits['REJECT']:
+            return REJECT, status
+        if depth >= limits['DEFER']:
+            action, reason = DEFER, status
+    return action, reason
+
+
+def admit(user):
+    """Decide whether `user` may send a message now"""
+    config = admission_settings()
+    if not config['ENABLED']:
+        return Admission(ACCEPT, 0, '')
+    action, status = backlog_action()
+    if action == REJECT:
+        return Admission(REJECT, config['RETRY_AFTER'], f'{status} backlog')
+    wait = _take_tokens(user)
+    if wait:
+        return Admission(REJECT, math.ceil(wait), 'rate limit')
+    if action == ACCEPT:
+        try:
+            cache.incr(f'{CACHE_PREFIX}depth:SENT')  # Keep the cached depth roughly current
+        except ValueError:
+            pass
+    return Admission(action, 0, f'{status} backlog' if action == DEFER else '')
+
+
+@register(Tags.caches, deploy=True)
+def check_admission_cache(app_configs, **kwargs):
+    backend = settings.CACHES['default']['BACKEND']
+    if not admission_settings()['ENABLED'] or backend in SHARED_CACHE_BACKENDS:
+        return []
+    return [Warning(
+        f'Admission control keeps its rate limits in {backend}, which is not shared between '
+        'processes or has no atomic increment, so each process enforces its own limits.',
+        hint='Set SECUREMESSENGER_REDIS_URL to use Redis.',
+        id='app.W001',
+    )]
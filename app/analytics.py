@@ -0,0 +1,190 @@
+"""
+Incremental lifecycle analytics.
+
+MessageLog rows are folded into hourly, per-actor LifecycleStat rows, each
+holding a count and a fixed-bucket latency histogram measured from the time
+the message was sent. A Checkpoint keeps the MessageLog high-water mark (one
+per message shard) so every refresh only reads rows written since the
+previous one, and reports only ever touch the (small) rollup table.
+
+Ids are handed out when a row is inserted, not when its transaction commits,
+so a lower id can become visible after a higher one has been folded in and
+the mark has moved past it. A refresh therefore stops at the first entry
+younger than `settle` seconds and leaves it, and everything after it, for
+the next run: only a transaction that stays open longer than that can still
+be missed.
+"""
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Checkpoint, LifecycleStat, MessageLog
+from .sharding import message_aliases
+
+
+CHECKPOINT_NAME = 'lifecycle_stats'
+
+# Transitions that are measured against the time the message was sent
+TRACKED_LOG_TYPES = ('ACCEPT', 'CERTIFICATE', 'DELIVER', 'REJECT')
+
+# Upper bounds (seconds) of the latency histogram buckets; one extra
+# overflow bucket holds everything slower than the last bound.
+LATENCY_BUCKETS = (
+    1, 5, 15, 30, 60, 120, 300, 600, 900, 1800,
+    3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+    86400, 2 * 86400, 4 * 86400, 7 * 86400,
+)
+
+
+def empty_histogram():
+    """Histogram with every bucket at zero"""
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def merge_histograms(target, other):
+    """Add the counts of `other` into `target` in place"""
+    if len(target) < len(other):
+        target.extend([0] * (len(other) - len(target)))
+    for index, value in enumerate(other):
+        target[index] += value
+    return target
+
+
+def estimate_quantile(histogram, quantile):
+    """Estimate a latency quantile (seconds) from a bucket histogram"""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for index, value in enumerate(histogram):
+        if not value:
+            continue
+        if seen + value >= rank:
+            lower = LATENCY_BUCKETS[index - 1] if index else 0
+            if index >= len(LATENCY_BUCKETS):
+                return float(lower)
+            upper = LATENCY_BUCKETS[index]
+            # Interpolate linearly inside the bucket
+            return lower + (upper - lower) * (rank - seen) / value
+        seen += value
+    return float(LATENCY_BUCKETS[-1])
+
+
+def _hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _apply_rollup(rollup):
+    """Merge an in-memory rollup {(bucket, actor_id, log_type): [count, total, hist]} into the table"""
+    existing = {
+        (stat.bucket, stat.actor_id, stat.log_type): stat
+        for stat in LifecycleStat.objects.select_for_update().filter(
+            bucket__in={key[0] for key in rollup},
+            log_type__in={key[2] for key in rollup},
+        )
+    }
+    to_update, to_create = [], []
+    for key, (count, total, histogram) in rollup.items():
+        stat = existing.get(key)
+        if stat is None:
+            bucket, actor_id, log_type = key
+            to_create.append(LifecycleStat(
+                bucket=bucket,
+                actor_id=actor_id,
+                log_type=log_type,
+                count=count,
+                latency_total=total,
+                latency_histogram=histogram,
+            ))
+        else:
+            stat.count += count
+            stat.latency_total += total
+            stat.latency_histogram = merge_histograms(stat.latency_histogram or empty_histogram(), histogram)
+            to_update.append(stat)
+    if to_create:
+        LifecycleStat.objects.bulk_create(to_create)
+    if to_update:
+        LifecycleStat.objects.bulk_update(to_update, ['count', 'latency_total', 'latency_histogram'])
+
+
+def refresh_lifecycle_stats(batch_size=1000, settle=60):
+    """Fold settled MessageLog rows past the high-water marks into LifecycleStat; returns rows read"""
+    cutoff = timezone.now() - timedelta(seconds=settle)
+    return sum(_refresh_from(alias, batch_size, cutoff) for alias in message_aliases())
+
+
+def _refresh_from(alias, batch_size, cutoff):
+    checkpoint_name = CHECKPOINT_NAME if alias is None else f'{CHECKPOINT_NAME}:{alias}'
+    processed = 0
+    while True:
+        with transaction.atomic():
+            checkpoint, _ = Checkpoint.objects.select_for_update().get_or_create(name=checkpoint_name)
+            logs = list(
+                MessageLog.objects.using(alias).filter(id__gt=checkpoint.position)
+                .order_by('id')
+                .values('id', 'actor_id', 'log_type', 'timestamp', 'message__timestamp')[:batch_size]
+            )
+            complete = len(logs) < batch_size
+            unsettled = next((index for index, log in enumerate(logs) if log['timestamp'] > cutoff), None)
+            if unsettled is not None:
+                # Stop at the first unsettled entry so no id is ever skipped
+                logs, complete = logs[:unsettled], True
+            if not logs:
+                break
+
+            rollup = {}
+            for log in logs:
+                if log['log_type'] not in TRACKED_LOG_TYPES:
+                    continue
+                latency = max((log['timestamp'] - log['message__timestamp']).total_seconds(), 0.0)
+                key = (_hour(log['timestamp']), log['actor_id'], log['log_type'])
+                entry = rollup.setdefault(key, [0, 0.0, empty_histogram()])
+                entry[0] += 1
+                entry[1] += latency
+                entry[2][bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+            if rollup:
+                _apply_rollup(rollup)
+            checkpoint.position = logs[-1]['id']
+            checkpoint.save(update_fields=['position', 'updated_at'])
+
+        processed += len(logs)
+        if complete:
+            break
+    return processed
+
+
+def lifecycle_report(log_type='CERTIFICATE', since=None, until=None):
+    """Per-actor count, mean and latency quantiles for one transition"""
+    if since is None:
+        since = timezone.now() - timedelta(days=7)
+    stats = LifecycleStat.objects.filter(log_type=log_type, bucket__gte=_hour(since))
+    if until is not None:
+        stats = stats.filter(bucket__lt=until)
+
+    per_actor = {}
+    for stat in stats.select_related('actor'):
+        row = per_actor.setdefault(stat.actor_id, {
+            'actor': stat.actor.username if stat.actor else None,
+            'count': 0,
+            'latency_total': 0.0,
+            'histogram': empty_histogram(),
+        })
+        row['count'] += stat.count
+        row['latency_total'] += stat.latency_total
+        merge_histograms(row['histogram'], stat.latency_histogram)
+
+    report = []
+    for row in per_actor.values():
+        report.append({
+            'actor': row['actor'],
+            'count': row['count'],
+            'mean_seconds': row['latency_total'] / row['count'] if row['count'] else None,
+            'p50_seconds': estimate_quantile(row['histogram'], 0.5),
+            'p90_seconds': estimate_quantile(row['histogram'], 0.9),
+        })
+    report.sort(key=lambda row: row['count'], reverse=True)
+    return report
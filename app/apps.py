@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        # Connect the connection tuning, shard maintenance, routing rule, read
+        # receipt and role cache signal handlers and register the background
+        # job handlers
+        from . import database, receipts, roles, routing, sharding, tasks  # noqa: F401
@@ -0,0 +1,130 @@
+"""
+Helpers for the async views.
+
+The inbox, outbox, message page and the status/stats APIs are ``async def``
+views, so under ASGI (SecureMessenger/asgi.py) a request waiting on the
+database does not hold a worker thread. Django 4.2's login_required,
+cache_control and condition decorators only wrap sync views, hence the async
+versions here. The lazy ``request.user`` loads the session and user with
+sync queries, so async_login_required resolves it once off the event loop;
+everything after that uses the async ORM.
+
+Decrypting a message is CPU-bound and would stall every other request on the
+event loop, so it runs in an executor of ASYNC_VIEWS['DECRYPT_WORKERS']
+threads, which also bounds how many requests decrypt at once. Django runs
+the same views under WSGI through async_to_sync; ``bench_async`` compares
+the two paths.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.views import redirect_to_login
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from .models import UserProfile
+from .sharding import MergedQuerySet
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def async_settings():
+    config = {
+        'DECRYPT_WORKERS': 4,
+    }
+    config.update(getattr(settings, 'ASYNC_VIEWS', {}))
+    return config
+
+
+def _decrypt_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=async_settings()['DECRYPT_WORKERS'], thread_name_prefix='decrypt',
+            )
+        return _executor
+
+
+async def decrypt_content(message):
+    """message.decrypt_content() in the bounded decrypt executor"""
+    return await asyncio.get_running_loop().run_in_executor(_decrypt_pool(), message.decrypt_content)
+
+
+def _authenticated(request):
+    # Evaluates the lazy request.user (session and user queries)
+    return request.user.is_authenticated
+
+
+def async_login_required(view_func):
+    """login_required for async views"""
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        if not await sync_to_async(_authenticated)(request):
+            return redirect_to_login(request.get_full_path())
+        return await view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def async_cache_control(**directives):
+    """cache_control for async views"""
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            response = await view_func(request, *args, **kwargs)
+            patch_cache_control(response, **directives)
+            return response
+        return wrapper
+    return decorator
+
+
+def async_condition(etag_func):
+    """condition(etag_func=...) for async views with an async `etag_func`"""
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            etag = await etag_func(request, *args, **kwargs)
+            etag = quote_etag(etag) if etag is not None else None
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = await view_func(request, *args, **kwargs)
+            if etag and request.method in ('GET', 'HEAD'):
+                response.headers.setdefault('ETag', etag)
+            return response
+        return wrapper
+    return decorator
+
+
+async def load_profile(user):
+    """The user's profile (or None), cached on the user so templates can read it"""
+    if not User.profile.related.is_cached(user):
+        profile = await UserProfile.objects.filter(user_id=user.id).afirst()
+        User.profile.related.set_cached_value(user, profile)
+    return User.profile.related.get_cached_value(user)
+
+
+async def async_page(object_list, number, per_page):
+    """Paginator(object_list, per_page).get_page(number) with async queries"""
+    paginator = Paginator(object_list, per_page)
+    paginator.count = await object_list.acount()
+    try:
+        number = paginator.validate_number(number)
+    except PageNotAnInteger:
+        number = 1
+    except EmptyPage:
+        number = paginator.num_pages
+    bottom = (number - 1) * per_page
+    top = bottom + per_page
+    if isinstance(object_list, MergedQuerySet):
+        rows = await object_list.aslice(bottom, top)
+    else:
+        rows = [row async for row in object_list[bottom:top]]
+    return Page(rows, number, paginator)
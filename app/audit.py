@@ -0,0 +1,58 @@
+"""
+Tamper-evident message history.
+
+Every MessageLog entry stores entry_hash = SHA-256 over its own fields and
+previous_hash, the entry_hash of the message's previous entry (empty for
+the first). Each message's history is its own chain: appends to different
+messages never contend for a shared head, and chains verify independently,
+so a verification pass splits into segments that run in parallel.
+
+The ``verify_audit_log`` command re-hashes only the entries added since the
+last AuditCheckpoint of each database and checks that they link to the
+entries before them, then records a new checkpoint: the id it verified up
+to and a root hash folding every entry_hash into the previous root, signed
+with SECRET_KEY. Editing a new row breaks its hash or a link, and a forged
+checkpoint (e.g. one moved past tampered rows) fails its signature.
+``--full`` re-verifies every chain from its first entry and recomputes every
+checkpoint's root, which also catches rewrites of history that an earlier
+checkpoint already covered.
+
+Like app.key_rotation, this module does not need Django set up, so
+verify_chains() can run in worker processes.
+"""
+import hashlib
+import json
+from datetime import timezone
+
+
+def entry_digest(previous_hash, message_id, actor_id, log_type, notes, rule_id, timestamp):
+    """Hex SHA-256 of one log entry's canonical form"""
+    canonical = json.dumps(
+        [previous_hash, message_id, actor_id, log_type, notes, rule_id, timestamp.astimezone(timezone.utc).isoformat()],
+        separators=(',', ':'), ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def verify_chains(chains):
+    """Check [(anchor_hash, [row, ...]), ...] chain segments
+
+    Rows are (id, previous_hash, entry_hash, message_id, actor_id, log_type,
+    notes, rule_id, timestamp) in id order; the anchor is the entry_hash
+    the segment must continue from. Returns [(log id, problem), ...].
+    """
+    problems = []
+    for anchor, rows in chains:
+        expected = anchor
+        for log_id, previous_hash, entry_hash, *fields in rows:
+            if previous_hash != expected:
+                problems.append((log_id, 'does not link to the previous entry'))
+            elif entry_digest(previous_hash, *fields) != entry_hash:
+                problems.append((log_id, 'contents do not match its hash'))
+            expected = entry_hash
+    return problems
+
+
+def root_hasher(root):
+    """Running hash for the next checkpoint root: update() it with each entry_hash in id order"""
+    return hashlib.sha256(root.encode('ascii'))
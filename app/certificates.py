@@ -0,0 +1,265 @@
+"""
+Certificate validity and expiry.
+
+certificate_validity() answers whether a message's CA certificate is valid
+right now. A certificate's valid_until never changes once issued, so it is
+cached per message (CERTIFICATE_CHECKS['CACHE_SECONDS']) and the check is a
+cache lookup plus a clock comparison; only a miss reads the certificate row.
+acertificate_validity() is the same check for async views.
+
+sign_messages() produces the Ed25519 certificates (see app/signatures.py)
+certify_messages() stores, with the CA key from CA_SIGNING['PRIVATE_KEY_FILE'].
+Without a key file signing and verifying raise ImproperlyConfigured, except
+under DEBUG, where a development key derived from SECRET_KEY is used (and
+logged as such): anyone holding SECRET_KEY could forge its certificates. The
+key is loaded once per process. verify_certificates() checks the stored
+certificates of many messages against the CA's public keys; batches of at
+least PARALLEL_THRESHOLD are split across a process pool of VERIFY_WORKERS.
+
+expire_certificates() is run by the ``expire_certificates`` command. It
+range-scans the valid_until index from a per-shard Checkpoint (stored as
+epoch microseconds) up to now, and in batches stamps expired_at, writes an
+EXPIRE MessageLog per certificate and drops the cached entries.
+"""
+import base64
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache, partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import signatures
+from .models import Certificate, Checkpoint, Message, MessageLog
+from .sharding import message_aliases
+
+
+CHECKPOINT_NAME = 'certificate_expiry'
+CACHE_PREFIX = 'certificate_valid_until:'
+CERTIFIED_STATUSES = ('CERTIFICATE_CREATED', 'DELIVERED')
+
+logger = logging.getLogger(__name__)
+
+
+def certificate_settings():
+    config = {
+        'CACHE_SECONDS': 300,
+    }
+    config.update(getattr(settings, 'CERTIFICATE_CHECKS', {}))
+    return config
+
+
+def signing_settings():
+    config = {
+        'PRIVATE_KEY_FILE': None,  # PEM Ed25519 key (``manage.py ca_keygen``); required unless DEBUG
+        'TRUSTED_PUBLIC_KEYS': [],  # Base64 raw public keys of retired CA keys, still accepted
+        'VERIFY_WORKERS': os.cpu_count() or 1,
+        'PARALLEL_THRESHOLD': 2000,  # Smaller batches are verified inline
+        'VERIFY_CHUNK_SIZE': 500,
+    }
+    config.update(getattr(settings, 'CA_SIGNING', {}))
+    return config
+
+
+def certificate_validity(message):
+    """{'valid': bool, 'valid_until': datetime} for a certified message, else None"""
+    if message.status not in CERTIFIED_STATUSES:
+        return None
+    key = f'{CACHE_PREFIX}{message.id}'
+    valid_until = cache.get(key)
+    if valid_until is None:
+        valid_until = (
+            Certificate.objects.using(message._state.db)
+            .filter(message_id=message.id)
+            .values_list('valid_until', flat=True)
+            .first()
+        )
+        if valid_until is None:
+            return None
+        cache.set(key, valid_until, certificate_settings()['CACHE_SECONDS'])
+    return {'valid': timezone.now() < valid_until, 'valid_until': valid_until}
+
+
+async def acertificate_validity(message):
+    """certificate_validity() for async views"""
+    if message.status not in CERTIFIED_STATUSES:
+        return None
+    key = f'{CACHE_PREFIX}{message.id}'
+    valid_until = await cache.aget(key)
+    if valid_until is None:
+        valid_until = await (
+            Certificate.objects.using(message._state.db)
+            .filter(message_id=message.id)
+            .values_list('valid_until', flat=True)
+            .afirst()
+        )
+        if valid_until is None:
+            return None
+        await cache.aset(key, valid_until, certificate_settings()['CACHE_SECONDS'])
+    return {'valid': timezone.now() < valid_until, 'valid_until': valid_until}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _load_signing_key(path, secret_key):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    if path is None:
+        logger.warning(
+            'CA_SIGNING["PRIVATE_KEY_FILE"] is not set: signing certificates with a development key derived '
+            'from SECRET_KEY. Anyone with SECRET_KEY can forge these certificates; never use it in production.'
+        )
+        seed = hashlib.sha256(f'app.certificates:{secret_key}'.encode('utf-8')).digest()
+        return Ed25519PrivateKey.from_private_bytes(seed)
+    with open(path, 'rb') as key_file:
+        key = load_pem_private_key(key_file.read(), password=None)
+    if not isinstance(key, Ed25519PrivateKey):
+        raise ValueError(f'{path} does not hold an Ed25519 private key')
+    return key
+
+
+def signing_key():
+    """(private key, key id) the CA signs with"""
+    path = signing_settings()['PRIVATE_KEY_FILE']
+    if path is None and not settings.DEBUG:
+        raise ImproperlyConfigured(
+            'CA_SIGNING["PRIVATE_KEY_FILE"] must name the CA signing key (create one with '
+            '`manage.py ca_keygen <path>` and set SECUREMESSENGER_CA_KEY_FILE); the SECRET_KEY-derived '
+            'development key is only used when DEBUG is on.'
+        )
+    key = _load_signing_key(path, settings.SECRET_KEY)
+    return key, signatures.key_id(signatures.public_bytes(key))
+
+
+def public_keys():
+    """{key id: raw public key} for the current CA key and every trusted retired one"""
+    key, current = signing_key()
+    trusted = [base64.b64decode(encoded) for encoded in signing_settings()['TRUSTED_PUBLIC_KEYS']]
+    keys = {signatures.key_id(raw): raw for raw in trusted}
+    keys[current] = signatures.public_bytes(key)
+    return keys
+
+
+def sign_messages(rows):
+    """{message id: certificate} for rows of (id, sender id, receiver id, ciphertext)"""
+    key, current = signing_key()
+    return {
+        message_id: signatures.sign(key, signatures.message_digest(message_id, sender_id, receiver_id, ciphertext), current)
+        for message_id, sender_id, receiver_id, ciphertext in rows
+    }
+
+
+def _verify_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: the parent may be a threaded web server
+            _pool = ProcessPoolExecutor(
+                max_workers=signing_settings()['VERIFY_WORKERS'], mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+def verify_items(items):
+    """signatures.verify_batch() over `items`, in the process pool when there are enough"""
+    config = signing_settings()
+    verify = partial(signatures.verify_batch, public_keys())
+    if len(items) < config['PARALLEL_THRESHOLD'] or config['VERIFY_WORKERS'] <= 1:
+        return verify(items)
+    size = config['VERIFY_CHUNK_SIZE']
+    chunks = [items[index:index + size] for index in range(0, len(items), size)]
+    return [result for results in _verify_pool().map(verify, chunks) for result in results]
+
+
+def verify_certificates(message_ids, user=None):
+    """{message id: status} for the certified messages among `message_ids`
+
+    Statuses are those of app.signatures. Messages without a certificate (or,
+    given `user`, not sent to or by them) are left out.
+    """
+    items = []
+    for alias in message_aliases():
+        certificates = Certificate.objects.using(alias).filter(message_id__in=message_ids)
+        if user is not None:
+            certificates = certificates.filter(Q(message__sender=user) | Q(message__receiver=user))
+        items.extend(certificates.values_list(
+            'message_id', 'message__sender_id', 'message__receiver_id', 'message__encrypted_content', 'certificate_data',
+        ))
+    return dict(verify_items(items))
+
+
+def resign_certificates(alias, message_ids):
+    """Sign the certified messages among `message_ids` again, after their ciphertext changed"""
+    rows = list(
+        Message.objects.using(alias).filter(id__in=message_ids, cert__isnull=False)
+        .values_list('id', 'sender_id', 'receiver_id', 'encrypted_content')
+    )
+    signed = sign_messages(rows)
+    with transaction.atomic(using=alias):
+        Message.objects.using(alias).bulk_update(
+            [Message(id=message_id, certificate=certificate) for message_id, certificate in signed.items()],
+            ['certificate'],
+        )
+        certificates = list(Certificate.objects.using(alias).filter(message_id__in=signed).only('id', 'message_id'))
+        for certificate in certificates:
+            certificate.certificate_data = signed[certificate.message_id]
+        Certificate.objects.using(alias).bulk_update(certificates, ['certificate_data'])
+    return len(signed)
+
+
+def _to_position(value):
+    return int(value.timestamp() * 1_000_000)
+
+
+def _from_position(position):
+    return datetime.fromtimestamp(position / 1_000_000, tz=dt_timezone.utc)
+
+
+def expire_certificates(batch_size=1000, now=None):
+    """Record every certificate that expired since the last sweep; returns how many"""
+    now = now or timezone.now()
+    return sum(_expire_on(alias, batch_size, now) for alias in message_aliases())
+
+
+def _expire_on(alias, batch_size, now):
+    checkpoint_name = CHECKPOINT_NAME if alias is None else f'{CHECKPOINT_NAME}:{alias}'
+    checkpoint, _ = Checkpoint.objects.get_or_create(name=checkpoint_name)
+    expired = 0
+    while True:
+        # Rows tied on the cursor's timestamp are re-read but skipped by expired_at
+        rows = list(
+            Certificate.objects.using(alias)
+            .filter(valid_until__gte=_from_position(checkpoint.position), valid_until__lte=now, expired_at=None)
+            .order_by('valid_until', 'id')
+            .values_list('id', 'message_id', 'valid_until')[:batch_size]
+        )
+        if not rows:
+            return expired
+
+        with transaction.atomic(using=alias):
+            Certificate.objects.using(alias).filter(id__in=[row[0] for row in rows]).update(expired_at=now)
+            logs = [
+                MessageLog(message_id=message_id, log_type='EXPIRE', notes=f'Certificate expired {valid_until:%Y-%m-%d %H:%M}')
+                for _, message_id, valid_until in rows
+            ]
+            MessageLog.chain(alias, logs)
+            MessageLog.objects.using(alias).bulk_create(logs)
+        cache.delete_many([f'{CACHE_PREFIX}{message_id}' for _, message_id, _ in rows])
+        checkpoint.position = _to_position(rows[-1][2])
+        checkpoint.save(update_fields=['position', 'updated_at'])
+        expired += len(rows)
+        if len(rows) < batch_size:
+            return expired
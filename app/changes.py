@@ -0,0 +1,91 @@
+"""
+Delta sync.
+
+Every write that inserts a message or changes what a client shows for it
+(its status, or the receiver reading it) sets the message's change_seq to the
+next value of a counter kept on the message's own database (a Checkpoint row,
+see Checkpoint.advance). Message.save() does so itself; the bulk writers in
+app.lifecycle, app.receipts and ``rebalance_shards`` call next_change(). The
+counter is advanced inside the writing transaction, so its row lock orders
+the writers: no change numbered below one a client has already seen can
+commit later, and "everything after N" never skips a row. SQLite has one
+writer per database file anyway, so there the lock costs no concurrency,
+only the advance itself: one UPDATE ... RETURNING (bench_db_writes runs
+faster with it than without, as the lock taken first spares the retries).
+
+changes_since() answers the sync API. A client's position is an opaque,
+signed token holding the last (change_seq, id) it received from each message
+database; a client that is up to date costs one index lookup per database
+and gets an empty page.
+"""
+from django.core import signing
+from django.db import router
+from django.db.models import Q
+
+from .models import CHANGE_COUNTER, Checkpoint, Message
+from .sharding import message_aliases
+
+
+SALT = 'app.changes'
+FIELDS = ('id', 'status', 'sender_id', 'receiver_id', 'subject', 'conversation_id', 'timestamp', 'updated_at', 'read_at')
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+
+def next_change(alias):
+    """The next change number on `alias` (the messages' database); call inside the writing transaction"""
+    return Checkpoint.advance(alias or router.db_for_write(Message), CHANGE_COUNTER)
+
+
+async def achange_positions():
+    """Every message database's change counter; moves on each write a client could see"""
+    return [
+        await Checkpoint.objects.using(alias).filter(name=CHANGE_COUNTER).values_list('position', flat=True).afirst()
+        for alias in message_aliases()
+    ]
+
+
+def encode_token(positions):
+    return signing.dumps(positions, salt=SALT, compress=True)
+
+
+def decode_token(token):
+    """{database: [change_seq, id]} from a sync token; {} (from the start) for none. Raises BadSignature."""
+    if not token:
+        return {}
+    positions = signing.loads(token, salt=SALT)
+    if not isinstance(positions, dict):
+        raise signing.BadSignature('Malformed sync token')
+    return positions
+
+
+def _after(position):
+    change_seq, row_id = position
+    return Q(change_seq__gt=change_seq) | Q(change_seq=change_seq, id__gt=row_id)
+
+
+def changes_since(user_id, token=None, limit=None):
+    """(rows, next token, more) for messages sent or received by a user since `token`
+
+    Rows are tuples of FIELDS in change order per database, at most `limit`
+    (PAGE_SIZE by default, MAX_PAGE_SIZE at most). Raises
+    signing.BadSignature for a token this server did not issue.
+    """
+    limit = min(max(limit or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+    positions = decode_token(token)
+    rows, more = [], False
+    for alias in message_aliases():
+        key = alias or 'default'
+        messages = Message.objects.using(alias).filter(Q(receiver_id=user_id) | Q(sender_id=user_id))
+        if key in positions:
+            messages = messages.filter(_after(positions[key]))
+        wanted = limit - len(rows)
+        page = list(messages.order_by('change_seq', 'id').values_list('change_seq', *FIELDS)[:wanted + 1])
+        if len(page) > wanted:
+            page, more = page[:wanted], True
+        if page:
+            positions[key] = [page[-1][0], page[-1][1]]
+            rows.extend(row[1:] for row in page)
+        if more:
+            break
+    return rows, encode_token(positions), more
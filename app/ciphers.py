@@ -0,0 +1,182 @@
+"""
+Pluggable symmetric cipher backends for message bodies.
+
+Every backend produces URL-safe base64 text whose first decoded byte is a
+version tag, so Message.decrypt_content can pick the right backend for any
+stored row:
+
+    0x80  Fernet (AES-128-CBC + HMAC-SHA256); the tag is Fernet's own
+    0x01  AES-256-GCM        version | 12-byte nonce | ciphertext + tag
+    0x02  ChaCha20-Poly1305  version | 12-byte nonce | ciphertext + tag
+
+The AEAD backends authenticate the version byte as associated data.
+decrypt_prefix() recovers just the start of a large body for previews by
+running the underlying block/stream cipher over its first bytes; that output
+is NOT authenticated and must only ever be used for display. This module
+only depends on ``cryptography`` so it can be imported by worker processes
+that never set Django up, and it imports ``cryptography`` on first use only:
+app.models imports it, so every process that sets Django up would otherwise
+pay for loading OpenSSL bindings it may never call.
+"""
+import base64
+import binascii
+import os
+
+
+class DecryptionError(Exception):
+    """A token could not be decrypted with the given key"""
+
+
+def _decoded_length(token):
+    """Length of the bytes a padded base64 token decodes to"""
+    return len(token) // 4 * 3 - len(token[-2:]) + len(token[-2:].rstrip('='))
+
+
+def _decode_head(token, size):
+    """First `size` decoded bytes, decoding only the base64 quanta they need"""
+    return base64.urlsafe_b64decode(token[:-(-size // 3) * 4])[:size]
+
+
+class CipherBackend:
+    """Interface for message body ciphers (keys and tokens are text)"""
+    name = None
+    version = None
+
+    def generate_key(self):
+        raise NotImplementedError
+
+    def encrypt(self, key, plaintext):
+        raise NotImplementedError
+
+    def decrypt(self, key, token):
+        raise NotImplementedError
+
+    def decrypt_prefix(self, key, token, size):
+        """At least the first `size` plaintext bytes (unauthenticated for large tokens)"""
+        return self.decrypt(key, token)[:size]
+
+
+class FernetBackend(CipherBackend):
+    """The original format; every pre-existing row uses it"""
+    name = 'fernet'
+    version = 0x80
+
+    def generate_key(self):
+        from cryptography.fernet import Fernet
+        return Fernet.generate_key().decode('ascii')
+
+    def encrypt(self, key, plaintext):
+        from cryptography.fernet import Fernet
+        return Fernet(key.encode('ascii')).encrypt(plaintext).decode('ascii')
+
+    def decrypt(self, key, token):
+        from cryptography.fernet import Fernet, InvalidToken
+        try:
+            return Fernet(key.encode('ascii')).decrypt(token.encode('ascii'))
+        except (InvalidToken, ValueError, TypeError) as exc:
+            raise DecryptionError(str(exc) or 'Invalid token') from exc
+
+    def decrypt_prefix(self, key, token, size):
+        # Token: version(1) | timestamp(8) | iv(16) | AES-CBC ciphertext | HMAC(32)
+        blocks = -(-size // 16) * 16
+        if 25 + blocks >= _decoded_length(token) - 32:
+            # The prefix reaches the padded final block: just decrypt it all
+            return self.decrypt(key, token)[:size]
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        try:
+            head = _decode_head(token, 25 + blocks)
+            decryptor = Cipher(algorithms.AES(base64.urlsafe_b64decode(key)[16:]), modes.CBC(head[9:25])).decryptor()
+            return decryptor.update(head[25:])[:size]
+        except (ValueError, TypeError, binascii.Error) as exc:
+            raise DecryptionError(str(exc) or 'Invalid token') from exc
+
+
+class AEADBackend(CipherBackend):
+    """Single-pass AEAD with a random 96-bit nonce and a 256-bit key"""
+    algorithm = None  # Class name in cryptography.hazmat.primitives.ciphers.aead
+    nonce_size = 12
+
+    def _aead(self, raw_key):
+        from cryptography.hazmat.primitives.ciphers import aead
+        return getattr(aead, self.algorithm)(raw_key)
+
+    def generate_key(self):
+        return base64.urlsafe_b64encode(os.urandom(32)).decode('ascii')
+
+    def encrypt(self, key, plaintext):
+        header = bytes([self.version])
+        nonce = os.urandom(self.nonce_size)
+        sealed = self._aead(base64.urlsafe_b64decode(key)).encrypt(nonce, plaintext, header)
+        return base64.urlsafe_b64encode(header + nonce + sealed).decode('ascii')
+
+    def decrypt(self, key, token):
+        from cryptography.exceptions import InvalidTag
+        try:
+            raw = base64.urlsafe_b64decode(token)
+            header, nonce, sealed = raw[:1], raw[1:1 + self.nonce_size], raw[1 + self.nonce_size:]
+            return self._aead(base64.urlsafe_b64decode(key)).decrypt(nonce, sealed, header)
+        except (InvalidTag, ValueError, TypeError, binascii.Error) as exc:
+            raise DecryptionError(str(exc) or 'Invalid token') from exc
+
+    def _keystream_cipher(self, raw_key, nonce):
+        raise NotImplementedError
+
+    def decrypt_prefix(self, key, token, size):
+        offset = 1 + self.nonce_size
+        size = min(size, _decoded_length(token) - offset - 16)  # 16-byte tag at the end
+        if size <= 0:
+            return b''
+        try:
+            head = _decode_head(token, offset + size)
+            decryptor = self._keystream_cipher(base64.urlsafe_b64decode(key), head[1:offset]).decryptor()
+            return decryptor.update(head[offset:])
+        except (ValueError, TypeError, binascii.Error) as exc:
+            raise DecryptionError(str(exc) or 'Invalid token') from exc
+
+
+class AESGCMBackend(AEADBackend):
+    name = 'aesgcm'
+    version = 0x01
+    algorithm = 'AESGCM'
+
+    def _keystream_cipher(self, raw_key, nonce):
+        # GCM encrypts the payload with CTR starting at counter block 2
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        return Cipher(algorithms.AES(raw_key), modes.CTR(nonce + (2).to_bytes(4, 'big')))
+
+
+class ChaCha20Poly1305Backend(AEADBackend):
+    name = 'chacha20'
+    version = 0x02
+    algorithm = 'ChaCha20Poly1305'
+
+    def _keystream_cipher(self, raw_key, nonce):
+        # RFC 8439 encrypts the payload starting at block counter 1
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+        return Cipher(algorithms.ChaCha20(raw_key, (1).to_bytes(4, 'little') + nonce), mode=None)
+
+
+CIPHER_BACKENDS = {
+    backend.name: backend
+    for backend in (FernetBackend(), AESGCMBackend(), ChaCha20Poly1305Backend())
+}
+_BY_VERSION = {backend.version: backend for backend in CIPHER_BACKENDS.values()}
+
+
+def get_backend(name):
+    try:
+        return CIPHER_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown cipher backend {name!r}; choose from {", ".join(CIPHER_BACKENDS)}')
+
+
+def backend_for_token(token):
+    """Backend that produced a stored token, from its version byte"""
+    try:
+        version = base64.urlsafe_b64decode(token[:4])[0]
+    except (ValueError, IndexError, binascii.Error) as exc:
+        raise DecryptionError('Malformed token') from exc
+    try:
+        return _BY_VERSION[version]
+    except KeyError:
+        raise DecryptionError(f'Unknown token version 0x{version:02x}')
@@ -0,0 +1,134 @@
+"""
+ETag validators for conditional GET.
+
+Used with Django's ``@condition`` decorator so a client polling an unchanged
+mailbox, message or stats endpoint gets a 304 before the view queries
+ciphertext, decrypts or renders anything. Mailbox validators are the
+(max updated_at, count) of the user's messages, read from the
+(receiver, updated_at) / (sender, updated_at) indexes alone; a message's
+validator is its updated_at, log count and certificate validity. The stats
+validator is the user's profile and each message database's change counter
+(see app/changes.py): one indexed read per database instead of the counts
+it guards. The counter moves on every message write; a message deleted in
+the admin shows at the next one. Only ETags are emitted: new log entries
+and certificates expiring change a page without touching updated_at, so
+Last-Modified would lie.
+
+HTML validators include the session key, which rotates at login, so a
+revalidated page never carries a stale CSRF token, and the user's unread
+count shown in the navbar.
+
+The validators are async, like the views they guard (app/async_support.py).
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.http import Http404
+
+from .async_support import load_profile
+from .certificates import acertificate_validity
+from .changes import achange_positions
+from .models import Message, UserRole
+from .previews import previews_requested
+from .sharding import aget_message_or_404, ascatter_count, message_aliases, receiver_messages
+
+
+# Messages waiting on a router or the CA, counted in api_user_stats
+PENDING_STATUSES = ('SENT', 'ROUTER_ACCEPTED')
+
+
+def _etag(*parts):
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=12).hexdigest()
+
+
+async def _mailbox_state(querysets):
+    """(latest updated_at, row count) over one queryset per shard"""
+    latest, total = None, 0
+    for queryset in querysets:
+        row = await queryset.aaggregate(latest=Max('updated_at'), total=Count('id'))
+        total += row['total']
+        if row['latest'] is not None and (latest is None or row['latest'] > latest):
+            latest = row['latest']
+    return latest, total
+
+
+async def _page_state(request):
+    """What every HTML page shows besides its content: the session (CSRF) and the navbar's unread count"""
+    profile = await load_profile(request.user)
+    return request.user.id, request.session.session_key, profile and profile.unread_count
+
+
+async def inbox_etag(request):
+    user_id = request.user.id
+    state = await _mailbox_state([receiver_messages(user_id).filter(receiver_id=user_id)])
+    return _etag(
+        'inbox', await _page_state(request), request.GET.get('page'), previews_requested(request), state,
+    )
+
+
+async def outbox_etag(request):
+    user_id = request.user.id
+    state = await _mailbox_state([
+        Message.objects.using(alias).filter(sender_id=user_id) for alias in message_aliases()
+    ])
+    return _etag(
+        'outbox', await _page_state(request), request.GET.get('page'), previews_requested(request), state,
+    )
+
+
+async def _message_state(request, message_id):
+    """Validator parts for a message the user may see, or None (the view then answers)"""
+    try:
+        message = await aget_message_or_404(
+            Message.objects.annotate(log_count=Count('logs'))
+            .only('id', 'status', 'sender_id', 'receiver_id', 'updated_at'),
+            message_id,
+        )
+    except Http404:
+        return None
+    if request.user.id not in (message.sender_id, message.receiver_id):
+        return None
+    certificate = await acertificate_validity(message)
+    return message.id, message.updated_at, message.log_count, certificate and certificate['valid']
+
+
+async def message_etag(request, message_id):
+    state = await _message_state(request, message_id)
+    if state is None:
+        return None
+    return _etag('message', await _page_state(request), state)
+
+
+async def message_status_etag(request, message_id):
+    state = await _message_state(request, message_id)
+    if state is None:
+        return None
+    return _etag('message_status', state)
+
+
+async def user_stats(request):
+    """The api_user_stats payload, computed once per request"""
+    if not hasattr(request, '_user_stats'):
+        user_id = request.user.id
+        profile = await load_profile(request.user)
+        request._user_stats = {
+            'username': request.user.username,
+            'role': profile.role,
+            'sent_messages': await ascatter_count(lambda messages: messages.filter(sender_id=user_id)),
+            'received_messages': await receiver_messages(user_id).filter(receiver_id=user_id).acount(),
+            'unread_messages': profile.unread_count,
+            # One count per status: each is served by that status's partial queue index
+            'pending_actions': sum([
+                await ascatter_count(lambda messages: messages.filter(status=status))
+                for status in PENDING_STATUSES
+            ]) if profile.role in [UserRole.ROUTER, UserRole.CLOUD_AUTHORITY] else 0,
+        }
+    return request._user_stats
+
+
+async def user_stats_etag(request):
+    profile = await load_profile(request.user)
+    return _etag(
+        'user_stats', request.user.id, request.user.username, profile.role, profile.unread_count,
+        await achange_positions(),
+    )
@@ -0,0 +1,119 @@
+"""
+Conversation threads.
+
+A Conversation groups the messages between two users (both directions)
+and keeps denormalized pointers to its latest activity, so nothing ever
+groups the Message table by participant pair. Each participant has a
+ConversationMember row holding their unread count and a copy of
+last_activity: a user's conversation list is one range scan of the
+(user, last_activity, id) index, joined to the conversation and the peer.
+
+Conversations live on the default database. Their messages carry a
+conversation_id and live on the receiver's shard, so a thread reads at most
+two shards, keyset-paginated on the (conversation_id, timestamp, id) index.
+send_message attaches the conversation before saving and records the
+message after, which also bumps the receiver's unread counters (app.receipts
+brings them back down as messages are read); ``rebuild_conversations``
+backfills older messages and repairs the conversation counters.
+"""
+import heapq
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .database import retry_on_lock
+from .models import Conversation, ConversationMember, Message, UserProfile
+from .sharding import shard_for_receiver
+
+
+PAGE_SIZE = 20
+LIST_SIZE = 50
+
+
+@retry_on_lock
+def conversation_for(sender_id, receiver_id):
+    """The conversation between two users, created with its members on first use"""
+    user_a_id, user_b_id = sorted((sender_id, receiver_id))
+    conversation = Conversation.objects.filter(user_a_id=user_a_id, user_b_id=user_b_id).first()
+    if conversation is not None:
+        return conversation
+    try:
+        with transaction.atomic():
+            conversation = Conversation.objects.create(user_a_id=user_a_id, user_b_id=user_b_id)
+            ConversationMember.objects.bulk_create([
+                ConversationMember(conversation=conversation, user_id=user_id, peer_id=peer_id)
+                for user_id, peer_id in {(user_a_id, user_b_id), (user_b_id, user_a_id)}
+            ])
+    except IntegrityError:
+        # Created concurrently by the other participant
+        conversation = Conversation.objects.get(user_a_id=user_a_id, user_b_id=user_b_id)
+    return conversation
+
+
+@retry_on_lock
+@transaction.atomic
+def record_message(conversation_id, message):
+    """Fold a saved message into its conversation's pointers and the receiver's unread counts"""
+    Conversation.objects.filter(id=conversation_id).update(
+        last_message_id=Case(
+            When(last_activity__gt=message.timestamp, then=F('last_message_id')),
+            default=Value(message.id),
+        ),
+        last_activity=Greatest(F('last_activity'), Value(message.timestamp)),
+        message_count=F('message_count') + 1,
+    )
+    ConversationMember.objects.filter(conversation_id=conversation_id).update(
+        last_activity=Greatest(F('last_activity'), Value(message.timestamp)),
+        unread_count=Case(
+            When(user_id=message.receiver_id, then=F('unread_count') + 1),
+            default=F('unread_count'),
+            output_field=PositiveIntegerField(),
+        ),
+    )
+    UserProfile.objects.filter(user_id=message.receiver_id).update(unread_count=F('unread_count') + 1)
+
+
+def encode_cursor(timestamp, row_id):
+    return f'{int(timestamp.timestamp() * 1_000_000)}_{row_id}'
+
+
+def decode_cursor(value):
+    """(timestamp, id) from a ?before= cursor, or None for the first page"""
+    try:
+        micros, row_id = value.split('_')
+        return datetime.fromtimestamp(int(micros) / 1_000_000, tz=dt_timezone.utc), int(row_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _before(field, cursor):
+    timestamp, row_id = cursor
+    return Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': row_id})
+
+
+def conversation_page(user, cursor=None):
+    """(memberships, next cursor) for a user's most recent conversations"""
+    memberships = ConversationMember.objects.filter(user=user).select_related('conversation', 'peer')
+    if cursor:
+        memberships = memberships.filter(_before('last_activity', cursor))
+    rows = list(memberships.order_by('-last_activity', '-id')[:LIST_SIZE + 1])
+    if len(rows) > LIST_SIZE:
+        return rows[:LIST_SIZE], encode_cursor(rows[LIST_SIZE - 1].last_activity, rows[LIST_SIZE - 1].id)
+    return rows, None
+
+
+def thread_page(membership, cursor=None, deferred=()):
+    """(messages newest first, next cursor) for one page of a conversation"""
+    aliases = dict.fromkeys([shard_for_receiver(membership.user_id), shard_for_receiver(membership.peer_id)])
+    parts = []
+    for alias in aliases:
+        messages = Message.objects.using(alias).filter(conversation_id=membership.conversation_id)
+        if cursor:
+            messages = messages.filter(_before('timestamp', cursor))
+        parts.append(list(messages.defer(*deferred).order_by('-timestamp', '-id')[:PAGE_SIZE + 1]))
+    rows = list(heapq.merge(*parts, key=lambda message: (message.timestamp, message.id), reverse=True))
+    if len(rows) > PAGE_SIZE:
+        return rows[:PAGE_SIZE], encode_cursor(rows[PAGE_SIZE - 1].timestamp, rows[PAGE_SIZE - 1].id)
+    return rows, None
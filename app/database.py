@@ -0,0 +1,83 @@
+"""
+Database connection profile.
+
+Every database connection is tuned when it opens. With SQLite that means
+write-ahead logging (readers no longer wait for a writer, and a commit is an
+append), synchronous=NORMAL (no fsync per commit; the WAL is synced at
+checkpoints, so a power cut can lose the last commits but never corrupts
+the file), a memory map over the database file, and a busy timeout so a
+writer waits for the lock instead of failing at once. Connections are kept
+open between requests (CONN_MAX_AGE in settings).
+
+SQLite still has one writer at a time, and a transaction that read before
+writing cannot wait for the lock: once another writer has committed its
+snapshot is stale and it fails with "database is locked" straight away. The
+write paths therefore take the lock with their first statement (see
+app/lifecycle.py), and are wrapped in ``@retry_on_lock``, which runs the
+whole transaction again after an exponential, jittered backoff.
+"""
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def database_settings():
+    config = {
+        'SQLITE_PRAGMAS': {
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'mmap_size': 256 * 1024 * 1024,
+            'busy_timeout': 5000,  # Milliseconds a writer waits for the lock
+        },
+        'LOCK_RETRIES': 5,
+        'LOCK_BACKOFF': 0.05,  # Seconds before the first retry, doubled each time
+        'LOCK_MAX_BACKOFF': 1.0,
+    }
+    config.update(getattr(settings, 'DATABASE_TUNING', {}))
+    return config
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # On the driver connection, so query budgets and profiling don't count it
+    for name, value in database_settings()['SQLITE_PRAGMAS'].items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(text in str(error) for text in LOCK_ERRORS)
+
+
+def _in_transaction():
+    return any(connection.in_atomic_block for connection in connections.all(initialized_only=True))
+
+
+def retry_on_lock(func):
+    """Call `func` again after a backoff when it fails on a locked database
+
+    For functions whose writes are their own transaction and safe to repeat.
+    Inside a caller's transaction the error is raised: only the outermost
+    transaction can be retried.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        config = database_settings()
+        for attempt in range(config['LOCK_RETRIES'] + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                if attempt == config['LOCK_RETRIES'] or not is_lock_error(error) or _in_transaction():
+                    raise
+            delay = min(config['LOCK_BACKOFF'] * 2 ** attempt, config['LOCK_MAX_BACKOFF'])
+            time.sleep(delay * random.uniform(0.5, 1.0))
+    return wrapper
@@ -6,6 +6,16 @@ import re
 from .models import UserProfile, Message, UserRole
 
 
+def check_password_strength(password):
+    """Raise ValidationError unless the password meets the registration rules"""
+    if len(password) < 8:
+        raise ValidationError('Password must be at least 8 characters long.')
+    if not re.search(r'[A-Z]', password):
+        raise ValidationError('Password must contain at least one uppercase letter.')
+    if not re.search(r'[0-9]', password):
+        raise ValidationError('Password must contain at least one digit.')
+
+
 class UserRegistrationForm(forms.ModelForm):
     """User registration form"""
     password = forms.CharField(
@@ -51,12 +61,7 @@ class UserRegistrationForm(forms.ModelForm):
 
     def clean_password(self):
         password = self.cleaned_data.get('password')
-        if len(password) < 8:
-            raise ValidationError('Password must be at least 8 characters long.')
-        if not re.search(r'[A-Z]', password):
-            raise ValidationError('Password must contain at least one uppercase letter.')
-        if not re.search(r'[0-9]', password):
-            raise ValidationError('Password must contain at least one digit.')
+        check_password_strength(password)
         return password
 
     def clean(self):
@@ -135,15 +140,7 @@ class SendMessageForm(forms.ModelForm):
 
 
 class CAApprovalForm(forms.Form):
-    """Form for Cloud Authority to approve messages"""
-    certificate_data = forms.CharField(
-        widget=forms.Textarea(attrs={
-            'class': 'form-control',
-            'rows': 4,
-            'placeholder': 'Enter certificate/signature data'
-        }),
-        label='Certificate/Signature'
-    )
+    """Form for Cloud Authority to approve messages (the certificate itself is signed with the CA key)"""
     notes = forms.CharField(
         widget=forms.Textarea(attrs={
             'class': 'form-control',
@@ -163,6 +160,7 @@ class MessageFilterForm(forms.Form):
     STATUS_CHOICES = [
         ('', 'All Statuses'),
         ('DRAFT', 'Draft'),
+        ('QUEUED', 'Queued for later'),
         ('SENT', 'Sent'),
         ('ROUTER_ACCEPTED', 'Router Accepted'),
         ('CERTIFICATE_CREATED', 'Certificate Created'),
@@ -190,3 +188,12 @@ class MessageFilterForm(forms.Form):
             'type': 'datetime-local'
         })
     )
+
+
+class UserUploadForm(forms.Form):
+    """CSV or NDJSON file of users for bulk provisioning (see app/provisioning.py)"""
+    file = forms.FileField(
+        widget=forms.ClearableFileInput(attrs={'accept': '.csv,.ndjson,.jsonl'}),
+        help_text='Columns: username, email, first_name, last_name, password, role, organization'
+    )
+    dry_run = forms.BooleanField(required=False, label='Only validate the file')
@@ -0,0 +1,172 @@
+"""
+Database-backed job queue.
+
+Handlers are plain functions registered with ``@job('name')`` (see
+app/tasks.py); ``enqueue('name', {...})`` stores a Job row and returns at
+once, and ``manage.py worker`` processes claim and run them. There is no
+broker: the Job table on the default database is the queue, so it works the
+same on SQLite and on a production database.
+
+Workers claim a batch by stamping it with a unique lock token in a single
+conditional UPDATE, using SELECT ... FOR UPDATE SKIP LOCKED where the
+backend has it. A claim is a lease: a job whose worker died is claimed
+again once LEASE_SECONDS have passed. Failed jobs are retried with
+exponential backoff until max_attempts, then left as DEAD (the dead-letter
+queue) for inspection and ``worker --retry-dead``. Finished jobs are deleted.
+"""
+import logging
+import os
+import random
+import socket
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .database import retry_on_lock
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+
+
+def job_settings():
+    config = {
+        'EAGER': False,  # Run handlers inline in enqueue() instead of queueing
+        'MAX_ATTEMPTS': 5,
+        'BACKOFF_SECONDS': 5,  # Delay before the first retry, doubled for each further one
+        'BACKOFF_MAX_SECONDS': 3600,
+        'LEASE_SECONDS': 300,
+        'BATCH_SIZE': 10,
+        'POLL_INTERVAL': 1.0,
+    }
+    config.update(getattr(settings, 'JOB_QUEUE', {}))
+    return config
+
+
+def job(name):
+    """Register a function as the handler for jobs of kind `name`"""
+    def register(func):
+        JOB_HANDLERS[name] = func
+        return func
+    return register
+
+
+def enqueue(kind, payload=None, priority=100, delay=0, max_attempts=None):
+    """Queue a job (payload must be JSON serializable); returns the Job, or None when run eagerly"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'No job handler registered for {kind!r}')
+    config = job_settings()
+    payload = payload or {}
+    if config['EAGER']:
+        JOB_HANDLERS[kind](**payload)
+        return None
+    return _create_job(
+        kind=kind,
+        payload=payload,
+        priority=priority,
+        max_attempts=max_attempts or config['MAX_ATTEMPTS'],
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+@retry_on_lock
+def _create_job(**fields):
+    return Job.objects.create(**fields)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_jobs(worker, limit):
+    """Lease up to `limit` due jobs to `worker`, highest priority first"""
+    config = job_settings()
+    now = timezone.now()
+    claimable = (
+        Q(status=Job.QUEUED, run_at__lte=now)
+        | Q(status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=config['LEASE_SECONDS']))
+    )
+    token = f'{worker}:{uuid.uuid4().hex[:12]}'
+    lease = {'status': Job.RUNNING, 'locked_by': token, 'locked_at': now, 'attempts': F('attempts') + 1}
+    candidates = Job.objects.filter(claimable).order_by('priority', 'run_at', 'id')
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(candidates.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Job.objects.filter(id__in=ids).update(**lease)
+    else:
+        # One UPDATE ... WHERE id IN (SELECT ... LIMIT n) is atomic by itself; a
+        # SELECT followed by an UPDATE would deadlock concurrent SQLite writers
+        Job.objects.filter(claimable, id__in=candidates.values('id')[:limit]).update(**lease)
+    return list(Job.objects.filter(locked_by=token).order_by('priority', 'run_at', 'id'))
+
+
+def backoff_delay(attempts):
+    """Seconds before retry number `attempts`, with jitter so failures don't retry in lockstep"""
+    config = job_settings()
+    delay = min(config['BACKOFF_SECONDS'] * 2 ** (attempts - 1), config['BACKOFF_MAX_SECONDS'])
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _fail(job, error):
+    job.last_error = error
+    job.locked_by = ''
+    job.locked_at = None
+    if job.attempts >= job.max_attempts:
+        job.status = Job.DEAD
+        logger.error('Job %s is dead after %s attempts: %s', job, job.attempts, error.splitlines()[-1])
+    else:
+        job.status = Job.QUEUED
+        job.run_at = timezone.now() + timedelta(seconds=backoff_delay(job.attempts))
+    job.save(update_fields=['status', 'run_at', 'last_error', 'locked_by', 'locked_at', 'updated_at'])
+
+
+def run_job(job):
+    """Run one claimed job; returns True if it succeeded"""
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        job.attempts = job.max_attempts
+        _fail(job, f'No job handler registered for {job.kind!r}')
+        return False
+    if job.attempts > job.max_attempts:
+        # Its lease kept expiring: the job keeps killing or hanging its worker
+        _fail(job, job.last_error or 'Lease expired on every attempt')
+        return False
+    try:
+        handler(**job.payload)
+    except Exception:
+        _fail(job, traceback.format_exc())
+        return False
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).delete()
+    return True
+
+
+def work(worker=None, batch_size=None, should_stop=lambda: False):
+    """Claim and run batches until the queue has nothing due; returns (succeeded, failed)"""
+    worker = worker or worker_name()
+    batch_size = batch_size or job_settings()['BATCH_SIZE']
+    succeeded = failed = 0
+    while not should_stop():
+        jobs = claim_jobs(worker, batch_size)
+        if not jobs:
+            break
+        for claimed in jobs:
+            if run_job(claimed):
+                succeeded += 1
+            else:
+                failed += 1
+    return succeeded, failed
+
+
+def retry_dead_jobs(kind=None):
+    """Put dead-lettered jobs back on the queue with fresh attempts"""
+    dead = Job.objects.filter(status=Job.DEAD)
+    if kind:
+        dead = dead.filter(kind=kind)
+    return dead.update(status=Job.QUEUED, attempts=0, run_at=timezone.now(), last_error='')
@@ -0,0 +1,32 @@
+"""
+Parallel message re-encryption.
+
+rotate_chunk() is the unit of work handed to the process pool by the
+``rotate_message_keys`` command: it decrypts each row with its current key
+(whatever backend wrote it) and re-encrypts it under a freshly generated key
+for the target backend. It deliberately depends only on app.ciphers so
+worker processes never need Django set up.
+"""
+import os
+import time
+
+from .ciphers import DecryptionError, backend_for_token, get_backend
+
+
+def rotate_chunk(rows, backend_name='fernet'):
+    """Re-encrypt [(id, key, ciphertext), ...] under new keys
+
+    Returns (pid, busy_seconds, [(id, new_key, new_ciphertext), ...], [failed ids]).
+    """
+    start = time.perf_counter()
+    target = get_backend(backend_name)
+    rotated, failed = [], []
+    for message_id, key, ciphertext in rows:
+        try:
+            plaintext = backend_for_token(ciphertext).decrypt(key, ciphertext)
+        except DecryptionError:
+            failed.append(message_id)
+            continue
+        new_key = target.generate_key()
+        rotated.append((message_id, new_key, target.encrypt(new_key, plaintext)))
+    return os.getpid(), time.perf_counter() - start, rotated, failed
@@ -0,0 +1,99 @@
+"""
+Batched message status transitions.
+
+transition_messages() moves many messages on one database from one status to
+the next with a single UPDATE and writes their MessageLog rows with a single
+bulk INSERT, instead of a save() and a log insert per message. Only rows
+still in the expected status are moved, so a message a human (or another
+worker) decided in the meantime is left alone. The moved rows stay locked
+until the logs are written, so their audit hash chains cannot fork. The
+transaction starts by advancing the change counter, a write, so on SQLite it
+holds the write lock before it reads (see app/database.py).
+
+store_message() stores a new message and its SEND log entry in one
+transaction, so no sent message is ever missing the head of its audit chain.
+
+certify_messages() signs each message's digest with the CA key (see
+app/certificates.py) and sets every message's own certificate in the same
+UPDATE through a CASE over the ids.
+"""
+from datetime import timedelta
+
+from django.db import router, transaction
+from django.db.models import Case, TextField, Value, When
+from django.utils import timezone
+
+from .certificates import sign_messages
+from .changes import next_change
+from .database import retry_on_lock
+from .models import Certificate, Message, MessageLog
+
+
+@retry_on_lock
+def store_message(message, actor, notes='User sent message'):
+    """Insert a new message with its SEND log entry; QUEUED messages are logged when released"""
+    alias = router.db_for_write(Message, instance=message)
+    with transaction.atomic(using=alias):
+        message.save(using=alias)
+        if message.status == 'SENT':
+            message.logs.create(actor=actor, log_type='SEND', notes=notes)
+    return message
+
+
+@retry_on_lock
+def transition_messages(alias, message_ids, from_status, to_status, log_type,
+                        actor=None, notes='', rule_id=None, changes=None):
+    """Move messages still in `from_status` to `to_status`; returns the ids moved
+
+    `changes` are further field values set by the same UPDATE.
+    """
+    if not message_ids:
+        return []
+    with transaction.atomic(using=alias):
+        change_seq = next_change(alias)
+        moved = list(
+            Message.objects.using(alias).select_for_update()
+            .filter(id__in=message_ids, status=from_status)
+            .values_list('id', flat=True)
+        )
+        if not moved:
+            return []
+        Message.objects.using(alias).filter(id__in=moved).update(
+            status=to_status, updated_at=timezone.now(), change_seq=change_seq, **(changes or {})
+        )
+        logs = [
+            MessageLog(message_id=message_id, actor=actor, log_type=log_type, notes=notes, rule_id=rule_id)
+            for message_id in moved
+        ]
+        MessageLog.chain(alias, logs)
+        MessageLog.objects.using(alias).bulk_create(logs)
+    return moved
+
+
+@retry_on_lock
+def certify_messages(alias, message_ids, actor, valid_days=365, notes=''):
+    """Sign and issue certificates for router-accepted messages in bulk; returns the ids certified"""
+    with transaction.atomic(using=alias):
+        # Take the write lock before reading what to sign (the number goes unused)
+        next_change(alias)
+        rows = (
+            Message.objects.using(alias).filter(id__in=message_ids, status='ROUTER_ACCEPTED')
+            .values_list('id', 'sender_id', 'receiver_id', 'encrypted_content')
+        )
+        signed = sign_messages(rows)
+        if not signed:
+            return []
+        moved = transition_messages(
+            alias, list(signed), 'ROUTER_ACCEPTED', 'CERTIFICATE_CREATED', 'CERTIFICATE',
+            actor=actor, notes=notes or 'Certificate created by Cloud Authority',
+            changes={'certificate': Case(
+                *(When(id=message_id, then=Value(certificate)) for message_id, certificate in signed.items()),
+                output_field=TextField(),
+            )},
+        )
+        valid_until = timezone.now() + timedelta(days=valid_days)
+        Certificate.objects.using(alias).bulk_create([
+            Certificate(message_id=message_id, issued_by=actor, certificate_data=signed[message_id], valid_until=valid_until)
+            for message_id in moved
+        ])
+    return moved
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, Client
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _shares(total, parts):
+    """Split `total` requests over `parts` connections"""
+    return [total // parts + (1 if index < total % parts else 0) for index in range(parts)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the async views served the ASGI way (one event loop, middleware in async mode) '
+        'with the WSGI way (a fixed pool of worker threads) under the same number of concurrent connections'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help='User to request as (default: the first user with a profile)')
+        parser.add_argument('--paths', default='/inbox/,/api/stats/', help='Comma-separated paths to request')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per path and mode')
+        parser.add_argument('--concurrency', type=int, default=50, help='Connections open at once')
+        parser.add_argument('--threads', type=int, default=8, help='WSGI worker threads')
+        parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Seconds added to every query, to model a database across the network',
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(profile__isnull=False).order_by('id')
+        if options['username']:
+            users = users.filter(username=options['username'])
+        user = users.first()
+        if user is None:
+            raise CommandError('No user with a profile to request as; create one first')
+        if options['latency']:
+            self.add_latency(options['latency'])
+
+        session = Client()
+        session.force_login(user)
+        self.cookies = session.cookies
+        self.stdout.write(
+            f'{options["requests"]} requests per run as {user.username}, {options["concurrency"]} connections, '
+            f'{options["threads"]} WSGI threads, {options["latency"] * 1000:.1f}ms added per query'
+        )
+        self.stdout.write(
+            f'{"path":<24} {"mode":<5} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"errors":>7}'
+        )
+        try:
+            for path in options['paths'].split(','):
+                for mode, run in (('wsgi', self.run_wsgi), ('asgi', self.run_asgi)):
+                    started = time.perf_counter()
+                    results = run(path, options)
+                    elapsed = time.perf_counter() - started
+                    latencies = [latency for latency, _ in results]
+                    errors = sum(1 for _, status in results if status >= 400)
+                    self.stdout.write(
+                        f'{path:<24} {mode:<5} {len(results) / elapsed:>8.0f} '
+                        f'{_percentile(latencies, 0.5) * 1000:>8.1f} {_percentile(latencies, 0.95) * 1000:>8.1f} '
+                        f'{errors:>7}'
+                    )
+        finally:
+            session.logout()
+
+    def add_latency(self, seconds):
+        def delay(execute, sql, params, many, context):
+            time.sleep(seconds)
+            return execute(sql, params, many, context)
+
+        def install(sender, connection, **kwargs):
+            # First in the list: execute_wrapper() pops the last entry on exit
+            connection.execute_wrappers.insert(0, delay)
+
+        # Connections are per thread, so every new one gets the delay too
+        connection_created.connect(install, weak=False)
+        for connection in connections.all():
+            install(None, connection)
+
+    def run_wsgi(self, path, options):
+        """Each connection waits for one of --threads workers, as under a threaded WSGI server"""
+        workers = threading.Semaphore(options['threads'])
+
+        def connection(count):
+            client = Client()
+            client.cookies = self.cookies
+            results = []
+            for _ in range(count):
+                started = time.perf_counter()
+                with workers:
+                    response = client.get(path)
+                results.append((time.perf_counter() - started, response.status_code))
+            connections.close_all()
+            return results
+
+        shares = _shares(options['requests'], options['concurrency'])
+        with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+            return [result for results in pool.map(connection, shares) for result in results]
+
+    def run_asgi(self, path, options):
+        """Every connection on one event loop, each request in its own thread-sensitive context"""
+        async def connection(count):
+            client = AsyncClient()
+            client.cookies = self.cookies
+            results = []
+            for _ in range(count):
+                started = time.perf_counter()
+                # What Django's ASGIHandler does: the request's sync work gets its own thread
+                async with ThreadSensitiveContext():
+                    response = await client.get(path)
+                results.append((time.perf_counter() - started, response.status_code))
+            return results
+
+        async def run():
+            shares = _shares(options['requests'], options['concurrency'])
+            return await asyncio.gather(*(connection(count) for count in shares))
+
+        return [result for results in asyncio.run(run()) for result in results]
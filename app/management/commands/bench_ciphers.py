@@ -0,0 +1,53 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.ciphers import CIPHER_BACKENDS
+
+
+def _measure(function, min_seconds):
+    """Calls per second of `function`, timed for at least `min_seconds`"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return calls / elapsed
+
+
+class Command(BaseCommand):
+    help = 'Compare encrypt/decrypt throughput of the message cipher backends for small and large payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='64,1024,16384,1048576',
+            help='Comma-separated payload sizes in bytes',
+        )
+        parser.add_argument('--seconds', type=float, default=0.5, help='Minimum time per measurement')
+        parser.add_argument('--backends', default=','.join(CIPHER_BACKENDS))
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        backends = [CIPHER_BACKENDS[name] for name in options['backends'].split(',')]
+
+        self.stdout.write(
+            f'{"backend":<10} {"size":>9} {"enc ops/s":>11} {"enc MB/s":>9} '
+            f'{"dec ops/s":>11} {"dec MB/s":>9} {"overhead":>9}'
+        )
+        for size in sizes:
+            payload = os.urandom(size)
+            for backend in backends:
+                key = backend.generate_key()
+                token = backend.encrypt(key, payload)
+                encrypt_rate = _measure(lambda: backend.encrypt(key, payload), options['seconds'])
+                decrypt_rate = _measure(lambda: backend.decrypt(key, token), options['seconds'])
+                self.stdout.write(
+                    f'{backend.name:<10} {size:>9} '
+                    f'{encrypt_rate:>11.0f} {encrypt_rate * size / 1e6:>9.1f} '
+                    f'{decrypt_rate:>11.0f} {decrypt_rate * size / 1e6:>9.1f} '
+                    f'{len(token) / size:>8.2f}x'
+                )
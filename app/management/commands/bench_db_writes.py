@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test import override_settings
+
+from app.database import database_settings
+from app.lifecycle import transition_messages
+from app.models import Message
+from app.sharding import message_aliases
+
+
+MARKER = 'bench_db_writes'
+
+# Django's defaults: rollback journal, fsync on every commit, the driver's
+# 5 second busy timeout, no retries, a new connection per request
+UNTUNED = {
+    'SQLITE_PRAGMAS': {'journal_mode': 'delete', 'synchronous': 'full', 'busy_timeout': 5000},
+    'LOCK_RETRIES': 0,
+}
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure write throughput with concurrent writers (a send and a router accept each), '
+        'untuned against the DATABASE_TUNING profile with persistent connections'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent writers')
+        parser.add_argument('--writes', type=int, default=100, help='Messages sent and accepted per writer')
+
+    def handle(self, *args, **options):
+        users = list(User.objects.order_by('id')[:2])
+        if len(users) < 2:
+            raise CommandError('Need at least two users to send messages between; create them first')
+        if connections['default'].vendor != 'sqlite':
+            self.stdout.write('Not SQLite: the PRAGMAs do not apply, only connection reuse and retries differ')
+
+        self.stdout.write(f'{options["threads"]} writers x {options["writes"]} messages, each a send and an accept')
+        self.stdout.write(
+            f'{"profile":<8} {"journal":<8} {"writes/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"errors":>7}'
+        )
+        try:
+            for profile, tuning, reuse in (('untuned', UNTUNED, False), ('tuned', database_settings(), True)):
+                with override_settings(DATABASE_TUNING=tuning):
+                    # Reconnect so the profile's PRAGMAs switch the journal mode
+                    connections.close_all()
+                    journal = self.journal_mode()
+                    self.report(profile, journal, self.run(users, options, reuse))
+        finally:
+            connections.close_all()
+            deleted = sum(
+                Message.objects.using(alias).filter(subject=MARKER).delete()[1].get('app.Message', 0)
+                for alias in message_aliases()
+            )
+            self.stdout.write(f'Removed {deleted} benchmark messages')
+
+    def journal_mode(self):
+        connection = connections['default']
+        if connection.vendor != 'sqlite':
+            return '-'
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            return cursor.fetchone()[0]
+
+    def run(self, users, options, reuse):
+        sender, receiver = users
+        start = threading.Barrier(options['threads'])
+
+        def writer(_):
+            latencies, errors = [], 0
+            start.wait()
+            for _ in range(options['writes']):
+                started = time.perf_counter()
+                try:
+                    message = Message(sender=sender, receiver=receiver, subject=MARKER, encrypted_content=MARKER, status='SENT')
+                    message.save()
+                    transition_messages(
+                        message._state.db, [message.id], 'SENT', 'ROUTER_ACCEPTED', 'ACCEPT', actor=sender, notes=MARKER,
+                    )
+                    latencies.append(time.perf_counter() - started)
+                except OperationalError:
+                    errors += 1
+                if not reuse:
+                    connections.close_all()
+            connections.close_all()
+            return latencies, errors
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            results = list(pool.map(writer, range(options['threads'])))
+        elapsed = time.perf_counter() - started
+        latencies = [latency for thread_latencies, _ in results for latency in thread_latencies]
+        return latencies, sum(errors for _, errors in results), elapsed
+
+    def report(self, profile, journal, result):
+        latencies, errors, elapsed = result
+        self.stdout.write(
+            f'{profile:<8} {journal:<8} {len(latencies) / elapsed:>9.0f} '
+            f'{_percentile(latencies, 0.5) * 1000:>8.1f} {_percentile(latencies, 0.95) * 1000:>8.1f} {errors:>7}'
+        )
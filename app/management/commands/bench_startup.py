@@ -0,0 +1,82 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+# Run in a fresh interpreter so nothing is already imported
+SETUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': len(sys.modules), 'cryptography': 'cryptography' in sys.modules}))
+'''
+
+
+def parse_importtime(output):
+    """[(module, self_us, cumulative_us), ...] from `python -X importtime` stderr"""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # The header line
+        rows.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure cold django.setup() time for one or more settings modules in fresh '
+        'interpreters, with a per-module import breakdown from -X importtime'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--settings-modules',
+            default=f'{settings.SETTINGS_MODULE},SecureMessenger.worker_settings',
+            help='Comma-separated settings modules to compare',
+        )
+        parser.add_argument('--runs', type=int, default=5, help='Cold starts timed per settings module')
+        parser.add_argument('--top', type=int, default=15, help='Slowest modules and packages to list')
+
+    def run_setup(self, settings_module, *flags):
+        environ = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings_module}
+        return subprocess.run(
+            [sys.executable, *flags, '-c', SETUP_SCRIPT],
+            cwd=settings.BASE_DIR, env=environ, capture_output=True, text=True, check=True,
+        )
+
+    def handle(self, *args, **options):
+        for settings_module in options['settings_modules'].split(','):
+            results = [json.loads(self.run_setup(settings_module).stdout) for _ in range(options['runs'])]
+            timings = [result['seconds'] * 1000 for result in results]
+            self.stdout.write(
+                f'{settings_module}: django.setup() median {statistics.median(timings):.1f} ms '
+                f'(min {min(timings):.1f}, max {max(timings):.1f}) over {len(timings)} runs, '
+                f'{results[0]["modules"]} modules loaded, '
+                f'cryptography {"imported" if results[0]["cryptography"] else "not imported"}'
+            )
+
+            rows = parse_importtime(self.run_setup(settings_module, '-X', 'importtime').stderr)
+            packages = defaultdict(int)
+            for module, self_us, _ in rows:
+                packages[module.split('.')[0]] += self_us
+            self.stdout.write(f'  import time {sum(row[1] for row in rows) / 1000:.1f} ms in {len(rows)} modules')
+
+            self.stdout.write(f'  {"package":<40} {"self ms":>9}')
+            for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+                self.stdout.write(f'  {package:<40} {self_us / 1000:>9.1f}')
+
+            self.stdout.write(f'  {"module":<40} {"self ms":>9} {"cumul ms":>9}')
+            for module, self_us, cumulative_us in sorted(rows, key=lambda row: -row[1])[:options['top']]:
+                self.stdout.write(f'  {module:<40} {self_us / 1000:>9.1f} {cumulative_us / 1000:>9.1f}')
+            self.stdout.write('')
@@ -0,0 +1,35 @@
+import base64
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import signatures
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate an Ed25519 Cloud Authority signing key as a PEM file for CA_SIGNING["PRIVATE_KEY_FILE"]. '
+        'When replacing a key, add the old public key to CA_SIGNING["TRUSTED_PUBLIC_KEYS"] so existing '
+        'certificates keep verifying.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Where to write the private key')
+        parser.add_argument('--force', action='store_true', help='Overwrite an existing file')
+
+    def handle(self, *args, **options):
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+        from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat
+
+        path = options['path']
+        if os.path.exists(path) and not options['force']:
+            raise CommandError(f'{path} exists; use --force to overwrite it')
+        key = Ed25519PrivateKey.generate()
+        pem = key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'wb') as key_file:
+            key_file.write(pem)
+
+        public = signatures.public_bytes(key)
+        self.stdout.write(f'Wrote {path} (key id {signatures.key_id(public)})')
+        self.stdout.write(f'Public key: {base64.b64encode(public).decode("ascii")}')
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.certificates import expire_certificates
+
+
+class Command(BaseCommand):
+    help = 'Record certificates whose valid_until has passed (range scan from the last sweep)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Keep running and sweep every INTERVAL seconds (0 runs once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = expire_certificates(batch_size=options['batch_size'])
+            self.stdout.write(f'Expired {expired} certificates')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.models import Message
+from app.query_plans import canonical_queries, explain, seed_messages
+from app.sharding import message_aliases
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Run EXPLAIN on the canonical queries behind each view and background job (see app/query_plans.py) '
+        'and flag full scans and temporary sorts'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', help='Message database to explain against (default: the first message database)',
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='First insert this many synthetic messages (and ANALYZE), all rolled back afterwards',
+        )
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every plan, not only flagged ones')
+        parser.add_argument('--strict', action='store_true', help='Exit with an error when anything is flagged')
+
+    def handle(self, *args, **options):
+        alias = options['database'] or message_aliases()[0]
+        flagged = 0
+        try:
+            with transaction.atomic(), transaction.atomic(using=alias or 'default'):
+                if options['seed']:
+                    user, message = seed_messages(alias, options['seed'])
+                    self.stdout.write(f'Seeded {options["seed"]} messages (rolled back afterwards)')
+                else:
+                    message = Message.objects.using(alias).order_by('-id').first()
+                    if message is None:
+                        raise CommandError('No messages to explain against; pass --seed')
+                    user = message.receiver
+                flagged = self.report(canonical_queries(alias, user.id, message.id, message.conversation_id), options)
+                raise Rollback
+        except Rollback:
+            pass
+        if flagged and options['strict']:
+            raise CommandError(f'{flagged} queries scan or sort')
+
+    def report(self, queries, options):
+        flagged = 0
+        for view, description, queryset in queries:
+            plan, issues = explain(queryset)
+            if issues:
+                flagged += 1
+                self.stdout.write(self.style.WARNING(
+                    f'{view} ({description}): ' + ', '.join(problem for _, problem in issues)
+                ))
+            else:
+                self.stdout.write(f'{view} ({description}): ok')
+            if issues or options['verbose_plans']:
+                for line in plan.splitlines():
+                    self.stdout.write(f'    {line}')
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{len(queries)} queries, {flagged} flagged'))
+        return flagged
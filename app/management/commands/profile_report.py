@@ -0,0 +1,64 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from app.profiling import issue_profile_token, profiler_settings
+
+
+class Command(BaseCommand):
+    help = 'Aggregate request profiler reports into the hottest functions and queries per view'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Report directory (defaults to REQUEST_PROFILER["DIR"])')
+        parser.add_argument('--view', help='Only report on this view name')
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument(
+            '--issue-token',
+            action='store_true',
+            help='Print a signed header value that forces profiling of a request',
+        )
+
+    def handle(self, *args, **options):
+        config = profiler_settings()
+        if options['issue_token']:
+            self.stdout.write(f'{config["HEADER"]}: {issue_profile_token()}')
+            return
+
+        directory = Path(options['dir'] or config['DIR'])
+        views = {}
+        for path in directory.glob('*.json'):
+            with open(path) as handle:
+                summary = json.load(handle)
+            if options['view'] and summary['view'] != options['view']:
+                continue
+            view = views.setdefault(summary['view'], {
+                'requests': 0, 'total': 0.0, 'sql': 0.0, 'functions': {}, 'queries': {},
+            })
+            view['requests'] += 1
+            view['total'] += summary['total_seconds']
+            view['sql'] += summary['sql_seconds']
+            for row in summary['functions']:
+                view['functions'][row['function']] = view['functions'].get(row['function'], 0.0) + row['cumulative_seconds']
+            for row in summary['queries']:
+                calls, seconds = view['queries'].get(row['sql'], (0, 0.0))
+                view['queries'][row['sql']] = (calls + row['calls'], seconds + row['seconds'])
+
+        if not views:
+            self.stdout.write(f'No profiler reports found in {directory}')
+            return
+
+        limit = options['limit']
+        for name, view in sorted(views.items(), key=lambda item: item[1]['total'], reverse=True):
+            requests = view['requests']
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{name}: {requests} requests, '
+                f'avg {view["total"] / requests * 1000:.1f} ms '
+                f'(SQL {view["sql"] / requests * 1000:.1f} ms)'
+            ))
+            self.stdout.write('  Hottest functions (cumulative seconds):')
+            for function, seconds in sorted(view['functions'].items(), key=lambda item: item[1], reverse=True)[:limit]:
+                self.stdout.write(f'    {seconds:10.4f}  {function}')
+            self.stdout.write('  Hottest queries (calls, seconds):')
+            for sql, (calls, seconds) in sorted(view['queries'].items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+                self.stdout.write(f'    {calls:6d} {seconds:10.4f}  {sql[:160]}')
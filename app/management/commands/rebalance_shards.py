@@ -0,0 +1,82 @@
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.changes import next_change
+from app.models import Certificate, Message, MessageLog
+from app.sharding import mirror_users, shard_aliases, shard_for_receiver
+
+
+class Command(BaseCommand):
+    help = (
+        'Move messages (with their logs and certificates) onto the shard their receiver '
+        'hashes to under the current MESSAGE_SHARDS, e.g. after adding a shard. '
+        'Run refresh_lifecycle_stats first so moved log entries are not counted twice.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would move')
+
+    def handle(self, *args, **options):
+        aliases = shard_aliases()
+        if not aliases:
+            raise CommandError('Sharding is not enabled (set SECUREMESSENGER_SHARDS).')
+
+        if not options['dry_run']:
+            # New shards need every user before messages can reference them
+            mirror_users(list(User.objects.using('default')))
+
+        moved = defaultdict(int)
+        for source in aliases:
+            last_id = 0
+            while True:
+                batch = list(
+                    Message.objects.using(source).filter(id__gt=last_id)
+                    .order_by('id').values_list('id', 'receiver_id')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                targets = defaultdict(list)
+                for message_id, receiver_id in batch:
+                    target = shard_for_receiver(receiver_id, aliases)
+                    if target != source:
+                        targets[target].append(message_id)
+
+                for target, ids in targets.items():
+                    moved[(source, target)] += len(ids)
+                    if not options['dry_run']:
+                        self.move(source, target, ids)
+
+        for (source, target), count in sorted(moved.items()):
+            verb = 'Would move' if options['dry_run'] else 'Moved'
+            self.stdout.write(f'{verb} {count} messages {source} -> {target}')
+        if not moved:
+            self.stdout.write('All messages are already on their shard.')
+
+    def move(self, source, target, ids):
+        """Copy rows to `target` keeping their ids, then delete them from `source`
+
+        Ids already on `target` were copied by a run interrupted before its
+        delete; that copy is the one being read and written now, so it is
+        kept and only the source rows are deleted.
+        """
+        with transaction.atomic(using=target):
+            copied = set(Message.objects.using(target).filter(id__in=ids).values_list('id', flat=True))
+            fresh = [message_id for message_id in ids if message_id not in copied]
+            rows = [
+                *Message.objects.using(source).filter(id__in=fresh),
+                *MessageLog.objects.using(source).filter(message_id__in=fresh),
+                *Certificate.objects.using(source).filter(message_id__in=fresh),
+            ]
+            for row in rows:
+                # raw=True keeps auto_now timestamps as they are, like loaddata
+                row.save_base(using=target, raw=True, force_insert=True)
+            # New to this shard's change sequence, so syncing clients pick them up here
+            Message.objects.using(target).filter(id__in=fresh).update(change_seq=next_change(target))
+        with transaction.atomic(using=source):
+            Message.objects.using(source).filter(id__in=ids).delete()
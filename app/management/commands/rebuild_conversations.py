@@ -0,0 +1,69 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from app.conversations import conversation_for
+from app.models import Conversation, ConversationMember, Message
+from app.sharding import message_aliases, shard_for_receiver
+
+
+class Command(BaseCommand):
+    help = (
+        'Attach messages sent before conversations existed to their conversation, then '
+        'recompute every touched conversation\'s message count and latest-message pointer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--recount-all', action='store_true',
+            help='Recompute every conversation, not only those that gained messages',
+        )
+
+    def handle(self, *args, **options):
+        touched = set()
+        attached = 0
+        for alias in message_aliases():
+            messages = Message.objects.using(alias)
+            after = 0
+            while True:
+                rows = list(
+                    messages.filter(id__gt=after, conversation_id=None).order_by('id')
+                    .values_list('id', 'sender_id', 'receiver_id')[:options['batch_size']]
+                )
+                if not rows:
+                    break
+                by_conversation = defaultdict(list)
+                for message_id, sender_id, receiver_id in rows:
+                    by_conversation[conversation_for(sender_id, receiver_id).id].append(message_id)
+                for conversation_id, ids in by_conversation.items():
+                    messages.filter(id__in=ids).update(conversation_id=conversation_id)
+                touched.update(by_conversation)
+                attached += len(rows)
+                after = rows[-1][0]
+        self.stdout.write(f'Attached {attached} messages to {len(touched)} conversations')
+
+        conversations = Conversation.objects.all()
+        if not options['recount_all']:
+            conversations = conversations.filter(id__in=touched)
+        recounted = 0
+        for conversation in conversations.iterator():
+            self.recount(conversation)
+            recounted += 1
+        self.stdout.write(f'Recounted {recounted} conversations')
+
+    def recount(self, conversation):
+        """Message count and latest message from the (at most two) shards holding the thread"""
+        count, latest = 0, None
+        for alias in dict.fromkeys([shard_for_receiver(conversation.user_a_id), shard_for_receiver(conversation.user_b_id)]):
+            thread = Message.objects.using(alias).filter(conversation_id=conversation.id)
+            count += thread.count()
+            last = thread.order_by('-timestamp', '-id').values_list('timestamp', 'id').first()
+            if last is not None and (latest is None or last > latest):
+                latest = last
+        if latest is None:
+            latest = (conversation.last_activity, None)
+        Conversation.objects.filter(id=conversation.id).update(
+            message_count=count, last_activity=latest[0], last_message_id=latest[1],
+        )
+        ConversationMember.objects.filter(conversation_id=conversation.id).update(last_activity=latest[0])
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.analytics import refresh_lifecycle_stats
+
+
+class Command(BaseCommand):
+    help = 'Fold new MessageLog entries into the hourly lifecycle analytics table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--settle', type=float, default=60,
+            help='Leave entries younger than this many seconds (their transactions may still be committing) '
+                 'for the next run',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Keep running and refresh every INTERVAL seconds (0 runs once)',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = refresh_lifecycle_stats(batch_size=options['batch_size'], settle=options['settle'])
+            self.stdout.write(f'Processed {processed} log entries')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
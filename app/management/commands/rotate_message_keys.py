@@ -0,0 +1,118 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.certificates import resign_certificates
+from app.ciphers import CIPHER_BACKENDS
+from app.key_rotation import rotate_chunk
+from app.models import Checkpoint, Message
+from app.sharding import message_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt every message under a new key and cipher backend. Rows are streamed in '
+        'id-ranged chunks, re-encrypted across a process pool and written back with bulk_update; '
+        'progress is checkpointed so an interrupted run resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument(
+            '--cipher',
+            choices=sorted(CIPHER_BACKENDS),
+            help='Target backend (defaults to MESSAGE_CIPHER_BACKEND)',
+        )
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read and written per chunk')
+        parser.add_argument(
+            '--max-rows-per-second',
+            type=float,
+            default=0,
+            help='Throttle to leave capacity for live traffic (0 = unlimited)',
+        )
+        parser.add_argument('--run', default='default', help='Name of the rotation run (its checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved checkpoint and start over')
+
+    def handle(self, *args, **options):
+        self.workers = max(options['workers'], 1)
+        backend_name = options['cipher'] or getattr(settings, 'MESSAGE_CIPHER_BACKEND', 'fernet')
+        if backend_name not in CIPHER_BACKENDS:
+            raise CommandError(f'Unknown cipher backend {backend_name!r}')
+        self.rotate = partial(rotate_chunk, backend_name=backend_name)
+        self.per_worker = defaultdict(lambda: [0, 0.0])  # pid -> [rows, busy seconds]
+        self.failed = []
+        self.resigned = 0
+        started = time.perf_counter()
+        total = 0
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for alias in message_aliases():
+                name = f'key_rotation:{options["run"]}:{alias or "default"}'
+                checkpoint, _ = Checkpoint.objects.get_or_create(name=name)
+                if options['restart']:
+                    checkpoint.position = 0
+                    checkpoint.save(update_fields=['position', 'updated_at'])
+                if checkpoint.position:
+                    self.stdout.write(f'{alias or "default"}: resuming after message {checkpoint.position}')
+                total += self.rotate_alias(pool, alias, checkpoint, options, started, total)
+
+        self.report(total, time.perf_counter() - started)
+
+    def rotate_alias(self, pool, alias, checkpoint, options, started, done_before):
+        done = 0
+        while True:
+            rows = list(
+                Message.objects.using(alias)
+                .filter(id__gt=checkpoint.position)
+                .exclude(encryption_key='')
+                .order_by('id')
+                .values_list('id', 'encryption_key', 'encrypted_content')[:options['chunk_size']]
+            )
+            if not rows:
+                return done
+
+            slice_size = -(-len(rows) // self.workers)
+            slices = [rows[index:index + slice_size] for index in range(0, len(rows), slice_size)]
+            updates = []
+            for pid, busy, rotated, failed in pool.map(self.rotate, slices):
+                self.per_worker[pid][0] += len(rotated)
+                self.per_worker[pid][1] += busy
+                self.failed.extend(failed)
+                updates.extend(
+                    Message(id=message_id, encryption_key=key, encrypted_content=ciphertext)
+                    for message_id, key, ciphertext in rotated
+                )
+
+            with transaction.atomic(using=alias):
+                Message.objects.using(alias).bulk_update(updates, ['encryption_key', 'encrypted_content'])
+                # Certificates sign the ciphertext, so certified messages are signed again
+                self.resigned += resign_certificates(alias, [update.id for update in updates])
+            # Re-running a chunk is harmless, so the checkpoint follows the write
+            checkpoint.position = rows[-1][0]
+            checkpoint.save(update_fields=['position', 'updated_at'])
+            done += len(rows)
+
+            if options['max_rows_per_second']:
+                ahead = (done_before + done) / options['max_rows_per_second'] - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def report(self, total, elapsed):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'Re-encrypted {total - len(self.failed)} of {total} messages in {elapsed:.1f}s '
+            f'({total / elapsed if elapsed else 0:.0f} rows/s overall), {self.resigned} certificates re-signed'
+        ))
+        for pid, (rows, busy) in sorted(self.per_worker.items()):
+            rate = rows / busy if busy else 0
+            self.stdout.write(f'  worker {pid}: {rows} rows, {busy:.2f}s busy, {rate:.0f} rows/s')
+        if self.failed:
+            self.stdout.write(self.style.WARNING(
+                f'{len(self.failed)} messages could not be decrypted and were left unchanged: '
+                + ', '.join(str(message_id) for message_id in self.failed[:50])
+            ))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.routing import route_pending_messages
+
+
+class Command(BaseCommand):
+    help = 'Auto-accept or auto-reject SENT messages that match an enabled routing rule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Keep running and route new messages every INTERVAL seconds (0 runs once)',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Report decisions without applying them')
+
+    def handle(self, *args, **options):
+        while True:
+            totals = route_pending_messages(batch_size=options['batch_size'], dry_run=options['dry_run'])
+            verb = 'Would route' if options['dry_run'] else 'Routed'
+            self.stdout.write(f'{verb} {sum(totals.values())} messages')
+            for (rule_id, action), count in sorted(totals.items()):
+                self.stdout.write(f'  rule #{rule_id} {action}: {count}')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,49 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from app.models import Checkpoint
+from app.replicas import HEARTBEAT_NAME, replica_configured, replica_settings
+
+
+class Command(BaseCommand):
+    help = (
+        'Stand-in replication for local development: write a heartbeat on the primary '
+        'and copy the SQLite primary onto the SQLite replica file'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0,
+            help='Keep replicating every INTERVAL seconds (0 runs once)',
+        )
+
+    def handle(self, *args, **options):
+        if not replica_configured():
+            raise CommandError('No replica database is configured (set SECUREMESSENGER_REPLICA_DB).')
+        alias = replica_settings()['ALIAS']
+        primary, replica = connections['default'], connections[alias]
+        if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('sync_replica only copies SQLite files; use native replication elsewhere.')
+
+        while True:
+            checkpoint, _ = Checkpoint.objects.using('default').get_or_create(name=HEARTBEAT_NAME)
+            checkpoint.position = int(time.time())
+            checkpoint.save(using='default', update_fields=['position', 'updated_at'])
+
+            primary.ensure_connection()
+            target = sqlite3.connect(str(replica.settings_dict['NAME']))
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            replica.close()
+            self.stdout.write(f'Replicated to {alias}')
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,162 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.utils import timezone
+
+from app.audit import root_hasher, verify_chains
+from app.models import AuditCheckpoint, MessageLog
+from app.sharding import message_aliases
+
+
+ROW_FIELDS = (
+    'id', 'previous_hash', 'entry_hash', 'message_id', 'actor_id', 'log_type', 'notes', 'rule_id', 'timestamp',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Verify the hash-chained message history (see app/audit.py) from the last signed '
+        'checkpoint of each database forward, in parallel across message chains, and record '
+        'a new checkpoint when everything checks out'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch-size', type=int, default=5000, help='Log entries read per batch')
+        parser.add_argument(
+            '--settle', type=float, default=60,
+            help='Leave entries younger than this many seconds (their transactions may still be committing) '
+                 'for the next run',
+        )
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Re-verify every chain from its first entry and recompute every checkpoint root',
+        )
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Discard the existing checkpoints first (e.g. after rebalance_shards moved history)',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help='Seconds between runs (0 runs once); the first run that finds a problem exits with an error',
+        )
+
+    def handle(self, *args, **options):
+        self.workers = max(options['workers'], 1)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        try:
+            while True:
+                problems = sum(self.verify(alias, options) for alias in message_aliases())
+                if problems:
+                    # Also ends an --interval run, so whatever supervises it sees the failure
+                    raise CommandError(f'{problems} problems found in the message history')
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+    def verify(self, alias, options):
+        """Verify one database; returns the number of problems found"""
+        started = time.perf_counter()
+        database = alias or 'default'
+        if options['reset']:
+            AuditCheckpoint.objects.filter(database=database).delete()
+        checkpoints = list(AuditCheckpoint.objects.filter(database=database))
+        problems = [
+            (checkpoint.last_log_id, f'checkpoint #{checkpoint.id} has an invalid signature')
+            for checkpoint in checkpoints if not checkpoint.signature_valid()
+        ]
+        if problems:
+            return self.report(database, problems)
+
+        start = None if options['full'] or not checkpoints else checkpoints[-1]
+        boundaries = list(checkpoints) if options['full'] else []
+        start_position = position = start.last_log_id if start else 0
+        entries = start.entries if start else 0
+        hasher = root_hasher(start.root_hash if start else '')
+        cutoff = timezone.now() - timedelta(seconds=options['settle'])
+        logs = MessageLog.objects.using(alias)
+        heads = {}  # Latest entry_hash per message verified in this run
+
+        while True:
+            rows = list(logs.filter(id__gt=position).order_by('id').values_list(*ROW_FIELDS)[:options['batch_size']])
+            complete = len(rows) < options['batch_size']
+            unsettled = next((index for index, row in enumerate(rows) if row[-1] > cutoff), None)
+            if unsettled is not None:
+                # Stop at the first unsettled entry so no id is ever skipped
+                rows, complete = rows[:unsettled], True
+            if not rows:
+                break
+
+            unseen = {row[3] for row in rows} - heads.keys()
+            if unseen and start_position:
+                heads.update(self.anchors(logs, unseen, start_position))
+            chains = defaultdict(list)
+            for row in rows:
+                chains[row[3]].append(row)
+            segments = [(heads.get(message_id, ''), chain) for message_id, chain in chains.items()]
+            problems += self.verify_segments(segments)
+            heads.update((message_id, chain[-1][2]) for message_id, chain in chains.items())
+
+            for row in rows:
+                while boundaries and row[0] > boundaries[0].last_log_id:
+                    hasher, entries = self.close(boundaries.pop(0), hasher, entries, problems)
+                hasher.update(row[2].encode('ascii'))
+                entries += 1
+            position = rows[-1][0]
+            if complete:
+                break
+
+        while boundaries:
+            hasher, entries = self.close(boundaries.pop(0), hasher, entries, problems)
+        if problems:
+            return self.report(database, problems)
+
+        verified = entries - (start.entries if start else 0)
+        summary = f'{database}: verified {verified} entries in {time.perf_counter() - started:.2f}s'
+        if position > (checkpoints[-1].last_log_id if checkpoints else 0):
+            checkpoint = AuditCheckpoint(
+                database=database, last_log_id=position, entries=entries, root_hash=hasher.hexdigest(),
+            )
+            checkpoint.sign()
+            checkpoint.save()
+            summary += f', checkpoint #{checkpoint.id} at log {position}'
+        self.stdout.write(summary)
+        return 0
+
+    def anchors(self, logs, message_ids, position):
+        """entry_hash of each message's latest entry at or before `position`"""
+        latest = (
+            logs.filter(message_id__in=message_ids, id__lte=position)
+            .order_by().values('message_id').annotate(latest_id=Max('id')).values('latest_id')
+        )
+        return dict(logs.filter(id__in=latest).values_list('message_id', 'entry_hash'))
+
+    def verify_segments(self, segments):
+        if self.pool is None or len(segments) < self.workers:
+            return verify_chains(segments)
+        size = -(-len(segments) // self.workers)
+        slices = [segments[index:index + size] for index in range(0, len(segments), size)]
+        return [problem for result in self.pool.map(verify_chains, slices) for problem in result]
+
+    def close(self, checkpoint, hasher, entries, problems):
+        """Compare a checkpoint with the history recomputed up to it; continue from the checkpoint"""
+        if hasher.hexdigest() != checkpoint.root_hash or entries != checkpoint.entries:
+            problems.append((
+                checkpoint.last_log_id,
+                f'history covered by checkpoint #{checkpoint.id} was edited, deleted or moved',
+            ))
+        return root_hasher(checkpoint.root_hash), checkpoint.entries
+
+    def report(self, database, problems):
+        self.stderr.write(self.style.ERROR(f'{database}: {len(problems)} problems'))
+        for log_id, problem in problems[:50]:
+            self.stderr.write(f'  log {log_id}: {problem}')
+        return len(problems)
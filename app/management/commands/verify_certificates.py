@@ -0,0 +1,69 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import signatures
+from app.certificates import public_keys
+from app.models import Certificate
+from app.sharding import message_aliases
+
+
+ROW_FIELDS = ('message_id', 'message__sender_id', 'message__receiver_id', 'message__encrypted_content', 'certificate_data')
+
+
+class Command(BaseCommand):
+    help = (
+        'Check the CA signature of every certificate (see app/signatures.py) against the CA public keys, '
+        'in parallel across a process pool'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--batch-size', type=int, default=5000, help='Certificates read per batch')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        verify = partial(signatures.verify_batch, public_keys())
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        started = time.perf_counter()
+        counts = Counter()
+        failed = []
+        try:
+            for alias in message_aliases():
+                after = 0
+                while True:
+                    rows = list(
+                        Certificate.objects.using(alias).filter(message_id__gt=after)
+                        .order_by('message_id').values_list(*ROW_FIELDS)[:options['batch_size']]
+                    )
+                    if not rows:
+                        break
+                    if pool is None:
+                        results = verify(rows)
+                    else:
+                        size = -(-len(rows) // workers)
+                        slices = [rows[index:index + size] for index in range(0, len(rows), size)]
+                        results = [result for chunk in pool.map(verify, slices) for result in chunk]
+                    for message_id, status in results:
+                        counts[status] += 1
+                        if status in (signatures.INVALID, signatures.UNKNOWN_KEY):
+                            failed.append((message_id, status))
+                    after = rows[-1][0]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        self.stdout.write(
+            f'Checked {total} certificates in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f}/s): '
+            + ', '.join(f'{counts[status]} {status}' for status in sorted(counts))
+        )
+        if failed:
+            for message_id, status in failed[:50]:
+                self.stderr.write(f'  message {message_id}: {status}')
+            raise CommandError(f'{len(failed)} certificates failed verification')
@@ -0,0 +1,95 @@
+import signal
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from app.jobs import job_settings, retry_dead_jobs, work, worker_name
+
+
+class Command(BaseCommand):
+    help = (
+        'Run background jobs from the database queue. With --processes N the command '
+        'supervises N single-process workers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, help='Jobs claimed at a time (defaults to JOB_QUEUE)')
+        parser.add_argument('--poll-interval', type=float, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due instead of polling')
+        parser.add_argument('--retry-dead', action='store_true', help='Requeue dead-lettered jobs and exit')
+        parser.add_argument('--kind', help='With --retry-dead, only requeue jobs of this kind')
+
+    def handle(self, *args, **options):
+        if options['retry_dead']:
+            self.stdout.write(f'Requeued {retry_dead_jobs(options["kind"])} dead jobs')
+            return
+        if options['processes'] > 1:
+            return self.supervise(options)
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        name = worker_name()
+        poll_interval = options['poll_interval'] or job_settings()['POLL_INTERVAL']
+        self.stdout.write(f'Worker {name} started')
+        try:
+            while not self.stopping:
+                try:
+                    succeeded, failed = work(name, options['batch_size'], should_stop=lambda: self.stopping)
+                except DatabaseError as exc:
+                    # Typically a locked SQLite database; the claimed jobs' leases will expire.
+                    # A burst run is expected to finish, so it fails instead of retrying forever.
+                    if options['burst']:
+                        raise CommandError(f'{name}: {exc}') from exc
+                    self.stderr.write(f'{name}: {exc}')
+                    time.sleep(poll_interval)
+                    continue
+                if succeeded or failed:
+                    self.stdout.write(f'{name}: {succeeded} jobs done, {failed} failed')
+                elif options['burst']:
+                    break
+                else:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f'Worker {name} stopped')
+
+    def stop(self, signum, frame):
+        # Finish the job in hand, then exit
+        self.stopping = True
+
+    def supervise(self, options):
+        command = [sys.executable, '-m', 'django', 'worker', '--settings', settings.SETTINGS_MODULE]
+        for option in ('batch_size', 'poll_interval'):
+            if options[option] is not None:
+                command += [f'--{option.replace("_", "-")}', str(options[option])]
+        if options['burst']:
+            command.append('--burst')
+
+        children = [subprocess.Popen(command, cwd=settings.BASE_DIR) for _ in range(options['processes'])]
+
+        def forward(signum, frame):
+            # Each child finishes the job in hand, then exits
+            for child in children:
+                if child.poll() is None:
+                    child.terminate()
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        try:
+            for child in children:
+                child.wait()
+        finally:
+            # Only left early on an error: never leave orphaned workers behind
+            for child in children:
+                if child.poll() is None:
+                    child.terminate()
+            for child in children:
+                child.wait()
+        failed = [str(child.pid) for child in children if child.returncode]
+        if failed:
+            raise CommandError(f'Workers {", ".join(failed)} exited with an error')
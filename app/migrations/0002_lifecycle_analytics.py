@@ -0,0 +1,45 @@
+# Generated by Django 4.2.5 on 2026-10-19 06:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LifecycleStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('log_type', models.CharField(choices=[('CREATE', 'Created'), ('SEND', 'Sent'), ('ACCEPT', 'Accepted by Router'), ('CERTIFICATE', 'Certificate Created'), ('DELIVER', 'Delivered'), ('REJECT', 'Rejected')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('latency_total', models.FloatField(default=0)),
+                ('latency_histogram', models.JSONField(default=list)),
+                ('actor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-bucket'],
+                'indexes': [models.Index(fields=['log_type', 'bucket'], name='app_lifecyc_log_typ_90d7b9_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='lifecyclestat',
+            constraint=models.UniqueConstraint(fields=('bucket', 'actor', 'log_type'), name='unique_lifecycle_stat'),
+        ),
+    ]
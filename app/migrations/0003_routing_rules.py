@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-19 06:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('app', '0002_lifecycle_analytics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='rule_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RoutingRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('action', models.CharField(choices=[('ACCEPT', 'Auto-accept'), ('REJECT', 'Auto-reject')], max_length=10)),
+                ('priority', models.PositiveIntegerField(default=100)),
+                ('enabled', models.BooleanField(default=True)),
+                ('sender_role', models.CharField(blank=True, choices=[('CA', 'Cloud Authority'), ('ROUTER', 'Router'), ('PUBLISHER', 'Publisher'), ('USER', 'User')], max_length=20)),
+                ('receiver_role', models.CharField(blank=True, choices=[('CA', 'Cloud Authority'), ('ROUTER', 'Router'), ('PUBLISHER', 'Publisher'), ('USER', 'User')], max_length=20)),
+                ('sender_organization', models.CharField(blank=True, max_length=255)),
+                ('receiver_organization', models.CharField(blank=True, max_length=255)),
+                ('min_size', models.PositiveIntegerField(blank=True, null=True)),
+                ('max_size', models.PositiveIntegerField(blank=True, null=True)),
+                ('min_age', models.DurationField(blank=True, null=True)),
+                ('max_age', models.DurationField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('receiver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['priority', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificate',
+            name='expired_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='lifecyclestat',
+            name='log_type',
+            field=models.CharField(choices=[('CREATE', 'Created'), ('SEND', 'Sent'), ('ACCEPT', 'Accepted by Router'), ('CERTIFICATE', 'Certificate Created'), ('DELIVER', 'Delivered'), ('REJECT', 'Rejected'), ('EXPIRE', 'Certificate Expired')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='log_type',
+            field=models.CharField(choices=[('CREATE', 'Created'), ('SEND', 'Sent'), ('ACCEPT', 'Accepted by Router'), ('CERTIFICATE', 'Certificate Created'), ('DELIVER', 'Delivered'), ('REJECT', 'Rejected'), ('EXPIRE', 'Certificate Expired')], max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['valid_until'], name='app_certifi_valid_u_d90551_idx'),
+        ),
+    ]
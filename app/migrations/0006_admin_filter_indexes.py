@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_certificate_expiry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userprofile',
+            name='role',
+            field=models.CharField(choices=[('CA', 'Cloud Authority'), ('ROUTER', 'Router'), ('PUBLISHER', 'Publisher'), ('USER', 'User')], db_index=True, default='USER', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['status'], name='app_message_status_3c6f6b_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_admin_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'updated_at'], name='app_message_receive_34198d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'updated_at'], name='app_message_sender__a8a0c3_idx'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:11
+
+import hashlib
+import json
+from datetime import timezone
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def entry_digest(previous_hash, message_id, actor_id, log_type, notes, rule_id, timestamp):
+    """app.audit.entry_digest as of this migration, frozen so later changes there cannot rewrite history"""
+    canonical = json.dumps(
+        [previous_hash, message_id, actor_id, log_type, notes, rule_id, timestamp.astimezone(timezone.utc).isoformat()],
+        separators=(',', ':'), ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def chain_existing_logs(apps, schema_editor):
+    """Hash-chain the history written before this migration, per message in id order"""
+    MessageLog = apps.get_model('app', 'MessageLog')
+    logs = MessageLog.objects.using(schema_editor.connection.alias)
+    heads, batch = {}, []
+    for log in logs.order_by('id').iterator(chunk_size=2000):
+        log.previous_hash = heads.get(log.message_id, '')
+        log.entry_hash = heads[log.message_id] = entry_digest(
+            log.previous_hash, log.message_id, log.actor_id, log.log_type, log.notes, log.rule_id, log.timestamp,
+        )
+        batch.append(log)
+        if len(batch) == 2000:
+            logs.bulk_update(batch, ['previous_hash', 'entry_hash'])
+            batch = []
+    logs.bulk_update(batch, ['previous_hash', 'entry_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_mailbox_validator_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='entry_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='previous_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.CreateModel(
+            name='AuditCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(max_length=100)),
+                ('last_log_id', models.BigIntegerField()),
+                ('entries', models.BigIntegerField()),
+                ('root_hash', models.CharField(max_length=64)),
+                ('signature', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['database', 'last_log_id'],
+                'indexes': [models.Index(fields=['database', 'last_log_id'], name='app_auditch_databas_463229_idx')],
+            },
+        ),
+        migrations.RunPython(chain_existing_logs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:18
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_read(apps, schema_editor):
+    """Messages sent before read tracking count as read, so every unread counter starts at zero"""
+    Message = apps.get_model('app', 'Message')
+    Message.objects.using(schema_editor.connection.alias).filter(read_at=None).update(read_at=F('timestamp'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_conversations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_existing_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_read_receipts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('DRAFT', 'Draft'), ('QUEUED', 'Queued for later'), ('SENT', 'Sent'), ('ROUTER_ACCEPTED', 'Router Accepted'), ('CERTIFICATE_CREATED', 'Certificate Created'), ('DELIVERED', 'Delivered'), ('REJECTED', 'Rejected')], default='DRAFT', max_length=20),
+        ),
+    ]
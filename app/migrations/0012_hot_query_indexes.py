@@ -0,0 +1,38 @@
+# Generated by Django 4.2.5 on 2026-10-19 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_queued_status'),
+    ]
+
+    operations = [
+        # Superseded by the partial queue indexes below
+        migrations.RemoveIndex(
+            model_name='message',
+            name='app_message_status_3c6f6b_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', '-timestamp'], name='message_receiver_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', '-timestamp'], name='message_sender_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('status', 'SENT')), fields=['-timestamp'], name='message_sent_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('status', 'ROUTER_ACCEPTED')), fields=['-timestamp'], name='message_accepted_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(fields=['message', '-timestamp'], name='messagelog_message_recent_idx'),
+        ),
+    ]
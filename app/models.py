@@ -1,8 +1,19 @@
-from django.db import models
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import F, Max
 from django.contrib.auth.models import User
-from cryptography.fernet import Fernet
+from django.core.signing import Signer
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 import json
 
+from .audit import entry_digest
+from .ciphers import backend_for_token, get_backend
+from .database import retry_on_lock
+
+
+CHANGE_COUNTER = 'message_changes'
+
 
 class UserRole(models.TextChoices):
     """User role choices"""
@@ -18,9 +29,13 @@ class UserProfile(models.Model):
     role = models.CharField(
         max_length=20,
         choices=UserRole.choices,
-        default=UserRole.USER
+        default=UserRole.USER,
+        db_index=True
     )
     organization = models.CharField(max_length=255, blank=True)
+    # Received messages not yet opened; kept in step by app.conversations
+    # (on send) and app.receipts (on read), never counted
+    unread_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -35,6 +50,7 @@ class Message(models.Model):
     """Secure message model"""
     MESSAGE_STATUS = [
         ('DRAFT', 'Draft'),
+        ('QUEUED', 'Queued for later'),  # Held back by admission control (app/admission.py)
         ('SENT', 'Sent'),
         ('ROUTER_ACCEPTED', 'Router Accepted'),
         ('CERTIFICATE_CREATED', 'Certificate Created'),
@@ -46,9 +62,15 @@ class Message(models.Model):
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     subject = models.CharField(max_length=255)
     encrypted_content = models.TextField()  # Encrypted message content
-    encryption_key = models.TextField(blank=True)  # Fernet key (base64 encoded)
+    encryption_key = models.TextField(blank=True)  # Cipher key (base64 encoded)
     status = models.CharField(max_length=20, choices=MESSAGE_STATUS, default='DRAFT')
     certificate = models.TextField(blank=True, null=True)  # CA signature
+    # Conversation the message belongs to; a plain id because conversations
+    # live on the default database while messages may live on a shard
+    conversation_id = models.BigIntegerField(null=True, blank=True)
+    read_at = models.DateTimeField(null=True, blank=True)  # When the receiver first opened it
+    # Delta sync position: the database's change counter at the last write (see app/changes.py)
+    change_seq = models.BigIntegerField(default=0, editable=False)
     timestamp = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -57,27 +79,54 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['sender', 'status']),
             models.Index(fields=['receiver', 'status']),
+            # Conditional GET validators: max(updated_at) and count per mailbox
+            models.Index(fields=['receiver', 'updated_at']),
+            models.Index(fields=['sender', 'updated_at']),
+            # Keyset-paginated conversation threads
+            models.Index(fields=['conversation_id', '-timestamp', '-id']),
+            # Inbox and outbox pages, newest first (see app/query_plans.py)
+            models.Index(fields=['receiver', '-timestamp'], name='message_receiver_recent_idx'),
+            models.Index(fields=['sender', '-timestamp'], name='message_sender_recent_idx'),
+            # Router and CA queues: small partial indexes over the pending statuses only.
+            # One per status, since SQLite can use a partial index for `status = ?` but
+            # not for a bound `status IN (?, ?)`
+            models.Index(
+                fields=['-timestamp'], condition=models.Q(status='SENT'), name='message_sent_queue_idx',
+            ),
+            models.Index(
+                fields=['-timestamp'], condition=models.Q(status='ROUTER_ACCEPTED'), name='message_accepted_queue_idx',
+            ),
+            # Delta sync: a user's changes since a position
+            models.Index(fields=['receiver', 'change_seq', 'id'], name='message_receiver_changes_idx'),
+            models.Index(fields=['sender', 'change_seq', 'id'], name='message_sender_changes_idx'),
         ]
 
     def __str__(self):
         return f"Message from {self.sender} to {self.receiver}"
 
-    def encrypt_content(self, content):
-        """Encrypt message content"""
-        key = Fernet.generate_key()
-        cipher = Fernet(key)
-        encrypted = cipher.encrypt(content.encode('utf-8'))
-        self.encryption_key = key.decode('utf-8')
-        self.encrypted_content = encrypted.decode('utf-8')
+    @retry_on_lock
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(Message, instance=self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'change_seq'}
+        with transaction.atomic(using=using):
+            self.change_seq = Checkpoint.advance(using, CHANGE_COUNTER)
+            super().save(*args, **kwargs)
+
+    def encrypt_content(self, content, backend=None):
+        """Encrypt message content with a fresh key (MESSAGE_CIPHER_BACKEND by default)"""
+        cipher = get_backend(backend or getattr(settings, 'MESSAGE_CIPHER_BACKEND', 'fernet'))
+        key = cipher.generate_key()
+        self.encrypted_content = cipher.encrypt(key, content.encode('utf-8'))
+        self.encryption_key = key
 
     def decrypt_content(self):
-        """Decrypt message content"""
+        """Decrypt message content (the token's version byte selects the backend)"""
         try:
             if not self.encryption_key:
                 return None
-            cipher = Fernet(self.encryption_key.encode('utf-8'))
-            decrypted = cipher.decrypt(self.encrypted_content.encode('utf-8'))
-            return decrypted.decode('utf-8')
+            cipher = backend_for_token(self.encrypted_content)
+            return cipher.decrypt(self.encryption_key, self.encrypted_content).decode('utf-8')
         except Exception as e:
             return f"Error decrypting: {str(e)}"
 
@@ -91,20 +140,59 @@ class MessageLog(models.Model):
         ('CERTIFICATE', 'Certificate Created'),
         ('DELIVER', 'Delivered'),
         ('REJECT', 'Rejected'),
+        ('EXPIRE', 'Certificate Expired'),
     ]
 
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='logs')
     actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     log_type = models.CharField(max_length=20, choices=LOG_TYPE)
     notes = models.TextField(blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # RoutingRule behind an automated decision; a plain id because rules
+    # live on the default database while logs may live on a shard
+    rule_id = models.PositiveIntegerField(null=True, blank=True)
+    # Set before saving (not auto_now_add) because the entry hash covers it
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Hash chain per message (see app/audit.py)
+    previous_hash = models.CharField(max_length=64, blank=True, editable=False)
+    entry_hash = models.CharField(max_length=64, blank=True, editable=False)
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # A message's history in display order
+            models.Index(fields=['message', '-timestamp'], name='messagelog_message_recent_idx'),
+        ]
 
     def __str__(self):
         return f"{self.get_log_type_display()} - {self.message}"
 
+    def save(self, *args, **kwargs):
+        if not self.entry_hash:
+            MessageLog.chain(kwargs.get('using') or router.db_for_write(MessageLog, instance=self), [self])
+        super().save(*args, **kwargs)
+
+    def digest(self):
+        return entry_digest(
+            self.previous_hash, self.message_id, self.actor_id, self.log_type,
+            self.notes, self.rule_id, self.timestamp,
+        )
+
+    @classmethod
+    def chain(cls, using, logs):
+        """Link unsaved entries (in order) onto their messages' hash chains
+
+        Call this before bulk_create(); save() does it for single entries.
+        """
+        latest = (
+            cls.objects.using(using).filter(message_id__in={log.message_id for log in logs})
+            .order_by().values('message_id').annotate(latest_id=Max('id')).values('latest_id')
+        )
+        heads = dict(cls.objects.using(using).filter(id__in=latest).values_list('message_id', 'entry_hash'))
+        for log in logs:
+            log.previous_hash = heads.get(log.message_id, '')
+            log.entry_hash = log.digest()
+            heads[log.message_id] = log.entry_hash
+
 
 class Certificate(models.Model):
     """Digital certificate issued by CA"""
@@ -113,6 +201,207 @@ class Certificate(models.Model):
     certificate_data = models.TextField()  # Digital signature/certificate
     issued_date = models.DateTimeField(auto_now_add=True)
     valid_until = models.DateTimeField()
+    expired_at = models.DateTimeField(null=True, blank=True)  # Recorded by the expiry sweep
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['valid_until']),
+        ]
 
     def __str__(self):
         return f"Certificate for Message {self.message.id}"
+
+
+class Checkpoint(models.Model):
+    """High-water mark for incremental background jobs"""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
+
+    @classmethod
+    def advance(cls, using, name):
+        """Add one to a counter and return it; inside a transaction its row lock orders the writers
+
+        Message.save() calls this on every write, so where the database has
+        UPDATE ... RETURNING it is a single statement.
+        """
+        connection = connections[using]
+        if connection.vendor == 'postgresql' or (
+            connection.vendor == 'sqlite' and connection.features.can_return_columns_from_insert  # SQLite 3.35+
+        ):
+            table, position, key = map(connection.ops.quote_name, (cls._meta.db_table, 'position', 'name'))
+            with connection.cursor() as cursor:
+                cursor.execute(f'UPDATE {table} SET {position} = {position} + 1 WHERE {key} = %s RETURNING {position}', [name])
+                row = cursor.fetchone()
+            if row is not None:
+                return row[0]
+        checkpoints = cls.objects.using(using).filter(name=name)
+        if not checkpoints.update(position=F('position') + 1):
+            cls.objects.using(using).get_or_create(name=name)
+            checkpoints.update(position=F('position') + 1)
+        return checkpoints.values_list('position', flat=True).get()
+
+
+class LifecycleStat(models.Model):
+    """Hourly, per-actor rollup of message lifecycle transitions"""
+    bucket = models.DateTimeField()  # Start of the hour
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='+')
+    log_type = models.CharField(max_length=20, choices=MessageLog.LOG_TYPE)
+    count = models.PositiveIntegerField(default=0)
+    latency_total = models.FloatField(default=0)  # Seconds since the message was sent
+    latency_histogram = models.JSONField(default=list)  # Counts per analytics.LATENCY_BUCKETS
+
+    class Meta:
+        ordering = ['-bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'actor', 'log_type'], name='unique_lifecycle_stat'),
+        ]
+        indexes = [
+            models.Index(fields=['log_type', 'bucket']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_log_type_display()} x{self.count} ({self.bucket:%Y-%m-%d %H:00})"
+
+
+class RoutingRule(models.Model):
+    """Router-stage policy: auto-accept or auto-reject SENT messages that match
+
+    Empty conditions match anything; the enabled rule with the lowest
+    priority (then id) that matches a message decides it.
+    """
+    ACTIONS = [
+        ('ACCEPT', 'Auto-accept'),
+        ('REJECT', 'Auto-reject'),
+    ]
+
+    name = models.CharField(max_length=100)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    priority = models.PositiveIntegerField(default=100)  # Lower runs first
+    enabled = models.BooleanField(default=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    sender_role = models.CharField(max_length=20, choices=UserRole.choices, blank=True)
+    receiver_role = models.CharField(max_length=20, choices=UserRole.choices, blank=True)
+    sender_organization = models.CharField(max_length=255, blank=True)
+    receiver_organization = models.CharField(max_length=255, blank=True)
+    min_size = models.PositiveIntegerField(null=True, blank=True)  # Encrypted size in bytes
+    max_size = models.PositiveIntegerField(null=True, blank=True)
+    min_age = models.DurationField(null=True, blank=True)  # Time since the message was sent
+    max_age = models.DurationField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['priority', 'id']
+
+    def __str__(self):
+        return f"#{self.id} {self.name} ({self.get_action_display()})"
+
+
+class Job(models.Model):
+    """Background job in the database-backed queue (see app/jobs.py)"""
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DEAD = 'DEAD'
+    JOB_STATUS = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DEAD, 'Dead'),  # Out of attempts; kept for inspection and manual retry
+    ]
+
+    kind = models.CharField(max_length=100)  # Name of a handler registered with @job
+    payload = models.JSONField(default=dict)
+    priority = models.PositiveIntegerField(default=100)  # Lower runs first
+    status = models.CharField(max_length=10, choices=JOB_STATUS, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField()  # Not before; pushed back after each failure
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['priority', 'run_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'priority', 'run_at']),
+            models.Index(fields=['locked_by']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.id} ({self.get_status_display()})"
+
+
+class Conversation(models.Model):
+    """Message thread between two users, with denormalized activity (see app/conversations.py)"""
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')  # user_a_id <= user_b_id
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message_id = models.BigIntegerField(null=True, blank=True)  # Message may live on a shard
+    last_activity = models.DateTimeField(default=timezone.now)
+    message_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-last_activity']
+        constraints = [
+            models.UniqueConstraint(fields=['user_a', 'user_b'], name='unique_conversation_pair'),
+        ]
+
+    def __str__(self):
+        return f"Conversation #{self.id} ({self.message_count} messages)"
+
+
+class ConversationMember(models.Model):
+    """A participant's side of a conversation: their unread count and a copy of last_activity"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='members')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_memberships')
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')  # The other participant
+    unread_count = models.PositiveIntegerField(default=0)
+    # Copied from the conversation so a user's list is one index range scan
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-last_activity', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='unique_conversation_member'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_activity', '-id']),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in conversation #{self.conversation_id}"
+
+
+class AuditCheckpoint(models.Model):
+    """Signed record that a database's message history verified up to a log id"""
+    database = models.CharField(max_length=100)  # Alias holding the logs
+    last_log_id = models.BigIntegerField()
+    entries = models.BigIntegerField()  # Log entries covered, in total
+    root_hash = models.CharField(max_length=64)
+    signature = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['database', 'last_log_id']
+        indexes = [
+            models.Index(fields=['database', 'last_log_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.database} @ {self.last_log_id}"
+
+    def _expected_signature(self):
+        payload = f'{self.database}:{self.last_log_id}:{self.entries}:{self.root_hash}'
+        return Signer(salt='app.AuditCheckpoint').signature(payload)
+
+    def sign(self):
+        self.signature = self._expected_signature()
+
+    def signature_valid(self):
+        return constant_time_compare(self.signature, self._expected_signature())
@@ -0,0 +1,14 @@
+"""
+Parallel password hashing.
+
+hash_passwords() is the unit of work app.provisioning hands to its process
+pool. Hashers encode without reading settings, so it only needs the
+hasher's import path and worker processes never set Django up.
+"""
+from django.utils.module_loading import import_string
+
+
+def hash_passwords(hasher_path, passwords):
+    """Encoded hashes of `passwords`, each with a fresh salt"""
+    hasher = import_string(hasher_path)()
+    return [hasher.encode(password, hasher.salt()) for password in passwords]
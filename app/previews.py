@@ -0,0 +1,113 @@
+"""
+Decrypted message previews for the inbox and outbox.
+
+Every message on a page is decrypted in a shared thread pool (the ciphers
+release the GIL inside OpenSSL) and the page waits at most TIME_BUDGET
+seconds for the batch; anything unfinished or undecryptable is shown as
+"preview unavailable" instead of holding the page up. Bodies larger than
+FULL_DECRYPT_MAX_BYTES only have their first bytes decrypted (see
+CipherBackend.decrypt_prefix), which is unauthenticated and therefore only
+ever used for display.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .ciphers import DecryptionError, backend_for_token
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def preview_settings():
+    config = {
+        'ENABLED': False,
+        'CHARS': 80,
+        'TIME_BUDGET': 0.1,
+        'WORKERS': 4,
+        'FULL_DECRYPT_MAX_BYTES': 64 * 1024,
+    }
+    config.update(getattr(settings, 'MESSAGE_PREVIEWS', {}))
+    return config
+
+
+def _pool(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        return _executor
+
+
+def preview_text(key, token, chars=80, full_decrypt_max_bytes=64 * 1024):
+    """First `chars` characters of a message body, with an ellipsis if cut"""
+    backend = backend_for_token(token)
+    # Base64 tokens are 4/3 the size of the bytes they carry
+    truncated = len(token) * 3 // 4 > full_decrypt_max_bytes
+    if truncated:
+        # Up to 4 bytes per character; a split trailing character is dropped
+        plaintext = backend.decrypt_prefix(key, token, chars * 4)
+    else:
+        plaintext = backend.decrypt(key, token)
+    text = plaintext.decode('utf-8', errors='ignore')
+    if truncated or len(text) > chars:
+        return text[:chars].rstrip() + '…'
+    return text
+
+
+def _submit(messages, config):
+    """Queue a preview for every message; returns {future: message}"""
+    pending = {}
+    pool = _pool(config['WORKERS'])
+    for message in messages:
+        message.preview = None
+        if message.encryption_key and message.encrypted_content:
+            future = pool.submit(
+                preview_text,
+                message.encryption_key,
+                message.encrypted_content,
+                config['CHARS'],
+                config['FULL_DECRYPT_MAX_BYTES'],
+            )
+            pending[future] = message
+    return pending
+
+
+def _collect(pending, done, not_done):
+    for future in not_done:
+        future.cancel()
+    for future in done:
+        try:
+            pending[future].preview = future.result()
+        except (DecryptionError, ValueError):
+            pass
+
+
+def attach_previews(messages):
+    """Set ``message.preview`` on every message (None when unavailable)"""
+    config = preview_settings()
+    pending = _submit(messages, config)
+    done, not_done = wait(pending, timeout=config['TIME_BUDGET'])
+    _collect(pending, done, not_done)
+    return messages
+
+
+async def aattach_previews(messages):
+    """attach_previews() for async views: the event loop, not a thread, waits for the batch"""
+    config = preview_settings()
+    pending = {asyncio.wrap_future(future): message for future, message in _submit(messages, config).items()}
+    if pending:
+        done, not_done = await asyncio.wait(pending, timeout=config['TIME_BUDGET'])
+        _collect(pending, done, not_done)
+    return messages
+
+
+def previews_requested(request):
+    """Previews are on by default per MESSAGE_PREVIEWS, overridable with ?preview=0/1"""
+    requested = request.GET.get('preview')
+    if requested in ('0', '1'):
+        return requested == '1'
+    return preview_settings()['ENABLED']
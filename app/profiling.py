@@ -0,0 +1,230 @@
+"""
+Opt-in sampling request profiler.
+
+A configurable fraction of requests (or any request carrying a valid signed
+profiling header) runs under cProfile, with SQL time recorded separately
+through ``connection.execute_wrapper``. Each profiled request leaves a
+``.prof`` pstats dump and a ``.json`` summary in REQUEST_PROFILER['DIR'];
+the oldest reports are pruned once MAX_REPORTS is exceeded.
+
+The middleware runs natively in both sync and async stacks, so enabling it
+does not force async views through async_to_sync. cProfile hooks a whole
+thread, and every async request shares the event loop's thread, so under
+ASGI a process profiles one request at a time (others overlapping it are
+passed through) and the report shows the event loop's view of the request:
+time in synchronous database calls appears as awaits, with the statements
+themselves in the SQL summary.
+"""
+import cProfile
+import json
+import logging
+import pstats
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+SIGNING_SALT = 'app.profiling'
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.0,
+    'HEADER': 'X-Profile-Request',
+    'TOKEN_MAX_AGE': 3600,
+    'DIR': None,
+    'MAX_REPORTS': 200,
+    'TOP_FUNCTIONS': 30,
+    'TOP_QUERIES': 20,
+}
+
+
+def profiler_settings():
+    """REQUEST_PROFILER merged over the defaults"""
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'REQUEST_PROFILER', {}))
+    if config['DIR'] is None:
+        config['DIR'] = Path(settings.BASE_DIR) / 'profiles'
+    return config
+
+
+def issue_profile_token(label='manual'):
+    """Signed value for the profiling header"""
+    return signing.dumps({'label': label}, salt=SIGNING_SALT)
+
+
+def _valid_token(value, max_age):
+    try:
+        signing.loads(value, salt=SIGNING_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+_NUMBER_RE = re.compile(r'\b\d+\b')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+
+
+def normalize_sql(sql):
+    """Collapse literals so repeated queries share one fingerprint"""
+    return _NUMBER_RE.sub('?', _STRING_RE.sub('?', sql))
+
+
+class SQLRecorder:
+    """execute_wrapper that accumulates time per normalized statement"""
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+        self.queries = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.total += elapsed
+            self.count += 1
+            entry = self.queries.setdefault(normalize_sql(sql), [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def top(self, limit):
+        ranked = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+        return [
+            {'sql': sql, 'calls': calls, 'seconds': round(seconds, 6)}
+            for sql, (calls, seconds) in ranked[:limit]
+        ]
+
+
+def top_functions(stats, limit):
+    """The `limit` entries of a pstats.Stats with the highest cumulative time"""
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            'function': f'{filename}:{line}({name})',
+            'calls': nc,
+            'own_seconds': round(tt, 6),
+            'cumulative_seconds': round(ct, 6),
+        })
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:limit]
+
+
+class SamplingProfilerMiddleware:
+    """Profile a sample of requests and write per-view reports to disk"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.config = profiler_settings()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = 'HTTP_' + self.config['HEADER'].upper().replace('-', '_')
+        self.directory = Path(self.config['DIR'])
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.profiling = False  # An async request is being profiled on the event loop
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def should_profile(self, request):
+        token = request.META.get(self.header)
+        if token:
+            return _valid_token(token, self.config['TOKEN_MAX_AGE'])
+        return random.random() < self.config['SAMPLE_RATE']
+
+    def record_queries(self, recorder):
+        """Install `recorder` on this thread's connections; closing the returned stack removes it"""
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        return stack
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        recorder = SQLRecorder()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        with self.record_queries(recorder):
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        elapsed = time.perf_counter() - start
+
+        try:
+            self.write_report(request, response, profiler, recorder, elapsed)
+        except OSError:
+            logger.exception('Could not write request profile')
+        return response
+
+    async def __acall__(self, request):
+        if self.profiling or not self.should_profile(request):
+            return await self.get_response(request)
+
+        self.profiling = True
+        recorder = SQLRecorder()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        # Async views query through sync_to_async, on the request's own thread
+        # (asgiref's thread-sensitive executor), so the recorder is installed there
+        stack = await sync_to_async(self.record_queries)(recorder)
+        profiler.enable()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+            self.profiling = False
+            await sync_to_async(stack.close)()
+        elapsed = time.perf_counter() - start
+
+        try:
+            await sync_to_async(self.write_report, thread_sensitive=False)(request, response, profiler, recorder, elapsed)
+        except OSError:
+            logger.exception('Could not write request profile')
+        return response
+
+    def write_report(self, request, response, profiler, recorder, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else 'unresolved'
+        stem = f'{time.strftime("%Y%m%d-%H%M%S")}-{view_name.replace(":", "_")}-{uuid.uuid4().hex[:8]}'
+
+        profiler.dump_stats(self.directory / f'{stem}.prof')
+        summary = {
+            'view': view_name,
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'total_seconds': round(elapsed, 6),
+            'sql_seconds': round(recorder.total, 6),
+            'sql_count': recorder.count,
+            'queries': recorder.top(self.config['TOP_QUERIES']),
+            'functions': top_functions(pstats.Stats(profiler), self.config['TOP_FUNCTIONS']),
+        }
+        with open(self.directory / f'{stem}.json', 'w') as handle:
+            json.dump(summary, handle, indent=2)
+        self.prune()
+
+    def prune(self):
+        """Keep at most MAX_REPORTS reports, dropping the oldest"""
+        reports = sorted(self.directory.glob('*.json'), key=lambda path: path.stat().st_mtime)
+        for report in reports[:max(len(reports) - self.config['MAX_REPORTS'], 0)]:
+            report.unlink(missing_ok=True)
+            report.with_suffix('.prof').unlink(missing_ok=True)
@@ -0,0 +1,205 @@
+"""
+Bulk user provisioning.
+
+provision_users() creates accounts from CSV or NDJSON rows with the columns
+username, email, first_name, last_name, password, role and organization, for
+the ``provision_users`` command and the admin upload. Rows are checked a
+chunk at a time against the registration rules, plus one query per chunk for
+usernames already taken; a bad row is reported with its line number and the
+rest of the file carries on.
+
+Hashing a password is deliberately slow (PBKDF2 with hundreds of thousands
+of iterations), so passwords are hashed across a process pool of
+USER_PROVISIONING['HASH_WORKERS'] (see app/passwords.py). A row without a
+password gets an unusable one until the user resets it. Each chunk's users
+and profiles are inserted with a bulk_create each in one transaction, then
+mirrored onto the shards.
+"""
+import csv
+import json
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from .forms import check_password_strength
+from .models import UserProfile, UserRole
+from .passwords import hash_passwords
+from .sharding import mirror_users
+
+
+FORMATS = ('csv', 'ndjson')
+COLUMNS = ('username', 'email', 'first_name', 'last_name', 'password', 'role', 'organization')
+
+RowError = namedtuple('RowError', 'line username message')
+
+
+def provisioning_settings():
+    config = {
+        'HASH_WORKERS': os.cpu_count() or 1,
+        'CHUNK_SIZE': 1000,  # Rows validated and inserted together
+        'MAX_UPLOAD_ROWS': 2000,  # Larger files go through the command
+    }
+    config.update(getattr(settings, 'USER_PROVISIONING', {}))
+    return config
+
+
+def detect_format(filename):
+    """'csv' or 'ndjson' from a file name, or None"""
+    extension = os.path.splitext(filename)[1].lower()
+    return {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(extension)
+
+
+def read_rows(lines, file_format):
+    """(line number, row dict, error) for each record in an iterable of text lines"""
+    if file_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, f'Invalid JSON: {error}'
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, 'Each line must be a JSON object'
+
+
+def _clean(row):
+    """(User fields, UserProfile fields, password) for a row; raises ValidationError"""
+    values = {column: str(row.get(column) or '').strip() for column in COLUMNS if column != 'password'}
+    password = str(row.get('password') or '')
+    if not values['username']:
+        raise ValidationError('username is required.')
+    for column in ('username', 'first_name', 'last_name'):
+        if len(values[column]) > 150:
+            raise ValidationError(f'{column} must be at most 150 characters.')
+    User.username_validator(values['username'])
+    if values['email']:
+        validate_email(values['email'])
+    role = values['role'].upper() or UserRole.USER
+    if role not in UserRole.values:
+        raise ValidationError(f'Unknown role {values["role"]!r}.')
+    if len(values['organization']) > 255:
+        raise ValidationError('organization must be at most 255 characters.')
+    if password:
+        check_password_strength(password)
+    user_fields = {column: values[column] for column in ('username', 'email', 'first_name', 'last_name')}
+    return user_fields, {'role': role, 'organization': values['organization']}, password
+
+
+def _hash(pool, workers, passwords):
+    """Encoded passwords, the non-empty ones hashed across the pool"""
+    hasher = type(get_hasher())
+    hasher_path = f'{hasher.__module__}.{hasher.__qualname__}'
+    given = [password for password in passwords if password]
+    if pool is None or len(given) < 2:
+        hashed = hash_passwords(hasher_path, given)
+    else:
+        size = -(-len(given) // workers)
+        slices = [given[index:index + size] for index in range(0, len(given), size)]
+        hashed = [
+            encoded
+            for chunk in pool.map(hash_passwords, [hasher_path] * len(slices), slices)
+            for encoded in chunk
+        ]
+    hashed = iter(hashed)
+    return [next(hashed) if password else make_password(None) for password in passwords]
+
+
+def _insert(pending):
+    """Create users and profiles for [((line, user fields, profile fields, password), hash)]"""
+    with transaction.atomic():
+        users = User.objects.bulk_create([
+            User(password=encoded, **user_fields) for (_, user_fields, _, _), encoded in pending
+        ])
+        if any(user.pk is None for user in users):
+            # Backends that cannot return ids from a bulk insert
+            ids = dict(User.objects.filter(username__in=[user.username for user in users]).values_list('username', 'id'))
+            for user in users:
+                user.pk = ids[user.username]
+        UserProfile.objects.bulk_create([
+            UserProfile(user=user, **profile_fields) for user, ((_, _, profile_fields, _), _) in zip(users, pending)
+        ])
+    mirror_users(users, created=True)
+    return users
+
+
+def _without_taken(accepted, errors):
+    """The rows whose username is still free; the others are reported"""
+    usernames = [user_fields['username'] for _, user_fields, _, _ in accepted]
+    taken = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    errors.extend(
+        RowError(line, user_fields['username'], 'A user with that username already exists.')
+        for line, user_fields, _, _ in accepted if user_fields['username'] in taken
+    )
+    return [row for row in accepted if row[1]['username'] not in taken]
+
+
+def _provision_chunk(chunk, seen, pool, workers, dry_run, errors):
+    accepted = []
+    for line, row, error in chunk:
+        username = str((row or {}).get('username') or '').strip()
+        if error is None:
+            try:
+                cleaned = _clean(row)
+            except ValidationError as invalid:
+                error = ' '.join(invalid.messages)
+        if error is None and username in seen:
+            error = 'Duplicate username in this file.'
+        if error is not None:
+            errors.append(RowError(line, username, error))
+            continue
+        seen.add(username)
+        accepted.append((line, *cleaned))
+
+    accepted = _without_taken(accepted, errors)
+    if dry_run or not accepted:
+        return len(accepted)
+    pending = list(zip(accepted, _hash(pool, workers, [password for _, _, _, password in accepted])))
+    try:
+        return len(_insert(pending))
+    except IntegrityError:
+        # A username was taken since the check: report it and insert the rest
+        kept = {line for line, _, _, _ in _without_taken(accepted, errors)}
+        return len(_insert([item for item in pending if item[0][0] in kept]))
+
+
+def provision_users(rows, workers=None, chunk_size=None, dry_run=False):
+    """Create users from read_rows() output; returns (users created, [RowError])
+
+    With `dry_run` nothing is written and the count is of rows that would be created.
+    """
+    config = provisioning_settings()
+    workers = max(workers or config['HASH_WORKERS'], 1)
+    chunk_size = chunk_size or config['CHUNK_SIZE']
+    created, errors, seen = 0, [], set()
+    # Spawned, not forked: the admin upload runs inside a threaded web server
+    pool = None
+    if workers > 1 and not dry_run:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            created += _provision_chunk(chunk, seen, pool, workers, dry_run, errors)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return created, sorted(errors)
@@ -0,0 +1,131 @@
+"""
+Declarative per-view query budgets.
+
+Views declare the most queries a request may issue with ``@query_budget(n)``
+(or ``register_budget`` for views defined elsewhere); scatter-gather views
+add ``per_shard`` queries for every message shard beyond the first.
+QueryBudgetMiddleware counts every query executed while the view runs; in
+strict mode (DEBUG and the test suite) an overrun raises
+QueryBudgetExceeded, otherwise it is only logged so production traffic is
+never interrupted.
+"""
+import logging
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from .sharding import shard_aliases
+
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+
+
+class QueryBudgetExceeded(Exception):
+    """A view issued more queries than its declared budget"""
+
+
+def query_budget(max_queries, per_shard=0):
+    """Declare the maximum number of queries a view may issue"""
+    def decorator(view_func):
+        view_func.query_budget = (max_queries, per_shard)
+        return view_func
+    return decorator
+
+
+def register_budget(view_name, max_queries, per_shard=0):
+    """Declare a budget for a view by URL name (for views we cannot decorate)"""
+    _registry[view_name] = (max_queries, per_shard)
+
+
+def budget_for(view_func, view_name=None):
+    """Budget declared for a view under the current shard layout, or None"""
+    budget = getattr(view_func, 'query_budget', None)
+    if budget is None and view_name:
+        budget = _registry.get(view_name)
+    if budget is None:
+        return None
+    max_queries, per_shard = budget
+    return max_queries + per_shard * max(len(shard_aliases()) - 1, 0)
+
+
+def budget_settings():
+    config = {'ENABLED': True, 'STRICT': settings.DEBUG}
+    config.update(getattr(settings, 'QUERY_BUDGET', {}))
+    return config
+
+
+class QueryCounter:
+    """execute_wrapper counting queries across all connections"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        self.statements.append(sql)
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMiddleware:
+    """Enforce (or log) per-view query budgets"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        request.query_budget = budget_for(view_func, match.view_name if match else None)
+
+    def count_queries(self, counter):
+        """Install `counter` on this thread's connections; closing the returned stack removes it"""
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(counter))
+        return stack
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = budget_settings()
+        if not config['ENABLED']:
+            return self.get_response(request)
+
+        counter = QueryCounter()
+        with self.count_queries(counter):
+            response = self.get_response(request)
+        self.check(request, counter, config)
+        return response
+
+    async def __acall__(self, request):
+        config = budget_settings()
+        if not config['ENABLED']:
+            return await self.get_response(request)
+
+        # Async views query through sync_to_async, on the request's own thread
+        # (asgiref's thread-sensitive executor), so the counter is installed there
+        counter = QueryCounter()
+        stack = await sync_to_async(self.count_queries)(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        self.check(request, counter, config)
+        return response
+
+    def check(self, request, counter, config):
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and counter.count > budget:
+            view_name = request.resolver_match.view_name if request.resolver_match else request.path
+            detail = f'{view_name} issued {counter.count} queries (budget {budget})'
+            if config['STRICT']:
+                raise QueryBudgetExceeded(detail + ':\n' + '\n'.join(counter.statements))
+            logger.warning('Query budget exceeded: %s', detail)
@@ -0,0 +1,142 @@
+"""
+Query plans for the hot queries.
+
+canonical_queries() lists the querysets behind each view's (and worker's)
+hot path, built the way the view builds them, for the ``explain_queries``
+command. plan_issues() reads a plan from QuerySet.explain() and flags the
+steps that grow with the table: full scans and sorts into a temporary
+structure. Both are the database's judgement under its current statistics,
+so run the command against realistic data (``--seed``) before trusting a
+clean report.
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .conversations import LIST_SIZE, PAGE_SIZE
+from .models import Certificate, Conversation, ConversationMember, Job, LifecycleStat, Message, MessageLog
+
+
+SEED_STATUSES = ['DELIVERED'] * 6 + ['CERTIFICATE_CREATED', 'ROUTER_ACCEPTED', 'SENT', 'REJECTED']
+
+# Plan fragments that mean a full scan or a temporary sort, per backend
+ISSUE_PATTERNS = {
+    'sqlite': [('SCAN ', 'full scan'), ('USE TEMP B-TREE', 'temporary sort')],
+    'postgresql': [('Seq Scan', 'full scan'), ('Sort  ', 'sort'), ('Sort (', 'sort')],
+    'mysql': [('\tALL\t', 'full scan'), ('Using filesort', 'sort'), ('Using temporary', 'temporary table')],
+}
+
+
+def canonical_queries(alias, user_id, message_id, conversation_id=None):
+    """[(view, description, queryset)] for the queries each view issues
+
+    Message tables are read on `alias`; `user_id` is the user whose mailbox
+    is read and `message_id` a message they received.
+    """
+    messages = Message.objects.using(alias)
+    logs = MessageLog.objects.using(alias)
+    queries = [
+        ('dashboard', 'router queue', messages.filter(status='SENT').select_related('sender', 'receiver')),
+        ('dashboard', 'CA queue', messages.filter(status='ROUTER_ACCEPTED').select_related('sender', 'receiver')),
+        ('dashboard', 'recent sent', messages.filter(sender_id=user_id).select_related('receiver')[:10]),
+        ('inbox', 'page', messages.filter(receiver_id=user_id).select_related('sender').order_by('-timestamp')[:10]),
+        ('inbox', 'ETag', messages.filter(receiver_id=user_id).order_by().values('receiver_id').annotate(
+            latest=Max('updated_at'), total=Count('id'))),
+        ('outbox', 'page', messages.filter(sender_id=user_id).select_related('receiver').order_by('-timestamp')[:10]),
+        ('outbox', 'ETag', messages.filter(sender_id=user_id).order_by().values('sender_id').annotate(
+            latest=Max('updated_at'), total=Count('id'))),
+        ('view_message', 'message', messages.filter(id=message_id).select_related('sender', 'receiver')),
+        ('view_message', 'history', logs.filter(message_id__in=[message_id]).select_related('actor')),
+        ('view_message', 'certificate', Certificate.objects.using(alias).filter(message_id=message_id)
+            .values_list('valid_until', flat=True)),
+        ('conversations', 'page', ConversationMember.objects.filter(user_id=user_id)
+            .select_related('conversation', 'peer').order_by('-last_activity', '-id')[:LIST_SIZE + 1]),
+        ('api_user_stats', 'pending count (router)', messages.filter(status='SENT').order_by().values('id')),
+        ('api_user_stats', 'pending count (CA)', messages.filter(status='ROUTER_ACCEPTED').order_by().values('id')),
+        ('api_lifecycle_stats', 'report', LifecycleStat.objects.filter(
+            log_type='CERTIFICATE', bucket__gte=timezone.now() - timedelta(days=7))),
+        ('api_verify_certificates', 'certificates', Certificate.objects.using(alias)
+            .filter(message_id__in=[message_id]).values_list('message_id', 'message__encrypted_content', 'certificate_data')),
+        ('route_messages', 'batch', messages.filter(status='SENT', id__gt=0).order_by('id')[:500]),
+        ('expire_certificates', 'batch', Certificate.objects.using(alias).filter(
+            valid_until__gte=timezone.now() - timedelta(days=1), valid_until__lte=timezone.now(), expired_at=None,
+        ).order_by('valid_until', 'id')[:1000]),
+        ('worker', 'claim', Job.objects.filter(status=Job.QUEUED, run_at__lte=timezone.now())
+            .order_by('priority', 'run_at', 'id')[:10]),
+    ]
+    if conversation_id is not None:
+        queries.append(('conversation_thread', 'page', messages.filter(conversation_id=conversation_id)
+                        .order_by('-timestamp', '-id')[:PAGE_SIZE + 1]))
+    return queries
+
+
+def plan_issues(vendor, plan):
+    """[(plan line, problem)] for the steps of `plan` that scan or sort"""
+    issues = []
+    for line in plan.splitlines():
+        for fragment, problem in ISSUE_PATTERNS.get(vendor, []):
+            # An ordered walk of an index ("SCAN t USING INDEX i") reads only what it returns
+            if fragment in line and not (vendor == 'sqlite' and 'USING' in line and 'INDEX' in line):
+                issues.append((line.strip(), problem))
+                break
+    return issues
+
+
+def explain(queryset):
+    """(plan text, [(plan line, problem)]) for a queryset"""
+    plan = queryset.explain()
+    return plan, plan_issues(connections[queryset.db].vendor, plan)
+
+
+def seed_messages(alias, count, users=50, logs_per_message=2):
+    """Bulk-insert `count` synthetic messages with history and conversations between `users` new users
+
+    For trying plans on realistic data inside a transaction that is rolled back.
+    Returns (a user, one of their received messages).
+    """
+    stamp = timezone.now()
+    people = User.objects.bulk_create([
+        User(username=f'explain-{stamp:%H%M%S%f}-{index}', password='!') for index in range(users)
+    ])
+    if alias is not None:
+        User.objects.using(alias).bulk_create([User(pk=person.pk, username=person.username, password='!') for person in people])
+    generator = random.Random(0)
+    pairs = [(first, second) for index, first in enumerate(people) for second in people[index + 1:]]
+    conversations = Conversation.objects.bulk_create([
+        Conversation(user_a=first, user_b=second, last_activity=stamp - timedelta(seconds=generator.randrange(90 * 86400)))
+        for first, second in pairs
+    ])
+    ConversationMember.objects.bulk_create([
+        ConversationMember(conversation=conversation, user=user, peer=peer, last_activity=conversation.last_activity)
+        for conversation in conversations
+        for user, peer in ((conversation.user_a, conversation.user_b), (conversation.user_b, conversation.user_a))
+    ])
+    rows = []
+    for _ in range(count):
+        index = generator.randrange(len(pairs))
+        sender, receiver = generator.sample(pairs[index], 2)
+        rows.append(Message(
+            sender=sender, receiver=receiver, subject='Seeded', encrypted_content='x',
+            status=generator.choice(SEED_STATUSES), conversation_id=conversations[index].id,
+        ))
+    created = Message.objects.using(alias).bulk_create(rows, batch_size=2000)
+    # auto_now_add stamps every row alike; spread them out like real traffic
+    moments = [stamp - timedelta(seconds=generator.randrange(90 * 86400)) for _ in created]
+    for message, moment in zip(created, moments):
+        message.timestamp = moment
+    Message.objects.using(alias).bulk_update(created, ['timestamp'], batch_size=2000)
+    MessageLog.objects.using(alias).bulk_create([
+        MessageLog(message=message, actor=message.sender, log_type='SEND', timestamp=message.timestamp)
+        for message in created for _ in range(logs_per_message)
+    ], batch_size=2000)
+    for connection in {connections['default'], connections[alias or 'default']}:
+        if connection.vendor in ('sqlite', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+    user = people[0]
+    message = next((message for message in created if message.receiver_id == user.id), created[0])
+    return user, message
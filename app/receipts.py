@@ -0,0 +1,155 @@
+"""
+Read receipts with deferred, batched writes.
+
+Opening a message (or a conversation thread) must not add an UPDATE to the
+request, so mark_read() only records the receipt in a per-process buffer.
+The buffer is written after a response has been sent (on
+``request_finished``) once it holds READ_RECEIPTS['BATCH_SIZE'] receipts or
+its oldest receipt is MAX_DELAY seconds old. A flush writes each shard in
+one transaction (nested in one on the default database): a guarded UPDATE
+per (receiver, conversation) group setting read_at, then one UPDATE each for
+the receivers' UserProfile.unread_count and ConversationMember.unread_count,
+decremented by the rows that actually flipped. The flips and the decrements
+commit or roll back together, so counters and read state stay in step and
+are never recounted; a shard whose write failed is kept for the next flush.
+Receipts still buffered when a process exits are lost (nothing is written at
+exit, when the database may already be gone), which only leaves those
+messages unread.
+"""
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DatabaseError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .changes import next_change
+from .database import retry_on_lock
+from .models import ConversationMember, Message, UserProfile
+from .sharding import shard_for_receiver
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = {}  # (alias, message id) -> (receiver id, conversation id, read_at)
+_oldest = None  # time.monotonic() of the oldest pending receipt
+
+
+def receipt_settings():
+    config = {
+        'BATCH_SIZE': 200,
+        'MAX_DELAY': 1.0,
+    }
+    config.update(getattr(settings, 'READ_RECEIPTS', {}))
+    return config
+
+
+def mark_read(messages, reader):
+    """Buffer receipts for the messages `reader` received and has not read yet"""
+    global _oldest
+    now = timezone.now()
+    with _lock:
+        for message in messages:
+            if message.receiver_id != reader.id or message.read_at is not None:
+                continue
+            key = (shard_for_receiver(message.receiver_id), message.id)  # Never the replica it was read from
+            _pending.setdefault(key, (message.receiver_id, message.conversation_id, now))
+            if _oldest is None:
+                _oldest = time.monotonic()
+
+
+@receiver(request_finished)
+def flush_if_due(**kwargs):
+    config = receipt_settings()
+    with _lock:
+        due = _pending and (
+            len(_pending) >= config['BATCH_SIZE'] or time.monotonic() - _oldest >= config['MAX_DELAY']
+        )
+    if due:
+        flush()
+
+
+def flush():
+    """Write every buffered receipt; returns how many messages became read"""
+    global _pending, _oldest
+    with _lock:
+        pending, _pending, _oldest = _pending, {}, None
+    by_alias = defaultdict(lambda: defaultdict(list))
+    for (alias, message_id), (receiver_id, conversation_id, read_at) in pending.items():
+        by_alias[alias][(receiver_id, conversation_id)].append((message_id, read_at))
+
+    flipped = 0
+    for alias, groups in by_alias.items():
+        try:
+            flipped += _write(alias, groups)
+        except DatabaseError:
+            failed = {key: value for key, value in pending.items() if key[0] == alias}
+            logger.warning('Could not write %d read receipts; retrying later', len(failed), exc_info=True)
+            with _lock:
+                for key, value in failed.items():
+                    _pending.setdefault(key, value)
+                if _oldest is None:
+                    _oldest = time.monotonic()
+    return flipped
+
+
+def clear():
+    """Drop every buffered receipt without writing it (for tests); returns how many were dropped"""
+    global _pending, _oldest
+    with _lock:
+        dropped, _pending, _oldest = len(_pending), {}, None
+    return dropped
+
+
+@retry_on_lock
+def _write(alias, groups):
+    """Flip one shard's receipts and decrement the counters they cover; returns how many flipped"""
+    unread, member_unread = Counter(), Counter()
+    # The counters live on the default database; nesting the two transactions rolls
+    # both back if either fails (with sharding off they are the same transaction)
+    with transaction.atomic(using=alias), transaction.atomic():
+        change_seq = next_change(alias)
+        for (receiver_id, conversation_id), receipts in groups.items():
+            flipped = Message.objects.using(alias).filter(
+                id__in=[message_id for message_id, _ in receipts], read_at=None,
+            ).update(
+                read_at=min(read_at for _, read_at in receipts), updated_at=timezone.now(), change_seq=change_seq,
+            )
+            if flipped:
+                unread[receiver_id] += flipped
+                if conversation_id:
+                    member_unread[(conversation_id, receiver_id)] += flipped
+        _decrement_unread(unread, member_unread)
+    return sum(unread.values())
+
+
+def _decrement_unread(unread, member_unread):
+    if unread:
+        UserProfile.objects.filter(user_id__in=unread).update(unread_count=Case(
+            *[When(user_id=user_id, then=_decrement(count)) for user_id, count in unread.items()],
+            default=F('unread_count'),
+            output_field=PositiveIntegerField(),
+        ))
+    if member_unread:
+        conditions = [
+            (Q(conversation_id=conversation_id, user_id=user_id), count)
+            for (conversation_id, user_id), count in member_unread.items()
+        ]
+        ConversationMember.objects.filter(
+            conversation_id__in={conversation_id for conversation_id, _ in member_unread}
+        ).update(unread_count=Case(
+            *[When(condition, then=_decrement(count)) for condition, count in conditions],
+            default=F('unread_count'),
+            output_field=PositiveIntegerField(),
+        ))
+
+
+def _decrement(count):
+    return Greatest(F('unread_count') - count, Value(0))
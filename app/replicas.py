@@ -0,0 +1,158 @@
+"""
+Read-replica routing.
+
+Views marked ``@read_only`` send their ``app`` model reads to the replica
+alias (DATABASE_REPLICA['ALIAS']); everything else - writes, sessions, auth
+and unmarked views - stays on ``default``. After a user performs a write a
+signed cookie pins their reads to the primary for STICKY_SECONDS so they
+always see their own writes, and the replica is skipped entirely while its
+replication heartbeat is older than MAX_LAG_SECONDS.
+"""
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.utils import timezone
+
+
+HEARTBEAT_NAME = 'replica_heartbeat'
+PIN_COOKIE = 'primary_pin'
+
+_use_replica = ContextVar('use_replica', default=False)
+_health = {'checked_at': 0.0, 'healthy': False}
+
+
+def replica_settings():
+    config = {
+        'ALIAS': 'replica',
+        'STICKY_SECONDS': 5,
+        'MAX_LAG_SECONDS': 10,
+        'LAG_CHECK_INTERVAL': 1,
+        'ROUTED_APPS': ('app',),
+    }
+    config.update(getattr(settings, 'DATABASE_REPLICA', {}))
+    return config
+
+
+def replica_configured():
+    """True when a replica alias exists and is a different database than default"""
+    alias = replica_settings()['ALIAS']
+    if alias not in settings.DATABASES:
+        return False
+    # A test mirror (or misconfiguration) pointing at the primary has nothing to offload
+    return connections[alias].settings_dict['NAME'] != connections['default'].settings_dict['NAME']
+
+
+def read_only(view_func):
+    """Mark a view as safe to serve from the read replica"""
+    view_func.read_only = True
+    return view_func
+
+
+def replica_lag():
+    """Seconds since the replica last received a heartbeat, or None if unknown"""
+    from .models import Checkpoint
+
+    config = replica_settings()
+    try:
+        beat_at = (
+            Checkpoint.objects.using(config['ALIAS'])
+            .filter(name=HEARTBEAT_NAME)
+            .values_list('updated_at', flat=True)
+            .first()
+        )
+    except DatabaseError:
+        return None
+    if beat_at is None:
+        return None
+    return (timezone.now() - beat_at).total_seconds()
+
+
+def replica_healthy():
+    """Cached check that the replica is within MAX_LAG_SECONDS of the primary"""
+    config = replica_settings()
+    now = time.monotonic()
+    if now - _health['checked_at'] >= config['LAG_CHECK_INTERVAL']:
+        lag = replica_lag()
+        _health['healthy'] = lag is not None and lag <= config['MAX_LAG_SECONDS']
+        _health['checked_at'] = now
+    return _health['healthy']
+
+
+class ReplicaRouter:
+    """Send reads from @read_only views to the replica alias"""
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and model._meta.app_label in replica_settings()['ROUTED_APPS']:
+            return replica_settings()['ALIAS']
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica is a copy of default, so objects from either may relate
+        pair = {'default', replica_settings()['ALIAS']}
+        if obj1._state.db in pair and obj2._state.db in pair:
+            return True
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Route @read_only views to the replica and pin writers to the primary"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def pinned(self, request):
+        return request.get_signed_cookie(
+            PIN_COOKIE, default=None, max_age=replica_settings()['STICKY_SECONDS']
+        ) is not None
+
+    def eligible(self, request):
+        # Health is checked here, before the view runs, so the (cached) lag
+        # query is never charged against a view's query budget
+        return (
+            request.method in ('GET', 'HEAD')
+            and replica_configured()
+            and not self.pinned(request)
+            and replica_healthy()
+        )
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.replica_eligible = self.eligible(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            if getattr(request, 'replica_token', None) is not None:
+                _use_replica.reset(request.replica_token)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        request.replica_eligible = await sync_to_async(self.eligible)(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            if getattr(request, 'replica_token', None) is not None:
+                # process_view ran in a sync_to_async thread whose context was
+                # copied back here, so its token cannot be reset in this one
+                _use_replica.set(False)
+        return self.pin(request, response)
+
+    def pin(self, request, response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and replica_configured():
+            sticky = replica_settings()['STICKY_SECONDS']
+            response.set_signed_cookie(PIN_COOKIE, '1', max_age=sticky, httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.replica_eligible and getattr(view_func, 'read_only', False):
+            request.replica_token = _use_replica.set(True)
@@ -0,0 +1,133 @@
+"""
+User and role resolution.
+
+ProfileBackend is the authentication backend (AUTHENTICATION_BACKENDS):
+Django's AuthenticationMiddleware loads the lazy ``request.user`` through
+it, together with its UserProfile in one select_related query, so the
+navbar's unread count and every role check read the profile without a
+second query.
+
+Views restricted to some roles use ``@role_required(...)`` instead of
+``@login_required`` plus an inline profile check. The role a session
+resolved is cached under the user's id together with the session's auth
+hash (the "session version", which changes when the password does), so a
+repeat request only needs the session to pass the check; the user row is
+loaded only if the view itself uses it. Saving or deleting the user or
+their profile drops the cached role; after a deactivation the next request
+loads the user, and Django signs the inactive user out. That only reaches
+every worker when the cache is shared between processes (Redis in
+production, see CACHES): with the in-process cache other workers would keep
+honouring a revoked role for up to CACHE_SECONDS, so ``manage.py check
+--deploy`` flags it.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.checks import Tags, Warning, register
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+from .models import UserProfile
+
+
+CACHE_PREFIX = 'role:'
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+def role_settings():
+    config = {
+        'CACHE_SECONDS': 300,
+    }
+    config.update(getattr(settings, 'ROLE_CACHE', {}))
+    return config
+
+
+# ===================== AUTHENTICATION =====================
+class ProfileBackend(ModelBackend):
+    """ModelBackend whose get_user() loads the profile in the same query"""
+
+    def get_user(self, user_id):
+        user = User._default_manager.select_related('profile').filter(pk=user_id).first()
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+
+# ===================== ROLES =====================
+def _cache_key(user_id):
+    return f'{CACHE_PREFIX}{user_id}'
+
+
+def request_role(request):
+    """The signed-in user's role ('' without a profile), or None when nobody is signed in"""
+    user_id = request.session.get(SESSION_KEY)
+    if user_id is None:
+        return None
+    version = request.session.get(HASH_SESSION_KEY)
+    cached = cache.get(_cache_key(user_id))
+    if cached is not None and version and cached[0] == version:
+        return cached[1]
+
+    user = request.user
+    if not user.is_authenticated:
+        return None
+    role = user.profile.role if hasattr(user, 'profile') else ''
+    # Read again: a rejected fallback hash flushes the session, a valid one rotates it
+    version = request.session.get(HASH_SESSION_KEY)
+    if version:
+        cache.set(_cache_key(user.id), (version, role), role_settings()['CACHE_SECONDS'])
+    return role
+
+
+def role_required(*roles, api=False):
+    """Allow signed-in users with one of `roles`
+
+    Anonymous users go to the login page. Other users are sent back to the
+    dashboard with an error, or get a JSON 403 when `api` is set.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            role = request_role(request)
+            if role is None:
+                return redirect_to_login(request.get_full_path())
+            if role not in roles:
+                if api:
+                    return JsonResponse({'error': 'Permission denied'}, status=403)
+                messages.error(request, 'You do not have permission to perform this action.')
+                return redirect('dashboard')
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def forget_profile_role(sender, instance, **kwargs):
+    cache.delete(_cache_key(instance.user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_role(sender, instance, **kwargs):
+    # Deactivating a user or changing their password must not leave a cached pass
+    cache.delete(_cache_key(instance.pk))
+
+
+@register(Tags.caches, deploy=True)
+def check_role_cache(app_configs, **kwargs):
+    backend = settings.CACHES['default']['BACKEND']
+    if not role_settings()['CACHE_SECONDS'] or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Warning(
+        f'Roles are cached for {role_settings()["CACHE_SECONDS"]}s in {backend}, which each process keeps '
+        'to itself: a role revoked in one worker stays valid in the others until the entry expires.',
+        hint='Set SECUREMESSENGER_REDIS_URL to use Redis, or ROLE_CACHE["CACHE_SECONDS"] = 0.',
+        id='app.W002',
+    )]
@@ -0,0 +1,201 @@
+"""
+Automatic Router-stage decisions.
+
+Enabled RoutingRule rows are compiled into a RuleMatcher: every rule is
+filed under one of its equality conditions (sender, receiver, role or
+organization), so a message only evaluates the rules filed under its own
+values plus the rules without any equality condition, in priority order.
+Saving or deleting a rule bumps a Checkpoint used as a version counter and
+every process rebuilds its matcher the next time it notices the change.
+
+route_pending_messages() is run by the ``route_messages`` command: it walks
+SENT messages in id-ordered batches on every shard and applies each batch's
+decisions with one UPDATE and one bulk log insert per action and rule.
+"""
+import heapq
+from collections import defaultdict, namedtuple
+
+from django.db.models import F
+from django.db.models.functions import Length
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .lifecycle import transition_messages
+from .models import Checkpoint, Message, RoutingRule, UserProfile
+from .sharding import message_aliases
+
+
+VERSION_CHECKPOINT = 'routing_rules'
+
+# action -> (new status, MessageLog type)
+ACTION_TRANSITIONS = {
+    'ACCEPT': ('ROUTER_ACCEPTED', 'ACCEPT'),
+    'REJECT': ('REJECTED', 'REJECT'),
+}
+
+MessageFacts = namedtuple(
+    'MessageFacts',
+    'sender_id receiver_id sender_role receiver_role sender_organization receiver_organization size age',
+)
+
+# Equality conditions a rule can be filed under, most selective first
+INDEXED_FACTS = (
+    'sender_id', 'receiver_id', 'sender_organization', 'receiver_organization', 'sender_role', 'receiver_role',
+)
+
+
+def _organization(value):
+    return (value or '').strip().casefold()
+
+
+class CompiledRule:
+    __slots__ = ('id', 'name', 'action', 'order', 'equals', 'size', 'age')
+
+    def __init__(self, rule):
+        self.id = rule.id
+        self.name = rule.name
+        self.action = rule.action
+        self.order = (rule.priority, rule.id)
+        conditions = {
+            'sender_id': rule.sender_id,
+            'receiver_id': rule.receiver_id,
+            'sender_organization': _organization(rule.sender_organization),
+            'receiver_organization': _organization(rule.receiver_organization),
+            'sender_role': rule.sender_role,
+            'receiver_role': rule.receiver_role,
+        }
+        self.equals = tuple((fact, value) for fact, value in conditions.items() if value)
+        self.size = (rule.min_size, rule.max_size)
+        self.age = (rule.min_age, rule.max_age)
+
+    def matches(self, facts):
+        for fact, value in self.equals:
+            if getattr(facts, fact) != value:
+                return False
+        return _within(facts.size, *self.size) and _within(facts.age, *self.age)
+
+
+def _within(value, low, high):
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+class RuleMatcher:
+    """Priority-ordered rules indexed by their first equality condition"""
+
+    def __init__(self, rules):
+        self.index = defaultdict(list)  # (fact, value) -> rules in priority order
+        self.unindexed = []
+        for rule in sorted((CompiledRule(rule) for rule in rules), key=lambda rule: rule.order):
+            if rule.equals:
+                self.index[rule.equals[0]].append(rule)
+            else:
+                self.unindexed.append(rule)
+
+    def __bool__(self):
+        return bool(self.index or self.unindexed)
+
+    def match(self, facts):
+        """First rule (by priority) matching the message, or None"""
+        candidates = [self.index.get((fact, getattr(facts, fact)), ()) for fact in INDEXED_FACTS]
+        candidates.append(self.unindexed)
+        for rule in heapq.merge(*candidates, key=lambda rule: rule.order):
+            if rule.matches(facts):
+                return rule
+        return None
+
+
+_matcher = {'version': None, 'matcher': None}
+
+
+def rules_version():
+    return Checkpoint.objects.filter(name=VERSION_CHECKPOINT).values_list('position', flat=True).first() or 0
+
+
+def get_matcher():
+    """The compiled matcher for the enabled rules, rebuilt when they change"""
+    version = rules_version()
+    if _matcher['version'] != version:
+        _matcher['matcher'] = RuleMatcher(RoutingRule.objects.filter(enabled=True))
+        _matcher['version'] = version
+    return _matcher['matcher']
+
+
+@receiver(post_save, sender=RoutingRule)
+@receiver(post_delete, sender=RoutingRule)
+def bump_rules_version(sender, **kwargs):
+    checkpoint, _ = Checkpoint.objects.get_or_create(name=VERSION_CHECKPOINT)
+    Checkpoint.objects.filter(pk=checkpoint.pk).update(position=F('position') + 1)
+
+
+def _profiles(user_ids):
+    """user id -> (role, normalized organization), read from the default database"""
+    return {
+        user_id: (role, _organization(organization))
+        for user_id, role, organization in UserProfile.objects.filter(user_id__in=user_ids)
+        .values_list('user_id', 'role', 'organization')
+    }
+
+
+def decide(rows, matcher, now=None):
+    """rows of (id, sender_id, receiver_id, timestamp, size) -> {(action, rule): [ids]}"""
+    now = now or timezone.now()
+    profiles = _profiles({row[1] for row in rows} | {row[2] for row in rows})
+    decisions = defaultdict(list)
+    for message_id, sender_id, receiver_id, timestamp, size in rows:
+        sender_role, sender_organization = profiles.get(sender_id, ('', ''))
+        receiver_role, receiver_organization = profiles.get(receiver_id, ('', ''))
+        rule = matcher.match(MessageFacts(
+            sender_id, receiver_id, sender_role, receiver_role,
+            sender_organization, receiver_organization, size or 0, now - timestamp,
+        ))
+        if rule is not None:
+            decisions[rule].append(message_id)
+    return decisions
+
+
+def _sent_rows(alias):
+    return (
+        Message.objects.using(alias).filter(status='SENT')
+        .annotate(size=Length('encrypted_content'))
+        .order_by('id')
+        .values_list('id', 'sender_id', 'receiver_id', 'timestamp', 'size')
+    )
+
+
+def _apply(alias, rows, matcher, totals, dry_run=False):
+    for rule, message_ids in decide(rows, matcher).items():
+        if not dry_run:
+            status, log_type = ACTION_TRANSITIONS[rule.action]
+            message_ids = transition_messages(
+                alias, message_ids, 'SENT', status, log_type,
+                notes=f'Auto-routed by rule #{rule.id} ({rule.name})',
+                rule_id=rule.id,
+            )
+        totals[(rule.id, rule.action)] += len(message_ids)
+    return totals
+
+
+def route_pending_messages(batch_size=500, dry_run=False):
+    """Apply the rules to every SENT message; returns {(rule id, action): count}"""
+    totals = defaultdict(int)
+    for alias in message_aliases():
+        after = 0
+        while True:
+            matcher = get_matcher()
+            if not matcher:
+                return dict(totals)
+            rows = list(_sent_rows(alias).filter(id__gt=after)[:batch_size])
+            if not rows:
+                break
+            after = rows[-1][0]
+            _apply(alias, rows, matcher, totals, dry_run)
+    return dict(totals)
+
+
+def route_messages_now(alias, message_ids):
+    """Apply the rules to specific SENT messages on one database (e.g. just after sending)"""
+    matcher = get_matcher()
+    if not matcher:
+        return {}
+    return dict(_apply(alias, list(_sent_rows(alias).filter(id__in=message_ids)), matcher, defaultdict(int)))
@@ -0,0 +1,315 @@
+"""
+Horizontal sharding of messages by receiver.
+
+When MESSAGE_SHARDS lists database aliases, Message, MessageLog and
+Certificate rows live on the shard chosen by a stable hash of the message's
+receiver_id. A receiver's inbox is therefore a single-shard query, while
+sender- and status-driven listings (outbox, router and CA queues) are
+scatter-gathered across every shard and merged in order.
+
+Users are mirrored onto every shard so foreign keys and select_related keep
+working, and each shard allocates ids from its own range (shard index <<
+ID_SHARD_BITS), so ids are unique across shards and a message id usually
+names its shard. With MESSAGE_SHARDS empty every helper degrades to the
+plain default queryset and routing is left to the other routers.
+"""
+import hashlib
+import heapq
+import logging
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from django.http import Http404
+
+
+logger = logging.getLogger(__name__)
+
+SHARDED_MODELS = {'message', 'messagelog', 'certificate'}
+ID_SHARD_BITS = 40
+
+
+def shard_aliases():
+    return list(getattr(settings, 'MESSAGE_SHARDS', []))
+
+
+def sharding_enabled():
+    return bool(shard_aliases())
+
+
+def message_aliases():
+    """Aliases holding messages; [None] (router's choice) when sharding is off"""
+    return shard_aliases() or [None]
+
+
+def _stable_hash(value):
+    digest = hashlib.blake2b(str(value).encode('ascii'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def shard_for_receiver(receiver_id, aliases=None):
+    """Alias owning a receiver's messages, or None when sharding is off"""
+    aliases = shard_aliases() if aliases is None else aliases
+    if not aliases:
+        return None
+    return aliases[_stable_hash(receiver_id) % len(aliases)]
+
+
+def home_shard_for_id(message_id):
+    """Shard that allocated a message id, or None"""
+    aliases = shard_aliases()
+    index = message_id >> ID_SHARD_BITS
+    if aliases and index < len(aliases):
+        return aliases[index]
+    return None
+
+
+def _is_sharded(model):
+    return model._meta.app_label == 'app' and model._meta.model_name in SHARDED_MODELS
+
+
+def _message_db(message):
+    if message._state.db and not message._state.adding:
+        return message._state.db
+    return shard_for_receiver(message.receiver_id)
+
+
+def db_for_instance(instance):
+    """Shard a sharded-model instance belongs on"""
+    from .models import Message
+
+    if isinstance(instance, Message):
+        return _message_db(instance)
+    if instance._state.db and not instance._state.adding:
+        return instance._state.db
+    descriptor = type(instance).message
+    if descriptor.is_cached(instance):
+        return _message_db(instance.message)
+    return None
+
+
+class ShardRouter:
+    """Place Message, MessageLog and Certificate rows on receiver-hashed shards"""
+
+    def _route(self, model, hints):
+        if not sharding_enabled() or not _is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and _is_sharded(instance.__class__):  # Not type(): may be a lazy user
+            return db_for_instance(instance)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Users are mirrored onto every shard
+        if sharding_enabled() and (isinstance(obj1, User) or isinstance(obj2, User)):
+            return True
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Query helpers
+# ---------------------------------------------------------------------------
+
+class MergedQuerySet:
+    """Read-only, ordered union of one queryset per shard (paginator compatible)"""
+
+    def __init__(self, querysets, order_field, descending=True):
+        self.querysets = querysets
+        self.order_field = order_field
+        self.descending = descending
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(queryset.count() for queryset in self.querysets)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return any(queryset.exists() for queryset in self.querysets)
+
+    def _merge(self, stop):
+        parts = [list(queryset[:stop]) if stop is not None else list(queryset) for queryset in self.querysets]
+        return heapq.merge(*parts, key=attrgetter(self.order_field), reverse=self.descending)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            merged = self._merge(stop)
+            return [row for index, row in enumerate(merged) if index >= start and (stop is None or index < stop)]
+        rows = self[key:key + 1]
+        if not rows:
+            raise IndexError(key)
+        return rows[0]
+
+    def __iter__(self):
+        return iter(self._merge(None))
+
+    async def acount(self):
+        if self._count is None:
+            total = 0
+            for queryset in self.querysets:
+                total += await queryset.acount()
+            self._count = total
+        return self._count
+
+    async def aslice(self, start, stop):
+        """self[start:stop] for async views"""
+        parts = []
+        for queryset in self.querysets:
+            parts.append([row async for row in queryset[:stop]])
+        merged = heapq.merge(*parts, key=attrgetter(self.order_field), reverse=self.descending)
+        return list(islice(merged, start, stop))
+
+
+def receiver_messages(receiver_id):
+    """Message queryset on the single shard holding a receiver's mail"""
+    from .models import Message
+
+    return Message.objects.using(shard_for_receiver(receiver_id))
+
+
+def scatter(build, order_field='timestamp', descending=True):
+    """Apply `build` to Message.objects on every shard and merge the results
+
+    With sharding off this is just ``build(Message.objects.all())``.
+    """
+    from .models import Message
+
+    if not sharding_enabled():
+        return build(Message.objects.all())
+    return MergedQuerySet(
+        [build(Message.objects.using(alias)) for alias in shard_aliases()],
+        order_field,
+        descending,
+    )
+
+
+def scatter_count(build):
+    """Sum of build(queryset).count() across shards"""
+    from .models import Message
+
+    return sum(build(Message.objects.using(alias)).count() for alias in message_aliases())
+
+
+async def ascatter_count(build):
+    """scatter_count() for async views"""
+    from .models import Message
+
+    total = 0
+    for alias in message_aliases():
+        total += await build(Message.objects.using(alias)).acount()
+    return total
+
+
+def aliases_for_id(row_id):
+    """Message aliases to search for a sharded row, its home shard first"""
+    aliases = message_aliases()
+    home = home_shard_for_id(row_id)
+    if home:
+        aliases = [home] + [alias for alias in aliases if alias != home]
+    return aliases
+
+
+def get_message_or_404(queryset, message_id, **filters):
+    """Fetch a message by id, trying its home shard before the others"""
+    for alias in aliases_for_id(message_id):
+        message = queryset.using(alias).filter(id=message_id, **filters).first()
+        if message is not None:
+            return message
+    raise Http404('No Message matches the given query.')
+
+
+async def aget_message_or_404(queryset, message_id, **filters):
+    """get_message_or_404() for async views"""
+    for alias in aliases_for_id(message_id):
+        message = await queryset.using(alias).filter(id=message_id, **filters).afirst()
+        if message is not None:
+            return message
+    raise Http404('No Message matches the given query.')
+
+
+# ---------------------------------------------------------------------------
+# Shard maintenance
+# ---------------------------------------------------------------------------
+
+def _user_values(user, fields=None):
+    return {
+        field.attname: getattr(user, field.attname)
+        for field in User._meta.concrete_fields
+        if not field.primary_key and (fields is None or field.name in fields)
+    }
+
+
+def mirror_users(users, aliases=None, created=False, update_fields=None):
+    """Copy users onto every shard so foreign keys resolve there"""
+    for alias in aliases or shard_aliases():
+        missing = users if created else [
+            user for user in users
+            if not User.objects.using(alias).filter(pk=user.pk).update(**_user_values(user, update_fields))
+        ]
+        if missing:
+            User.objects.using(alias).bulk_create(
+                [User(pk=user.pk, **_user_values(user)) for user in missing], ignore_conflicts=True
+            )
+
+
+@receiver(post_save, sender=User)
+def mirror_user_on_save(sender, instance, using, created=False, update_fields=None, raw=False, **kwargs):
+    if raw or using in shard_aliases():
+        return
+    # Shards only need users for foreign keys; skip login bookkeeping
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    mirror_users([instance], created=created, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=User)
+def mirror_user_on_delete(sender, instance, using, **kwargs):
+    if using in shard_aliases():
+        return
+    for alias in shard_aliases():
+        User.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def reserve_shard_id_range(sender, using, **kwargs):
+    """Start each shard's ids at its own range so ids stay unique across shards"""
+    if sender.label != 'app' or using not in shard_aliases():
+        return
+    offset = shard_aliases().index(using) << ID_SHARD_BITS
+    if not offset:
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for model in sender.get_models():
+            if model._meta.model_name not in SHARDED_MODELS:
+                continue
+            table = model._meta.db_table
+            if connection.vendor == 'sqlite':
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, offset])
+                elif row[0] < offset:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [offset, table])
+            elif connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    f'GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)})))',
+                    [table, offset],
+                )
+            else:
+                logger.warning('Cannot reserve an id range for %s on %s (%s)', table, using, connection.vendor)
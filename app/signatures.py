@@ -0,0 +1,100 @@
+"""
+Ed25519 signatures over messages.
+
+The Cloud Authority certifies a message by signing its canonical digest:
+SHA-256 over a versioned, newline-separated encoding of the message id,
+sender id, receiver id and the SHA-256 of its ciphertext, so the
+certificate covers exactly who sent what to whom. A certificate is the
+text ``ed25519:<key id>:<base64 signature>``, where the key id is the
+first 16 hex digits of the SHA-256 of the raw public key; verifiers pick
+the public key by id, so certificates survive a CA key rotation as long as
+the old public key stays trusted. Anything else in a certificate field
+(free text typed before signatures existed) is reported as unsigned.
+
+Like app/audit.py this module has no Django imports, so verify_batch() can
+run in a process pool, and ``cryptography`` is imported on first use.
+Parsed public keys are cached per process.
+"""
+import base64
+import binascii
+import hashlib
+from functools import lru_cache
+
+
+SCHEME = 'ed25519'
+DIGEST_VERSION = b'securemessenger-certificate-v1'
+
+VALID = 'valid'
+INVALID = 'invalid'
+UNSIGNED = 'unsigned'
+UNKNOWN_KEY = 'unknown_key'
+
+
+def message_digest(message_id, sender_id, receiver_id, ciphertext):
+    """The 32-byte digest a certificate signs"""
+    ciphertext_hash = hashlib.sha256(ciphertext.encode('ascii')).hexdigest()
+    canonical = b'\n'.join([
+        DIGEST_VERSION,
+        str(message_id).encode('ascii'),
+        str(sender_id).encode('ascii'),
+        str(receiver_id).encode('ascii'),
+        ciphertext_hash.encode('ascii'),
+    ])
+    return hashlib.sha256(canonical).digest()
+
+
+def key_id(public_bytes):
+    return hashlib.sha256(public_bytes).hexdigest()[:16]
+
+
+def public_bytes(private_key):
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    return private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def sign(private_key, digest, signer_key_id):
+    """Certificate text for `digest`"""
+    signature = base64.b64encode(private_key.sign(digest)).decode('ascii')
+    return f'{SCHEME}:{signer_key_id}:{signature}'
+
+
+def parse(certificate):
+    """(key id, signature bytes), or None for anything that is not a signed certificate"""
+    parts = (certificate or '').split(':')
+    if len(parts) != 3 or parts[0] != SCHEME:
+        return None
+    try:
+        return parts[1], base64.b64decode(parts[2], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+@lru_cache(maxsize=16)
+def _public_key(raw):
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    return Ed25519PublicKey.from_public_bytes(raw)
+
+
+def verify(public_keys, digest, certificate):
+    """VALID, INVALID, UNSIGNED or UNKNOWN_KEY; `public_keys` maps key id to raw public key"""
+    from cryptography.exceptions import InvalidSignature
+
+    parsed = parse(certificate)
+    if parsed is None:
+        return UNSIGNED
+    signer, signature = parsed
+    if signer not in public_keys:
+        return UNKNOWN_KEY
+    try:
+        _public_key(public_keys[signer]).verify(signature, digest)
+    except InvalidSignature:
+        return INVALID
+    return VALID
+
+
+def verify_batch(public_keys, items):
+    """[(message id, status)] for items of (message id, sender id, receiver id, ciphertext, certificate)"""
+    return [
+        (message_id, verify(public_keys, message_digest(message_id, sender_id, receiver_id, ciphertext), certificate))
+        for message_id, sender_id, receiver_id, ciphertext, certificate in items
+    ]
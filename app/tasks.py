@@ -0,0 +1,58 @@
+"""
+Job handlers for work moved out of the request cycle (see app/jobs.py).
+
+Handlers may run more than once (a retry after a partial failure, or a lease
+that expired under a slow worker), so each one checks the message's current
+state before acting.
+"""
+from django.contrib.auth.models import User
+from django.http import Http404
+
+from .admission import ACCEPT, admission_settings, backlog_action
+from .jobs import enqueue, job
+from .lifecycle import certify_messages, transition_messages
+from .models import Message
+from .routing import route_messages_now
+from .sharding import get_message_or_404
+
+
+def _find_message(message_id, **filters):
+    try:
+        return get_message_or_404(Message.objects.all(), message_id, **filters)
+    except Http404:
+        return None
+
+
+@job('route_message')
+def route_message(message_id):
+    """Give the routing rules a first look at a newly sent message"""
+    message = _find_message(message_id, status='SENT')
+    if message is not None:
+        route_messages_now(message._state.db, [message.id])
+
+
+@job('release_message')
+def release_message(message_id, actor_id):
+    """Send a message admission control queued, once the backlog has room for it"""
+    message = _find_message(message_id, status='QUEUED')
+    if message is None:
+        return
+    if backlog_action()[0] != ACCEPT:
+        enqueue(
+            'release_message', {'message_id': message_id, 'actor_id': actor_id},
+            priority=50, delay=admission_settings()['RELEASE_DELAY'],
+        )
+        return
+    alias = message._state.db
+    if transition_messages(alias, [message.id], 'QUEUED', 'SENT', 'SEND', actor=message.sender,
+                           notes='User sent message (released from the admission queue)'):
+        route_messages_now(alias, [message.id])
+
+
+@job('issue_certificate')
+def issue_certificate(message_id, actor_id, valid_days=365, notes=''):
+    """Sign and issue the CA certificate for a router-accepted message"""
+    message = _find_message(message_id, status='ROUTER_ACCEPTED')
+    if message is None:
+        return  # Already certified (or no longer awaiting a certificate)
+    certify_messages(message._state.db, [message.id], User(pk=actor_id), valid_days=valid_days, notes=notes)
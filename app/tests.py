@@ -1,3 +1,1385 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import previews, receipts, routing, urls as app_urls
+from .admission import _take
+from .analytics import refresh_lifecycle_stats
+from .certificates import (
+    _load_signing_key, certificate_validity, expire_certificates, signing_key, verify_certificates,
+)
+from .ciphers import CIPHER_BACKENDS, DecryptionError, backend_for_token
+from .changes import next_change
+from .conversations import PAGE_SIZE, conversation_for, conversation_page, decode_cursor, record_message, thread_page
+from .database import retry_on_lock
+from .jobs import JOB_HANDLERS, claim_jobs, enqueue, job_settings, retry_dead_jobs, run_job
+from .lifecycle import certify_messages, transition_messages
+from .models import (
+    AuditCheckpoint, Certificate, Checkpoint, ConversationMember, Job, LifecycleStat, Message, MessageLog, RoutingRule,
+    UserProfile, UserRole,
+)
+from .profiling import SamplingProfilerMiddleware, issue_profile_token
+from .query_budget import budget_for
+from .replicas import HEARTBEAT_NAME, PIN_COOKIE
+from .roles import ProfileBackend, check_role_cache
+from .sharding import message_aliases, scatter, scatter_count, shard_aliases, shard_for_receiver
+from .tasks import release_message
+
+
+def create_user(username, role):
+    user = User.objects.create_user(username=username, password='Password1')
+    UserProfile.objects.create(user=user, role=role)
+    return user
+
+
+def create_message(sender, receiver, status='SENT', content='Hello there'):
+    message = Message(sender=sender, receiver=receiver, subject='Subject', status=status)
+    message.encrypt_content(content)
+    message.conversation_id = conversation_for(sender.id, receiver.id).id
+    message.save()
+    record_message(message.conversation_id, message)
+    message.logs.create(actor=sender, log_type='SEND', notes='User sent message')
+    return message
+
+
+def use_test_ca_key(test_class):
+    """Sign certificates with a throwaway CA key file for the whole class (outside DEBUG one is required)"""
+    key_dir = test_class.enterClassContext(tempfile.TemporaryDirectory())
+    test_class.key_file = os.path.join(key_dir, 'ca.pem')
+    call_command('ca_keygen', test_class.key_file, stdout=io.StringIO())
+    test_class.enterClassContext(override_settings(CA_SIGNING={'PRIVATE_KEY_FILE': test_class.key_file}))
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': True, 'STRICT': True}, READ_RECEIPTS={'MAX_DELAY': 0})
+class QueryBudgetTests(TestCase):
+    """Every URL in app/urls.py stays within its declared query budget"""
+    # Not '__all__': a replica is a TEST mirror of default and must not be opened as a second connection
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        use_test_ca_key(cls)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.router = create_user('router', UserRole.ROUTER)
+        cls.ca = create_user('authority', UserRole.CLOUD_AUTHORITY)
+        cls.publisher = create_user('publisher', UserRole.PUBLISHER)
+        cls.seed_messages(3)
+
+    def setUp(self):
+        # Receipts are buffered per process: never leave this test database's ids behind
+        receipts.clear()
+        self.addCleanup(receipts.clear)
+
+    @classmethod
+    def seed_messages(cls, count):
+        for _ in range(count):
+            create_message(cls.alice, cls.bob, status='SENT')
+            create_message(cls.bob, cls.alice, status='ROUTER_ACCEPTED')
+            create_message(cls.publisher, cls.bob, status='CERTIFICATE_CREATED')
+
+    def sent_message(self):
+        return scatter(lambda messages: messages.filter(sender=self.alice, status='SENT'))[0]
+
+    def accepted_message(self):
+        return scatter(lambda messages: messages.filter(status='ROUTER_ACCEPTED'))[0]
+
+    def get_cases(self):
+        """url name -> list of (user, kwargs)"""
+        sent = self.sent_message()
+        return {
+            'home': [(None, {})],
+            'register': [(None, {})],
+            'login': [(None, {})],
+            'logout': [(self.alice, {})],
+            'dashboard': [(self.alice, {}), (self.router, {}), (self.ca, {}), (self.publisher, {})],
+            'send_message': [(self.alice, {})],
+            'inbox': [(self.bob, {})],
+            'outbox': [(self.alice, {})],
+            'view_message': [(self.bob, {'message_id': sent.id})],
+            'conversations': [(self.bob, {})],
+            'conversation_thread': [(self.bob, {'conversation_id': sent.conversation_id})],
+            'router_accept': [(self.router, {'message_id': sent.id})],
+            'ca_create_certificate': [(self.ca, {'message_id': self.accepted_message().id})],
+            'api_message_status': [(self.alice, {'message_id': sent.id})],
+            'api_user_stats': [(self.alice, {}), (self.router, {})],
+            'api_lifecycle_stats': [(self.ca, {})],
+            'api_verify_certificates': [(self.alice, {}), (self.ca, {})],
+            'api_sync': [(self.alice, {})],
+        }
+
+    def request(self, user, name, kwargs, data=None):
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+        url = reverse(name, kwargs=kwargs)
+        if data is None:
+            return self.client.get(url)
+        return self.client.post(url, data)
+
+    def test_every_view_declares_a_budget(self):
+        for pattern in app_urls.urlpatterns:
+            with self.subTest(view=pattern.name):
+                self.assertIsNotNone(budget_for(pattern.callback), f'{pattern.name} has no query budget')
+
+    def test_every_url_within_budget(self):
+        cases = self.get_cases()
+        self.assertEqual(set(cases), {pattern.name for pattern in app_urls.urlpatterns})
+        for name, requests in cases.items():
+            for user, kwargs in requests:
+                with self.subTest(view=name, user=user and user.username):
+                    response = self.request(user, name, kwargs)
+                    self.assertLess(response.status_code, 400)
+
+    # AsyncClient fires request_finished from another thread, whose connection
+    # cannot write to the test database, so no receipts are buffered here
+    @mock.patch('app.views.mark_read')
+    async def test_async_views_within_budget(self, mark_read):
+        """The async views served natively (AsyncClient runs the middleware in async mode)"""
+        cases = await sync_to_async(self.get_cases)()
+        for name in ('inbox', 'outbox', 'view_message', 'api_message_status', 'api_user_stats'):
+            for user, kwargs in cases[name]:
+                with self.subTest(view=name, user=user.username):
+                    await sync_to_async(self.async_client.force_login)(user)
+                    url = reverse(name, kwargs=kwargs)
+                    response = await self.async_client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    revalidated = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+                    self.assertEqual(revalidated.status_code, 304)
+        self.assertTrue(mark_read.called)
+
+    def test_write_views_within_budget(self):
+        sent = self.sent_message()
+        accepted = self.accepted_message()
+        posts = [
+            (None, 'login', {}, {'username': 'alice', 'password': 'Password1'}),
+            (None, 'register', {}, {
+                'username': 'carol', 'email': 'carol@example.com', 'first_name': 'Carol',
+                'last_name': 'Smith', 'password': 'Password1', 'password_confirm': 'Password1',
+                'role': UserRole.USER,
+            }),
+            (self.alice, 'send_message', {}, {'receiver': self.bob.id, 'subject': 'Hi', 'content': 'Hello'}),
+            (self.router, 'router_accept', {'message_id': sent.id}, {}),
+            (self.ca, 'ca_create_certificate', {'message_id': accepted.id}, {'notes': 'Looks fine'}),
+        ]
+        for user, name, kwargs, data in posts:
+            with self.subTest(view=name):
+                response = self.request(user, name, kwargs, data)
+                self.assertEqual(response.status_code, 302)
+
+    def test_list_views_constant_as_data_grows(self):
+        cases = [
+            (self.bob, 'inbox'),
+            (self.alice, 'outbox'),
+            (self.bob, 'conversations'),
+            (self.alice, 'dashboard'),
+            (self.bob, 'dashboard'),
+            (self.router, 'dashboard'),
+            (self.ca, 'dashboard'),
+            (self.publisher, 'dashboard'),
+        ]
+
+        # The list views scatter over the shards: count the queries on each of them
+        aliases = sorted({'default', *(alias or 'default' for alias in message_aliases())})
+
+        def count_queries():
+            counts = []
+            for user, name in cases:
+                self.client.force_login(user)
+                with ExitStack() as stack:
+                    queries = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in aliases]
+                    self.client.get(reverse(name))
+                counts.append([len(captured) for captured in queries])
+            return counts
+
+        before = count_queries()
+        self.seed_messages(10)
+        self.assertEqual(count_queries(), before)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class JobQueueTests(TestCase):
+    """Sending, leases, retries and dead-lettering of background jobs"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+
+    def failing_job(self, **fields):
+        handlers = mock.patch.dict(JOB_HANDLERS, {'explode': mock.Mock(side_effect=RuntimeError('boom'))})
+        handlers.start()
+        self.addCleanup(handlers.stop)
+        return enqueue('explode', **fields)
+
+    def test_send_logs_in_the_request_and_queues_only_routing(self):
+        self.client.force_login(self.alice)
+        self.client.post(reverse('send_message'), {'receiver': self.bob.id, 'subject': 'Hi', 'content': 'Hello'})
+        message = scatter(lambda messages: messages.filter(sender=self.alice))[0]
+        self.assertEqual(list(message.logs.values_list('log_type', flat=True)), ['SEND'])
+        self.assertEqual(
+            list(Job.objects.values_list('kind', 'payload')), [('route_message', {'message_id': message.id})],
+        )
+
+    def test_expired_lease_is_claimed_again(self):
+        queued = self.failing_job()
+        self.assertEqual([claimed.id for claimed in claim_jobs('first', 10)], [queued.id])
+        self.assertEqual(claim_jobs('second', 10), [])
+
+        lease = job_settings()['LEASE_SECONDS']
+        Job.objects.filter(id=queued.id).update(locked_at=timezone.now() - timedelta(seconds=lease + 1))
+        reclaimed = claim_jobs('second', 10)
+        self.assertEqual([(claimed.id, claimed.attempts) for claimed in reclaimed], [(queued.id, 2)])
+        self.assertTrue(reclaimed[0].locked_by.startswith('second:'))
+
+    @override_settings(JOB_QUEUE={'BACKOFF_SECONDS': 10})
+    def test_failures_back_off_then_go_dead(self):
+        queued = self.failing_job(max_attempts=2)
+        started = timezone.now()
+        self.assertFalse(run_job(claim_jobs('worker', 1)[0]))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.locked_by), (Job.QUEUED, 1, ''))
+        self.assertGreaterEqual(queued.run_at, started + timedelta(seconds=5))
+        self.assertLessEqual(queued.run_at, timezone.now() + timedelta(seconds=10))
+        self.assertEqual(claim_jobs('worker', 1), [])  # Not due until the backoff passes
+
+        Job.objects.filter(id=queued.id).update(run_at=timezone.now())
+        with self.assertLogs('app.jobs', 'ERROR'):
+            self.assertFalse(run_job(claim_jobs('worker', 1)[0]))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.DEAD, 2))
+        self.assertIn('RuntimeError: boom', queued.last_error)
+        self.assertEqual(claim_jobs('worker', 1), [])
+
+        self.assertEqual(retry_dead_jobs('explode'), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.QUEUED, 0))
+
+    @mock.patch('app.management.commands.worker.signal.signal')
+    def test_burst_worker_fails_on_database_errors(self, install):
+        with mock.patch('app.management.commands.worker.work', side_effect=OperationalError('disk I/O error')) as work:
+            with self.assertRaisesMessage(CommandError, 'disk I/O error'):
+                call_command('worker', burst=True, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(work.call_count, 1)
+
+    @mock.patch('app.management.commands.worker.signal.signal')
+    def test_supervisor_forwards_sigterm_to_its_workers(self, install):
+        children = [mock.Mock(returncode=0) for _ in range(2)]
+        for child in children:
+            child.poll.return_value = None
+            child.terminate.side_effect = lambda child=child: setattr(child.poll, 'return_value', 0)
+
+        def sigterm_while_waiting():
+            handlers = {call.args[0]: call.args[1] for call in install.call_args_list}
+            self.assertIs(handlers[signal.SIGINT], handlers[signal.SIGTERM])
+            handlers[signal.SIGTERM](signal.SIGTERM, None)
+
+        children[0].wait.side_effect = sigterm_while_waiting
+        with mock.patch('app.management.commands.worker.subprocess.Popen', side_effect=children):
+            call_command('worker', processes=2, stdout=io.StringIO())
+        for child in children:
+            child.terminate.assert_called_once()  # Forwarded, not again on the way out
+            child.wait.assert_called()
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class AdmissionTests(TestCase):
+    """Rate limits, the 429 path and deferred sending"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        create_message(cls.bob, cls.alice, status='SENT')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def send(self):
+        return self.client.post(reverse('send_message'), {'receiver': self.bob.id, 'subject': 'Hi', 'content': 'Hello'})
+
+    def sent_by_alice(self):
+        return scatter(lambda messages: messages.filter(sender=self.alice))
+
+    @override_settings(ADMISSION_CONTROL={'USER_RATE': 0.5, 'USER_BURST': 1})
+    def test_empty_bucket_answers_429_with_retry_after(self):
+        self.assertEqual(self.send().status_code, 302)
+        response = self.send()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+        self.assertEqual(len(self.sent_by_alice()), 1)
+
+    def test_concurrent_takes_admit_exactly_the_burst(self):
+        now = int(time.time() * 1000)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            waits = list(pool.map(lambda _: _take('admission:test', 0.01, 5, now), range(40)))
+        self.assertEqual(waits.count(0), 5)
+
+    @override_settings(ADMISSION_CONTROL={'QUEUE_LIMITS': {'SENT': {'DEFER': 1, 'REJECT': 100}}})
+    def test_deferred_message_is_queued_then_released(self):
+        self.assertRedirects(self.send(), reverse('outbox'), fetch_redirect_response=False)
+        message = self.sent_by_alice()[0]
+        self.assertEqual((message.status, message.logs.count()), ('QUEUED', 0))
+        release = Job.objects.get(kind='release_message')
+        self.assertEqual(release.payload, {'message_id': message.id, 'actor_id': self.alice.id})
+
+        # Still over the limit: put back on the queue
+        release_message(**release.payload)
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'QUEUED')
+        self.assertEqual(Job.objects.filter(kind='release_message').count(), 2)
+
+        cache.clear()
+        with override_settings(ADMISSION_CONTROL={}):
+            release_message(**release.payload)
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'SENT')
+        self.assertEqual(list(message.logs.values_list('log_type', flat=True)), ['SEND'])
+
+
+@override_settings(
+    QUERY_BUDGET={'ENABLED': False},
+    DATABASE_REPLICA={'ALIAS': 'test_replica', 'LAG_CHECK_INTERVAL': 0, 'MAX_LAG_SECONDS': 10},
+)
+class ReplicaTests(TransactionTestCase):
+    """@read_only views on a second SQLite file kept in step by sync_replica"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test case has set up its databases, so the replica is a plain second file
+        # (under its own alias: SECUREMESSENGER_REPLICA_DB makes 'replica' a mirror of default in tests)
+        replica_dir = cls.enterClassContext(tempfile.TemporaryDirectory())
+        replica = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(replica_dir, 'replica.sqlite3')}
+        connections.configure_settings({'default': connections.settings['default'], 'test_replica': replica})
+        cls.enterClassContext(mock.patch.dict(settings.DATABASES, {'test_replica': replica}))
+        cls.addClassCleanup(connections.__delitem__, 'test_replica')
+        cls.addClassCleanup(lambda: connections['test_replica'].close())
+
+    def setUp(self):
+        self.alice = create_user('alice', UserRole.USER)
+        self.bob = create_user('bob', UserRole.USER)
+        self.carol = create_user('carol', UserRole.USER)
+        create_message(self.alice, self.bob)
+        call_command('sync_replica', stdout=io.StringIO())
+        # Written after the copy, so only the primary has carol's conversation with bob
+        self.client.force_login(self.carol)
+        self.client.post(reverse('send_message'), {'receiver': self.bob.id, 'subject': 'Hi', 'content': 'Hello'})
+
+    def peers(self, client):
+        with CaptureQueriesContext(connections['test_replica']) as replica_queries:
+            response = client.get(reverse('conversations'))
+        # Not counting the middleware's heartbeat check
+        served = [query for query in replica_queries if 'app_checkpoint' not in query['sql']]
+        return {membership.peer.username for membership in response.context['memberships']}, len(served)
+
+    def client_for(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def test_reads_use_the_replica(self):
+        peers, replica_queries = self.peers(self.client_for(self.bob))
+        self.assertEqual(peers, {'alice'})  # The replica has not seen carol's message yet
+        self.assertGreater(replica_queries, 0)
+
+    def test_writer_is_pinned_to_the_primary(self):
+        self.assertIn(PIN_COOKIE, self.client.cookies)
+        self.assertEqual(self.peers(self.client), ({'bob'}, 0))
+
+        with override_settings(DATABASE_REPLICA={'ALIAS': 'test_replica', 'STICKY_SECONDS': 0, 'LAG_CHECK_INTERVAL': 0}):
+            time.sleep(1)
+            peers, replica_queries = self.peers(self.client)
+        self.assertEqual(peers, set())
+        self.assertGreater(replica_queries, 0)
+
+    def test_lagging_replica_is_skipped(self):
+        stale = timezone.now() - timedelta(seconds=60)
+        Checkpoint.objects.using('test_replica').filter(name=HEARTBEAT_NAME).update(updated_at=stale)
+        self.assertEqual(self.peers(self.client_for(self.bob)), ({'alice', 'carol'}, 0))
+
+        call_command('sync_replica', stdout=io.StringIO())
+        peers, replica_queries = self.peers(self.client_for(self.bob))
+        self.assertEqual(peers, {'alice', 'carol'})
+        self.assertGreater(replica_queries, 0)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class RoutingRuleTests(TestCase):
+    """Which rule the matcher picks, and what route_messages does with it"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.PUBLISHER)
+        cls.carol = create_user('carol', UserRole.USER)
+
+    def setUp(self):
+        # The version counter rolls back with each test, so forget the compiled matcher
+        matcher = mock.patch.dict(routing._matcher, {'version': None, 'matcher': None})
+        matcher.start()
+        self.addCleanup(matcher.stop)
+
+    def rule(self, action='ACCEPT', **conditions):
+        return RoutingRule.objects.create(name=f'rule {action}', action=action, **conditions)
+
+    def facts(self, **overrides):
+        facts = {
+            'sender_id': self.alice.id, 'receiver_id': self.bob.id,
+            'sender_role': UserRole.USER, 'receiver_role': UserRole.PUBLISHER,
+            'sender_organization': 'acme', 'receiver_organization': 'globex',
+            'size': 100, 'age': timedelta(minutes=5),
+        }
+        facts.update(overrides)
+        return routing.MessageFacts(**facts)
+
+    def test_each_condition_must_hold(self):
+        cases = [
+            ({'sender': self.alice}, {'sender_id': self.carol.id}),
+            ({'receiver': self.bob}, {'receiver_id': self.carol.id}),
+            ({'sender_role': UserRole.USER}, {'sender_role': UserRole.ROUTER}),
+            ({'receiver_role': UserRole.PUBLISHER}, {'receiver_role': UserRole.USER}),
+            ({'sender_organization': ' ACME '}, {'sender_organization': 'globex'}),
+            ({'receiver_organization': 'Globex'}, {'receiver_organization': ''}),
+            ({'min_size': 50, 'max_size': 100}, {'size': 101}),
+            ({'min_size': 100}, {'size': 99}),
+            ({'min_age': timedelta(minutes=1), 'max_age': timedelta(minutes=5)}, {'age': timedelta(minutes=6)}),
+            ({'min_age': timedelta(minutes=5)}, {'age': timedelta(seconds=10)}),
+        ]
+        for conditions, miss in cases:
+            with self.subTest(**{name: str(value) for name, value in conditions.items()}):
+                rule = self.rule(**conditions)
+                matcher = routing.RuleMatcher([rule])
+                self.assertEqual(matcher.match(self.facts()).id, rule.id)
+                self.assertIsNone(matcher.match(self.facts(**miss)))
+
+    def test_first_match_by_priority(self):
+        by_sender = self.rule('REJECT', sender=self.alice, priority=50)
+        by_receiver = self.rule('ACCEPT', receiver=self.bob, priority=10)
+        large = self.rule('REJECT', min_size=1000, priority=5)
+        self.rule('REJECT', receiver=self.bob, priority=10)  # Same priority, created later
+        matcher = routing.RuleMatcher(RoutingRule.objects.all())
+
+        self.assertEqual(matcher.match(self.facts()).id, by_receiver.id)  # Priority, then the lower id
+        self.assertEqual(matcher.match(self.facts(size=5000)).id, large.id)
+        self.assertEqual(matcher.match(self.facts(receiver_id=self.carol.id)).id, by_sender.id)
+        self.assertIsNone(matcher.match(self.facts(sender_id=self.carol.id, receiver_id=self.carol.id)))
+
+    def test_empty_rule_matches_everything(self):
+        catch_all = self.rule('REJECT')
+        matcher = routing.RuleMatcher([catch_all])
+        for facts in (self.facts(), self.facts(sender_id=self.carol.id, sender_role='', size=0, age=timedelta())):
+            self.assertEqual(matcher.match(facts).id, catch_all.id)
+
+    def test_disabled_rules_are_skipped(self):
+        self.rule('REJECT', sender=self.alice, priority=1, enabled=False)
+        self.assertFalse(routing.get_matcher())
+        catch_all = self.rule('ACCEPT')  # Saving a rule bumps the version, so this is seen at once
+        self.assertEqual([rule.id for rule in routing.get_matcher().unindexed], [catch_all.id])
+        self.assertEqual(routing.get_matcher().match(self.facts()).action, 'ACCEPT')
+
+    def test_route_messages_applies_the_first_match(self):
+        rejected = create_message(self.alice, self.bob)
+        accepted = create_message(self.carol, self.bob)
+        self.rule('REJECT', sender=self.alice, priority=1)
+        catch_all = self.rule('ACCEPT')
+
+        call_command('route_messages', stdout=io.StringIO())
+        rejected.refresh_from_db()
+        accepted.refresh_from_db()
+        self.assertEqual(rejected.status, 'REJECTED')
+        self.assertEqual(accepted.status, 'ROUTER_ACCEPTED')
+        log = accepted.logs.get(log_type='ACCEPT')
+        self.assertEqual(log.notes, f'Auto-routed by rule #{catch_all.id} (rule ACCEPT)')
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class AuditLogTests(TestCase):
+    """verify_audit_log finds edited history and forged checkpoints"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.message = create_message(cls.alice, cls.bob)
+        cls.message.logs.create(actor=cls.bob, log_type='ACCEPT', notes='Accepted by router')
+        create_message(cls.bob, cls.alice)
+
+    def verify(self, *args):
+        """stderr of a verify_audit_log run, empty when it found nothing"""
+        stderr = io.StringIO()
+        try:
+            call_command('verify_audit_log', '--settle', '0', '--workers', '1', *args, stdout=io.StringIO(), stderr=stderr)
+        except CommandError:
+            self.assertTrue(stderr.getvalue())
+        return stderr.getvalue()
+
+    def logs(self):
+        return MessageLog.objects.using(self.message._state.db).filter(message=self.message).order_by('id')
+
+    def test_untouched_history_verifies_and_is_checkpointed(self):
+        self.assertEqual(self.verify(), '')
+        checkpoints = list(AuditCheckpoint.objects.all())
+        self.assertEqual(sum(checkpoint.entries for checkpoint in checkpoints), 3)
+        self.assertTrue(all(checkpoint.signature_valid() for checkpoint in checkpoints))
+        self.assertEqual(self.verify(), '')
+        self.assertEqual(AuditCheckpoint.objects.count(), len(checkpoints))  # Nothing new to cover
+
+    def test_edited_notes_break_the_chain(self):
+        send, accept = self.logs()
+        self.logs().filter(id=send.id).update(notes='Never sent')
+        self.assertIn(f'log {send.id}: contents do not match its hash', self.verify())
+
+        # Re-hashing the edited entry moves the break to the link after it
+        send.refresh_from_db()
+        self.logs().filter(id=send.id).update(entry_hash=send.digest())
+        problems = self.verify()
+        self.assertIn(f'log {accept.id}: does not link to the previous entry', problems)
+        self.assertNotIn(f'log {send.id}:', problems)
+        self.assertFalse(AuditCheckpoint.objects.exists())
+
+    def test_monitoring_run_exits_on_the_first_problem(self):
+        self.logs().filter(id=self.logs().first().id).update(notes='Never sent')
+        with mock.patch('time.sleep') as sleep, self.assertRaises(CommandError):
+            call_command(
+                'verify_audit_log', '--settle', '0', '--workers', '1', '--interval', '3600',
+                stdout=io.StringIO(), stderr=io.StringIO(),
+            )
+        sleep.assert_not_called()
+
+    def test_edits_behind_a_checkpoint_need_a_full_run(self):
+        self.assertEqual(self.verify(), '')
+        send = self.logs().first()
+        self.logs().filter(id=send.id).update(notes='Never sent')
+        self.assertEqual(self.verify(), '')  # Only entries after the checkpoint are re-hashed
+        self.assertIn(f'log {send.id}: contents do not match its hash', self.verify('--full'))
+
+        # A deleted entry leaves no broken hash behind, but the checkpoint's root no longer adds up
+        self.logs().filter(id=send.id).update(notes=send.notes)
+        self.logs().exclude(id=send.id).delete()
+        self.assertEqual(self.verify(), '')
+        self.assertIn('was edited, deleted or moved', self.verify('--full'))
+
+    def test_forged_checkpoint_fails_its_signature(self):
+        self.assertEqual(self.verify(), '')
+        checkpoint = AuditCheckpoint.objects.order_by('-entries').first()
+        AuditCheckpoint.objects.filter(id=checkpoint.id).update(last_log_id=checkpoint.last_log_id + 100)
+        checkpoint.refresh_from_db()
+        self.assertFalse(checkpoint.signature_valid())
+        self.assertIn(f'checkpoint #{checkpoint.id} has an invalid signature', self.verify())
+
+
+class CipherTests(SimpleTestCase):
+    """Every backend round-trips, and decrypt_prefix() agrees with a full decrypt"""
+    body = ('Zwölf Boxkämpfer jagen Viktor quer über den großen Sylter Deich. ' * 2000).encode('utf-8')
+
+    def test_round_trip_and_prefix(self):
+        for name, backend in CIPHER_BACKENDS.items():
+            with self.subTest(backend=name):
+                key = backend.generate_key()
+                for plaintext in (b'', b'Hello there', self.body):
+                    token = backend.encrypt(key, plaintext)
+                    self.assertIs(backend_for_token(token), backend)
+                    self.assertEqual(backend.decrypt(key, token), plaintext)
+                    for size in (1, 16, 17, 320, len(plaintext) + 100):
+                        self.assertEqual(backend.decrypt_prefix(key, token, size)[:size], plaintext[:size])
+
+    def test_wrong_key_or_edited_token_is_refused(self):
+        for name, backend in CIPHER_BACKENDS.items():
+            with self.subTest(backend=name):
+                key = backend.generate_key()
+                token = backend.encrypt(key, b'Hello there')
+                with self.assertRaises(DecryptionError):
+                    backend.decrypt(backend.generate_key(), token)
+                raw = bytearray(base64.urlsafe_b64decode(token))
+                raw[-1] ^= 1
+                with self.assertRaises(DecryptionError):
+                    backend.decrypt(key, base64.urlsafe_b64encode(bytes(raw)).decode('ascii'))
+        with self.assertRaises(DecryptionError):
+            backend_for_token(base64.urlsafe_b64encode(b'\x7fnot a token').decode('ascii'))
+
+    def test_messages_decrypt_whatever_backend_wrote_them(self):
+        for name in CIPHER_BACKENDS:
+            with self.subTest(backend=name):
+                message = Message()
+                message.encrypt_content('Grüße', backend=name)
+                self.assertIs(backend_for_token(message.encrypted_content), CIPHER_BACKENDS[name])
+                self.assertEqual(message.decrypt_content(), 'Grüße')
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class KeyRotationTests(TestCase):
+    """rotate_message_keys moves messages between backends and resumes from its checkpoint"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+    long_body = 'A long message body. ' * 5000  # Past FULL_DECRYPT_MAX_BYTES, so previews decrypt a prefix
+
+    @classmethod
+    def setUpClass(cls):
+        use_test_ca_key(cls)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.ca = create_user('authority', UserRole.CLOUD_AUTHORITY)
+        cls.short = create_message(cls.alice, cls.bob, status='ROUTER_ACCEPTED', content='Hello there')
+        cls.long = create_message(cls.bob, cls.alice, content=cls.long_body)
+        certify_messages(cls.short._state.db, [cls.short.id], cls.ca)
+
+    def rotate(self, *args):
+        stdout = io.StringIO()
+        call_command('rotate_message_keys', '--workers', '1', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def keys(self):
+        return {message.id: message.encryption_key for message in scatter(lambda messages: messages.all())}
+
+    def test_rotate_then_decrypt_with_every_backend(self):
+        for name in ('aesgcm', 'chacha20', 'fernet'):
+            with self.subTest(backend=name):
+                before = self.keys()
+                self.assertIn('Re-encrypted 2 of 2 messages', self.rotate('--cipher', name, '--run', name))
+                self.assertTrue(all(before[message_id] != key for message_id, key in self.keys().items()))
+
+                for message, body in ((self.short, 'Hello there'), (self.long, self.long_body)):
+                    message.refresh_from_db()
+                    backend = backend_for_token(message.encrypted_content)
+                    self.assertIs(backend, CIPHER_BACKENDS[name])
+                    self.assertEqual(message.decrypt_content(), body)
+                    prefix = backend.decrypt_prefix(message.encryption_key, message.encrypted_content, 40)
+                    self.assertEqual(prefix[:40], body.encode('utf-8')[:40])
+                # The certificate signs the ciphertext, so it was signed again
+                self.assertEqual(verify_certificates([self.short.id]), {self.short.id: 'valid'})
+
+    def test_interrupted_run_resumes_after_its_checkpoint(self):
+        self.rotate('--cipher', 'aesgcm', '--chunk-size', '1')
+        rotated = self.keys()
+        self.assertIn('Re-encrypted 0 of 0 messages', self.rotate('--cipher', 'aesgcm'))
+        self.assertEqual(self.keys(), rotated)
+        self.assertIn('Re-encrypted 2 of 2 messages', self.rotate('--cipher', 'aesgcm', '--restart'))
+
+
+@override_settings(MESSAGE_PREVIEWS={'TIME_BUDGET': 0.05, 'FULL_DECRYPT_MAX_BYTES': 1024})
+class PreviewTests(SimpleTestCase):
+    """Previews that miss the page's time budget or fail to decrypt show as unavailable"""
+
+    def message(self, content):
+        message = Message()
+        message.encrypt_content(content)
+        return message
+
+    def stall(self, stalled_token):
+        """Make the preview of one token wait until the test is over"""
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def preview_text(key, token, *args):
+            if token == stalled_token:
+                released.wait()
+            return original(key, token, *args)
+
+        original = previews.preview_text
+        patcher = mock.patch.object(previews, 'preview_text', preview_text)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_previews_are_cut_to_length(self):
+        short, long = self.message('Hello there'), self.message('Long body ' * 500)
+        previews.attach_previews([short, long])
+        self.assertEqual(short.preview, 'Hello there')
+        self.assertEqual(long.preview, ('Long body ' * 8).rstrip() + '…')  # From the decrypted prefix only
+
+    def test_slow_or_broken_previews_fall_back(self):
+        fast, slow, broken = self.message('Fast'), self.message('Slow'), self.message('Broken')
+        broken.encryption_key = CIPHER_BACKENDS['fernet'].generate_key()
+        self.stall(slow.encrypted_content)
+
+        started = time.perf_counter()
+        previews.attach_previews([fast, slow, broken])
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual((fast.preview, slow.preview, broken.preview), ('Fast', None, None))
+
+    def test_async_views_fall_back_the_same_way(self):
+        fast, slow = self.message('Fast'), self.message('Slow')
+        self.stall(slow.encrypted_content)
+        async_to_sync(previews.aattach_previews)([fast, slow])
+        self.assertEqual((fast.preview, slow.preview), ('Fast', None))
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class CertificateExpiryTests(TestCase):
+    """expire_certificates stamps expired_at once and chains an EXPIRE log"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        use_test_ca_key(cls)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        alice = create_user('alice', UserRole.USER)
+        bob = create_user('bob', UserRole.USER)
+        ca = create_user('authority', UserRole.CLOUD_AUTHORITY)
+        cls.expiring = create_message(alice, bob, status='ROUTER_ACCEPTED')
+        cls.current = create_message(bob, alice, status='ROUTER_ACCEPTED')
+        for message in (cls.expiring, cls.current):
+            certify_messages(message._state.db, [message.id], ca)
+            message.refresh_from_db()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_expired_certificates_are_recorded_once(self):
+        self.assertTrue(certificate_validity(self.expiring)['valid'])  # Now cached
+        valid_until = timezone.now() - timedelta(days=1)
+        Certificate.objects.using(self.expiring._state.db).filter(message=self.expiring).update(valid_until=valid_until)
+
+        self.assertEqual(expire_certificates(), 1)
+        certificate = Certificate.objects.using(self.expiring._state.db).get(message=self.expiring)
+        self.assertIsNotNone(certificate.expired_at)
+        self.assertIsNone(Certificate.objects.using(self.current._state.db).get(message=self.current).expired_at)
+        self.assertFalse(certificate_validity(self.expiring)['valid'])  # The cached entry was dropped
+        self.assertTrue(certificate_validity(self.current)['valid'])
+
+        *history, expire = self.expiring.logs.order_by('id')
+        self.assertEqual(expire.log_type, 'EXPIRE')
+        self.assertEqual(expire.notes, f'Certificate expired {valid_until:%Y-%m-%d %H:%M}')
+        self.assertEqual(expire.previous_hash, history[-1].entry_hash)
+        self.assertEqual(expire.entry_hash, expire.digest())
+
+        self.assertEqual(expire_certificates(), 0)  # The next sweep starts after it
+        self.assertEqual(self.expiring.logs.filter(log_type='EXPIRE').count(), 1)
+        self.assertEqual(expire_certificates(now=timezone.now() + timedelta(days=400)), 1)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class LifecycleStatsTests(TestCase):
+    """refresh_lifecycle_stats folds each log entry in exactly once, even when ids commit out of order"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.router = create_user('router', UserRole.ROUTER)
+        cls.message = create_message(cls.alice, cls.bob)
+        sent = timezone.now() - timedelta(hours=1)
+        Message.objects.using(cls.message._state.db).filter(id=cls.message.id).update(timestamp=sent)
+        cls.message.logs.update(timestamp=sent)
+
+    def accept(self, seconds_ago, **fields):
+        timestamp = timezone.now() - timedelta(seconds=seconds_ago)
+        return self.message.logs.create(actor=self.router, log_type='ACCEPT', timestamp=timestamp, **fields)
+
+    def accepted(self):
+        return sum(LifecycleStat.objects.filter(log_type='ACCEPT').values_list('count', flat=True))
+
+    def test_late_commit_of_a_lower_id_is_not_skipped(self):
+        first = self.accept(600)
+        # Inserted after an id was handed to a transaction that has not committed yet
+        recent = self.accept(1, id=first.id + 2)
+
+        refresh_lifecycle_stats(settle=60)
+        self.assertEqual(self.accepted(), 1)  # Stopped at the unsettled entry
+
+        self.accept(600, id=first.id + 1)  # The slow transaction commits
+        MessageLog.objects.using(recent._state.db).filter(id=recent.id).update(timestamp=recent.timestamp - timedelta(minutes=5))
+        refresh_lifecycle_stats(settle=60)
+        self.assertEqual(self.accepted(), 3)
+
+        refresh_lifecycle_stats(settle=0)
+        self.assertEqual(self.accepted(), 3)  # Nothing folded in twice
+
+    def test_batches_stop_at_the_first_unsettled_entry(self):
+        for seconds_ago in (300, 200, 100, 5, 400):
+            self.accept(seconds_ago)
+        self.assertEqual(refresh_lifecycle_stats(batch_size=2, settle=60), 4)  # The SEND log and three accepts
+        self.assertEqual(self.accepted(), 3)
+        self.assertEqual(refresh_lifecycle_stats(batch_size=2, settle=0), 2)
+        self.assertEqual(self.accepted(), 5)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ProfilerTests(TestCase):
+    """SamplingProfilerMiddleware picks requests by sample rate or signed header, in sync and async stacks"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    def setUp(self):
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+
+    def settings(self, **config):
+        return override_settings(REQUEST_PROFILER={'ENABLED': True, 'SAMPLE_RATE': 0.0, 'DIR': self.directory, **config})
+
+    def middleware(self, get_response, **config):
+        with self.settings(**config):
+            return SamplingProfilerMiddleware(get_response)
+
+    def reports(self):
+        reports = []
+        for path in sorted(Path(self.directory).glob('*.json')):
+            self.assertTrue(path.with_suffix('.prof').exists())
+            reports.append(json.loads(path.read_text()))
+        return reports
+
+    def test_sampled_requests_leave_a_report(self):
+        # A client loads its middleware on its first request, so each setting gets its own
+        with self.settings(SAMPLE_RATE=0.0):
+            self.assertEqual(Client().get(reverse('login')).status_code, 200)
+        self.assertEqual(self.reports(), [])
+
+        with self.settings(SAMPLE_RATE=1.0):
+            Client().get(reverse('login'))
+        [report] = self.reports()
+        self.assertEqual((report['view'], report['method'], report['status']), ('login', 'GET', 200))
+        self.assertTrue(report['functions'])
+
+    def test_only_a_valid_signed_header_forces_profiling(self):
+        middleware = self.middleware(lambda request: HttpResponse('ok'))
+        token = issue_profile_token()
+        forged = token[:-1] + ('A' if token[-1] != 'A' else 'B')
+        for value in ('', 'not-a-token', forged):
+            middleware(RequestFactory().get('/', HTTP_X_PROFILE_REQUEST=value))
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 7200):
+            middleware(RequestFactory().get('/', HTTP_X_PROFILE_REQUEST=token))  # Past TOKEN_MAX_AGE
+        self.assertEqual(self.reports(), [])
+
+        middleware(RequestFactory().get('/', HTTP_X_PROFILE_REQUEST=token))
+        self.assertEqual([report['view'] for report in self.reports()], ['unresolved'])
+
+    def test_async_stack_is_profiled_natively(self):
+        async def view(request):
+            await User.objects.acount()
+            await asyncio.sleep(0.05)
+            return HttpResponse('ok')
+
+        middleware = self.middleware(view, SAMPLE_RATE=1.0)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertFalse(iscoroutinefunction(self.middleware(lambda request: HttpResponse('ok'))))
+
+        async_to_sync(middleware)(RequestFactory().get('/'))
+        [report] = self.reports()
+        self.assertEqual(report['sql_count'], 1)  # Recorded on the thread the query ran on
+
+        async def overlapping():
+            return await asyncio.gather(*(middleware(RequestFactory().get('/')) for _ in range(2)))
+
+        self.assertEqual([response.status_code for response in async_to_sync(overlapping)()], [200, 200])
+        self.assertEqual(len(self.reports()), 2)  # cProfile covers the whole loop thread, so only one of them
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False}, READ_RECEIPTS={'MAX_DELAY': 0})
+class ReceiptTests(TestCase):
+    """Buffered read receipts flip read_at and bring the unread counters down together"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.received = [create_message(cls.alice, cls.bob) for _ in range(2)]
+        cls.sent = create_message(cls.bob, cls.alice)
+
+    def setUp(self):
+        receipts.clear()
+        self.addCleanup(receipts.clear)
+
+    def unread(self):
+        membership = ConversationMember.objects.get(user=self.bob, conversation_id=self.sent.conversation_id)
+        return UserProfile.objects.get(user=self.bob).unread_count, membership.unread_count
+
+    def read_at(self):
+        for message in self.received:
+            message.refresh_from_db()
+        return [message.read_at for message in self.received]
+
+    def test_flush_marks_read_and_decrements_once(self):
+        self.assertEqual(self.unread(), (2, 2))
+        receipts.mark_read([*self.received, self.sent], self.bob)  # Only what bob received counts
+        self.assertEqual(receipts.flush(), 2)
+        self.assertTrue(all(self.read_at()))
+        self.assertEqual(self.unread(), (0, 0))
+
+        receipts.mark_read(self.received, self.bob)  # Already read
+        self.assertEqual(receipts.flush(), 0)
+        self.assertEqual(self.unread(), (0, 0))
+
+    def test_failed_flush_rolls_back_and_is_retried(self):
+        receipts.mark_read(self.received, self.bob)
+        with mock.patch.object(receipts, '_decrement_unread', side_effect=OperationalError('disk I/O error')):
+            with self.assertLogs('app.receipts', 'WARNING'):
+                self.assertEqual(receipts.flush(), 0)
+        # The counters failed, so read_at was rolled back with them
+        self.assertEqual(self.read_at(), [None, None])
+        self.assertEqual(self.unread(), (2, 2))
+
+        self.assertEqual(receipts.flush(), 2)
+        self.assertTrue(all(self.read_at()))
+        self.assertEqual(self.unread(), (0, 0))
+
+    def test_receipts_are_written_after_the_response(self):
+        self.client.force_login(self.bob)
+        self.client.get(reverse('view_message', kwargs={'message_id': self.received[0].id}))
+        self.assertIsNotNone(self.read_at()[0])
+        self.assertEqual(self.unread(), (1, 1))
+        self.assertEqual(receipts.clear(), 0)
+
+
+@skipUnless(settings.MESSAGE_SHARDS, 'Sharding is off (set SECUREMESSENGER_SHARDS)')
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ShardingTests(TestCase):
+    """rebalance_shards moves rows (and can be re-run after a crash); scatter() merges the shards"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        receivers = [create_user(f'receiver{index}', UserRole.USER) for index in range(6)]
+        # Written while only the first shard existed, so most belong elsewhere now
+        with override_settings(MESSAGE_SHARDS=settings.MESSAGE_SHARDS[:1]):
+            cls.messages = [create_message(cls.alice, receiver) for receiver in receivers]
+
+    def placement(self, model=Message):
+        return {
+            alias: sorted(model.objects.using(alias).values_list('id' if model is Message else 'message_id', flat=True))
+            for alias in shard_aliases()
+        }
+
+    def expected(self):
+        placement = {alias: [] for alias in shard_aliases()}
+        for message in self.messages:
+            placement[shard_for_receiver(message.receiver_id)].append(message.id)
+        return {alias: sorted(ids) for alias, ids in placement.items()}
+
+    def rebalance(self):
+        """Messages moved, from the "Moved N messages a -> b" lines"""
+        stdout = io.StringIO()
+        call_command('rebalance_shards', stdout=stdout)
+        return sum(int(line.split()[1]) for line in stdout.getvalue().splitlines() if line.startswith('Moved'))
+
+    def test_rebalance_moves_rows_and_can_be_rerun(self):
+        first = shard_aliases()[0]
+        self.assertEqual(len(self.placement()[first]), 6)
+        moved = sum(len(ids) for alias, ids in self.expected().items() if alias != first)
+        self.assertGreater(moved, 0)
+
+        self.assertEqual(self.rebalance(), moved)
+        self.assertEqual(self.placement(), self.expected())
+        self.assertEqual(self.placement(MessageLog), self.expected())  # Each message's SEND log went with it
+
+        # A run that crashed between the copy and the delete left rows on both shards
+        for alias, ids in self.expected().items():
+            if alias != first:
+                rows = [*Message.objects.using(alias).filter(id__in=ids), *MessageLog.objects.using(alias).filter(message_id__in=ids)]
+                for row in rows:
+                    row.save_base(using=first, raw=True, force_insert=True)
+        self.assertEqual(sum(map(len, self.placement().values())), 6 + moved)
+
+        self.assertEqual(self.rebalance(), moved)  # Only deletes the leftovers
+        self.assertEqual(self.placement(), self.expected())
+        self.assertEqual(self.placement(MessageLog), self.expected())
+        self.assertEqual(self.rebalance(), 0)
+
+    def test_scatter_merges_every_shard_in_order(self):
+        self.rebalance()
+        sent = scatter(lambda messages: messages.filter(sender=self.alice), order_field='id')
+        newest_first = sorted((message.id for message in self.messages), reverse=True)
+        self.assertEqual(sent.count(), 6)
+        self.assertEqual([message.id for message in sent], newest_first)
+        self.assertEqual([message.id for message in sent[2:4]], newest_first[2:4])
+        self.assertEqual(sent[5].id, newest_first[5])
+        self.assertTrue(sent)
+        self.assertEqual(scatter_count(lambda messages: messages.filter(sender=self.alice)), 6)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class AdminTests(TestCase):
+    """The admin cannot edit history or status outside the logged transitions"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='Password1')
+        UserProfile.objects.create(user=cls.admin, role=UserRole.USER)
+        alice = create_user('alice', UserRole.USER)
+        cls.message = create_message(alice, create_user('bob', UserRole.USER))
+        cls.log = cls.message.logs.get()
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_audit_log_is_read_only(self):
+        change = reverse('admin:app_messagelog_change', args=[self.log.id])
+        self.assertEqual(self.client.get(change).status_code, 200)
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.post(change, {'notes': 'Edited', 'log_type': 'SEND'}).status_code, 403)
+            self.assertEqual(self.client.get(reverse('admin:app_messagelog_add')).status_code, 403)
+            self.assertEqual(self.client.post(reverse('admin:app_messagelog_delete', args=[self.log.id])).status_code, 403)
+        self.log.refresh_from_db()
+        self.assertEqual(self.log.notes, 'User sent message')
+        self.assertEqual(self.log.entry_hash, self.log.digest())
+
+    def test_message_status_is_not_a_form_field(self):
+        response = self.client.get(reverse('admin:app_message_change', args=[self.message.id]))
+        self.assertNotIn('status', response.context['adminform'].form.fields)
+        self.assertNotIn('certificate', response.context['adminform'].form.fields)
+
+    def run_action(self, action):
+        # A changelist reads one shard: the message's
+        shard = f'?shard={self.message._state.db}' if settings.MESSAGE_SHARDS else ''
+        return self.client.post(reverse('admin:app_message_changelist') + shard, {
+            'action': action, '_selected_action': [self.message.id],
+        })
+
+    def test_bulk_actions_need_the_views_roles(self):
+        self.run_action('accept_messages')  # A staff user with the USER role
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'SENT')
+        response = self.client.get(reverse('admin:app_message_changelist'))
+        self.assertNotIn('accept_messages', dict(response.context['action_form'].fields['action'].choices))
+
+        profile = UserProfile.objects.get(user=self.admin)
+        profile.role = UserRole.ROUTER
+        profile.save()
+        self.run_action('accept_messages')
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'ROUTER_ACCEPTED')
+        self.run_action('certify_messages')  # Not the CA
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'ROUTER_ACCEPTED')
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class RoleTests(TestCase):
+    """Cached role checks follow profile changes and warn about a per-process cache"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+
+    def test_role_checks_follow_profile_changes(self):
+        url = reverse('api_lifecycle_stats')
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url).status_code, 403)  # Role now cached for this session
+
+        self.alice.profile.role = UserRole.ROUTER
+        self.alice.profile.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_deactivated_users_lose_their_cached_role(self):
+        UserProfile.objects.filter(user=self.alice).update(role=UserRole.ROUTER)
+        url = reverse('api_lifecycle_stats')
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(url).status_code, 200)  # Role now cached for this session
+
+        self.alice.is_active = False
+        self.alice.save()
+        response = self.client.get(url)
+        self.assertRedirects(response, f'{reverse("login")}?next={url}', fetch_redirect_response=False)
+
+    def test_user_is_loaded_with_its_profile(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(ProfileBackend().get_user(self.alice.id).profile.role, UserRole.USER)
+
+    def test_role_cache_must_be_shared_in_production(self):
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache'}}
+        self.assertEqual([warning.id for warning in check_role_cache(None)], ['app.W002'])
+        with override_settings(CACHES=redis):
+            self.assertEqual(check_role_cache(None), [])
+        with override_settings(ROLE_CACHE={'CACHE_SECONDS': 0}):
+            self.assertEqual(check_role_cache(None), [])
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class CertificateSigningTests(TestCase):
+    """Certificates are signed with the CA key, verified in batches, and never issued unsigned"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        use_test_ca_key(cls)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.ca = create_user('authority', UserRole.CLOUD_AUTHORITY)
+        cls.sent = create_message(cls.alice, cls.bob)
+        cls.accepted = create_message(cls.bob, cls.alice, status='ROUTER_ACCEPTED')
+        cls.legacy = create_message(cls.alice, cls.bob, status='CERTIFICATE_CREATED')
+
+    def test_certificates_are_signed_and_verified(self):
+        accepted, legacy = self.accepted, self.legacy
+        alias = accepted._state.db
+        self.assertEqual(certify_messages(alias, [accepted.id], self.ca), [accepted.id])
+        Certificate.objects.using(legacy._state.db).create(
+            message=legacy, issued_by=self.ca, certificate_data='signature', valid_until=legacy.timestamp,
+        )
+
+        self.client.force_login(self.bob)
+        url = reverse('api_verify_certificates')
+        ids = f'{accepted.id},{legacy.id},{self.sent.id}'
+        certificates = self.client.get(url, {'ids': ids}).json()['certificates']
+        self.assertEqual(certificates, {str(accepted.id): 'valid', str(legacy.id): 'unsigned', str(self.sent.id): 'missing'})
+
+        Message.objects.using(alias).filter(id=accepted.id).update(sender=self.alice)
+        self.client.force_login(self.ca)
+        certificates = self.client.post(url, {'ids': str(accepted.id)}).json()['certificates']
+        self.assertEqual(certificates, {str(accepted.id): 'invalid'})
+
+    def test_signing_without_a_key_file_fails_closed(self):
+        _load_signing_key.cache_clear()
+        with override_settings(CA_SIGNING={}), self.assertRaises(ImproperlyConfigured):
+            certify_messages(self.accepted._state.db, [self.accepted.id], self.ca)
+        with override_settings(CA_SIGNING={}, DEBUG=True), self.assertLogs('app.certificates', 'WARNING'):
+            signing_key()
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ProvisioningTests(TestCase):
+    """provision_users creates the good rows on every database and reports the rest"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+
+    def test_provision_users_reports_bad_rows(self):
+        rows = [
+            'username,email,first_name,last_name,password,role,organization',
+            'dave,dave@example.com,Dave,Jones,Password1,router,Acme',
+            'erin,,Erin,,,,Acme',
+            'frank,frank@example.com,Frank,,Password1,WIZARD,Acme',
+            'alice,,,,Password1,USER,Acme',
+            'dave,,,,Password1,USER,Acme',
+            'gina,,,,short,USER,Acme',
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as upload:
+            upload.write('\n'.join(rows))
+        self.addCleanup(os.remove, upload.name)
+        call_command('provision_users', upload.name, workers=2, chunk_size=2, stdout=io.StringIO(), stderr=io.StringIO())
+
+        dave = User.objects.get(username='dave')
+        self.assertTrue(dave.check_password('Password1'))
+        self.assertEqual((dave.profile.role, dave.profile.organization), (UserRole.ROUTER, 'Acme'))
+        self.assertFalse(User.objects.get(username='erin').has_usable_password())
+        self.assertFalse(User.objects.filter(username__in=['frank', 'gina']).exists())
+        for alias in shard_aliases():
+            self.assertTrue(User.objects.using(alias).filter(username='erin').exists())
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class QueryPlanTests(TestCase):
+    """Every hot query in app/query_plans.py is served by an index"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    def test_hot_queries_use_indexes(self):
+        call_command('explain_queries', seed=2000, strict=True, stdout=io.StringIO())
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ChangeSyncTests(TestCase):
+    """api_sync pages through a user's changes and then returns only newer ones"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpClass(cls):
+        use_test_ca_key(cls)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.ca = create_user('authority', UserRole.CLOUD_AUTHORITY)
+        create_message(cls.alice, cls.bob)
+        cls.accepted = create_message(cls.bob, cls.alice, status='ROUTER_ACCEPTED')
+        create_message(cls.bob, cls.ca)  # Not alice's, never synced to her
+
+    def test_sync_returns_only_new_changes(self):
+        self.client.force_login(self.alice)
+        url = reverse('api_sync')
+        mine = scatter(lambda messages: messages.filter(sender=self.alice) | messages.filter(receiver=self.alice))
+        first = self.client.get(url, {'limit': 1}).json()
+        self.assertEqual((len(first['changes']), first['more']), (1, len(mine) > 1))
+        rest = self.client.get(url, {'token': first['token']}).json()
+        ids = {row[0] for row in first['changes'] + rest['changes']}
+        self.assertEqual(ids, {message.id for message in mine})
+        self.assertEqual(self.client.get(url, {'token': rest['token']}).json()['changes'], [])
+
+        accepted = self.accepted
+        certify_messages(accepted._state.db, [accepted.id], self.ca)
+        changes = self.client.get(url, {'token': rest['token']}).json()['changes']
+        self.assertEqual([(row[0], row[1]) for row in changes], [(accepted.id, 'CERTIFICATE_CREATED')])
+        self.assertEqual(self.client.get(url, {'token': 'forged'}).status_code, 400)
+
+    def test_advancing_the_counter_is_one_statement(self):
+        alias = self.accepted._state.db
+        first = next_change(alias)
+        with self.assertNumQueries(1, using=alias or 'default'):
+            self.assertEqual(next_change(alias), first + 1)
+
+
+class ConnectionTuningTests(TestCase):
+    """Connections get a busy timeout, and locked writes are retried only outside a transaction"""
+
+    def test_connections_are_tuned_and_locks_retried_outside_transactions(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+        calls = []
+
+        def locked():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'written'
+
+        # Tests run inside a transaction, which only its owner may retry
+        with self.assertRaises(OperationalError):
+            retry_on_lock(locked)()
+        self.assertEqual(len(calls), 1)
+        with mock.patch('app.database._in_transaction', return_value=False), mock.patch('app.database.time.sleep'):
+            self.assertEqual(retry_on_lock(locked)(), 'written')
+        self.assertEqual(len(calls), 3)
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ConditionalGetTests(TestCase):
+    """api_user_stats answers 304 until a message write changes what it reports"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+        cls.router = create_user('router', UserRole.ROUTER)
+        cls.sent = create_message(cls.alice, cls.bob)
+
+    def revalidate(self, user, etag):
+        self.client.force_login(user)
+        return self.client.get(reverse('api_user_stats'), headers={'If-None-Match': etag})
+
+    def test_user_stats_revalidate_until_a_message_changes(self):
+        first = self.revalidate(self.alice, '"none"')
+        self.assertEqual((first.status_code, first.json()['received_messages']), (200, 0))
+        self.assertEqual(self.revalidate(self.alice, first['ETag']).status_code, 304)
+
+        create_message(self.bob, self.alice)
+        changed = self.revalidate(self.alice, first['ETag'])
+        self.assertEqual((changed.status_code, changed.json()['received_messages']), (200, 1))
+        self.assertEqual(self.revalidate(self.alice, changed['ETag']).status_code, 304)
+
+    def test_pending_actions_revalidate_after_a_transition(self):
+        first = self.revalidate(self.router, '"none"')
+        self.assertEqual(first.json()['pending_actions'], 1)
+        self.assertEqual(self.revalidate(self.router, first['ETag']).status_code, 304)
+
+        transition_messages(self.sent._state.db, [self.sent.id], 'SENT', 'REJECTED', 'REJECT', actor=self.router)
+        changed = self.revalidate(self.router, first['ETag'])
+        self.assertEqual((changed.status_code, changed.json()['pending_actions']), (200, 0))
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': False})
+class ConversationTests(TestCase):
+    """Conversation pointers and counters, the conversation list and keyset-paginated threads"""
+    databases = {'default', *settings.MESSAGE_SHARDS}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = create_user('alice', UserRole.USER)
+        cls.bob = create_user('bob', UserRole.USER)
+
+    def membership(self, user, peer):
+        return ConversationMember.objects.select_related('conversation').get(user=user, peer=peer)
+
+    def test_record_message_keeps_pointers_and_unread_counts(self):
+        create_message(self.alice, self.bob)
+        latest = create_message(self.alice, self.bob)
+        create_message(self.bob, self.alice)  # Sent after, so it is the latest activity
+        reply = Message.objects.using(shard_for_receiver(self.alice.id)).get(sender=self.bob)
+
+        conversation = self.membership(self.alice, self.bob).conversation
+        self.assertEqual((conversation.message_count, conversation.last_message_id), (3, reply.id))
+        self.assertEqual(self.membership(self.bob, self.alice).unread_count, 2)
+        self.assertEqual(self.membership(self.alice, self.bob).unread_count, 1)
+        self.assertEqual(UserProfile.objects.get(user=self.bob).unread_count, 2)
+
+        # A message recorded late (an older timestamp) is counted but does not move the pointers
+        latest.timestamp -= timedelta(hours=1)
+        record_message(conversation.id, latest)
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.message_count, conversation.last_message_id), (4, reply.id))
+        self.assertEqual(conversation.last_activity, reply.timestamp)
+
+    @mock.patch('app.conversations.LIST_SIZE', 2)
+    def test_conversations_are_listed_by_latest_activity(self):
+        peers = [create_user(f'peer{index}', UserRole.USER) for index in range(3)]
+        for peer in peers:
+            create_message(peer, self.alice)
+        create_message(self.alice, peers[0])  # Brings the first conversation back to the top
+
+        first, cursor = conversation_page(self.alice)
+        self.assertEqual([membership.peer for membership in first], [peers[0], peers[2]])
+        rest, cursor = conversation_page(self.alice, decode_cursor(cursor))
+        self.assertEqual(([membership.peer for membership in rest], cursor), ([peers[1]], None))
+
+    def test_thread_pages_through_tied_timestamps(self):
+        for index in range(PAGE_SIZE + 5):
+            create_message(*((self.alice, self.bob) if index % 2 else (self.bob, self.alice)))
+        # Both directions, so both receivers' shards, all written within one microsecond
+        tied = timezone.now().replace(microsecond=123457)
+        for alias in message_aliases():
+            Message.objects.using(alias).update(timestamp=tied)
+
+        membership = self.membership(self.alice, self.bob)
+        seen, cursor = [], None
+        while True:
+            page, cursor = thread_page(membership, decode_cursor(cursor))
+            self.assertLessEqual(len(page), PAGE_SIZE)
+            seen.extend(message.id for message in page)
+            if cursor is None:
+                break
+        everything = scatter(lambda messages: messages.filter(conversation_id=membership.conversation_id), order_field='id')
+        self.assertEqual(seen, [message.id for message in everything])
+        self.assertIsNone(decode_cursor('not-a-cursor'))
@@ -16,6 +16,8 @@ urlpatterns = [
     path('inbox/', views.inbox, name='inbox'),
     path('outbox/', views.outbox, name='outbox'),
     path('message/<int:message_id>/', views.view_message, name='view_message'),
+    path('conversations/', views.conversations, name='conversations'),
+    path('conversations/<int:conversation_id>/', views.conversation_thread, name='conversation_thread'),
     
     # Router Operations
     path('router/accept/<int:message_id>/', views.router_accept_message, name='router_accept'),
@@ -26,4 +28,7 @@ urlpatterns = [
     # API Endpoints
     path('api/message/<int:message_id>/status/', views.api_message_status, name='api_message_status'),
     path('api/stats/', views.api_user_stats, name='api_user_stats'),
+    path('api/lifecycle/', views.api_lifecycle_stats, name='api_lifecycle_stats'),
+    path('api/certificates/verify/', views.api_verify_certificates, name='api_verify_certificates'),
+    path('api/sync/', views.api_sync, name='api_sync'),
 ]
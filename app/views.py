@@ -1,19 +1,45 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.core.signing import BadSignature
+from django.http import Http404, JsonResponse
 from django.views.decorators.http import require_http_methods
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from django.contrib import messages
 from django.utils import timezone
 from datetime import timedelta
 
-from .models import UserProfile, Message, MessageLog, Certificate, UserRole
+from .models import ConversationMember, UserProfile, Message, MessageLog, UserRole
+from .admission import DEFER, REJECT, admission_settings, admit
+from .analytics import TRACKED_LOG_TYPES, lifecycle_report
+from .async_support import (
+    async_cache_control, async_condition, async_login_required, async_page, decrypt_content,
+)
+from .certificates import acertificate_validity, signing_key, verify_certificates
+from .changes import FIELDS as SYNC_FIELDS, changes_since
+from .conditional import (
+    inbox_etag, message_etag, message_status_etag, outbox_etag, user_stats, user_stats_etag,
+)
+from .conversations import (
+    conversation_for, conversation_page, decode_cursor, record_message, thread_page,
+)
+from .jobs import enqueue
+from .lifecycle import store_message, transition_messages
+from .previews import aattach_previews, attach_previews, previews_requested
+from .query_budget import query_budget
+from .receipts import mark_read
+from .replicas import read_only
+from .roles import request_role, role_required
+from .sharding import aget_message_or_404, get_message_or_404, receiver_messages, scatter, scatter_count
 from .forms import UserRegistrationForm, UserLoginForm, SendMessageForm, CAApprovalForm
 
 
+MAX_VERIFY_IDS = 10000
+
+
 # ===================== HOME PAGE =====================
+@query_budget(2)
 def home(request):
     """Home page view"""
     if request.user.is_authenticated:
@@ -22,6 +48,7 @@ def home(request):
 
 
 # ===================== AUTHENTICATION VIEWS =====================
+@query_budget(4, per_shard=1)
 @require_http_methods(["GET", "POST"])
 def register(request):
     """User registration"""
@@ -45,6 +72,7 @@ def register(request):
     return render(request, 'auth/register.html', {'form': form})
 
 
+@query_budget(9)
 @require_http_methods(["GET", "POST"])
 def login_view(request):
     """User login"""
@@ -70,6 +98,7 @@ def login_view(request):
     return render(request, 'auth/login.html', {'form': form})
 
 
+@query_budget(5)
 @login_required
 def logout_view(request):
     """User logout"""
@@ -79,6 +108,8 @@ def logout_view(request):
 
 
 # ===================== DASHBOARD VIEW =====================
+@query_budget(5, per_shard=3)
+@read_only
 @login_required
 def dashboard(request):
     """User dashboard based on role"""
@@ -90,54 +121,76 @@ def dashboard(request):
     
     if profile.role == UserRole.CLOUD_AUTHORITY:
         # CA dashboard - messages waiting for certificate
-        pending_messages = Message.objects.filter(status='ROUTER_ACCEPTED')
+        pending_messages = scatter(
+            lambda messages: messages.filter(status='ROUTER_ACCEPTED').select_related('sender', 'receiver')
+        )
         context['pending_messages'] = pending_messages
         context['total_pending'] = pending_messages.count()
         return render(request, 'dashboard/ca_dashboard.html', context)
     
     elif profile.role == UserRole.ROUTER:
         # Router dashboard - messages waiting for acceptance
-        pending_messages = Message.objects.filter(status='SENT')
+        pending_messages = scatter(
+            lambda messages: messages.filter(status='SENT').select_related('sender', 'receiver')
+        )
         context['pending_messages'] = pending_messages
         context['total_pending'] = pending_messages.count()
         return render(request, 'dashboard/router_dashboard.html', context)
     
     elif profile.role == UserRole.PUBLISHER:
         # Publisher dashboard
-        context['recent_messages'] = Message.objects.filter(sender=request.user)[:10]
+        context['recent_messages'] = scatter(
+            lambda messages: messages.filter(sender=request.user).select_related('receiver')
+        )[:10]
         return render(request, 'dashboard/publisher_dashboard.html', context)
     
     else:  # Regular USER
-        sent = Message.objects.filter(sender=request.user).count()
-        received = Message.objects.filter(receiver=request.user).count()
+        sent = scatter_count(lambda messages: messages.filter(sender=request.user))
+        received = receiver_messages(request.user.id).filter(receiver=request.user).count()
         context['sent_count'] = sent
         context['received_count'] = received
-        context['recent_received'] = Message.objects.filter(
+        context['unread_count'] = profile.unread_count
+        context['recent_received'] = receiver_messages(request.user.id).filter(
             receiver=request.user
-        ).order_by('-timestamp')[:5]
+        ).select_related('sender').order_by('-timestamp')[:5]
         return render(request, 'dashboard/user_dashboard.html', context)
 
 
 # ===================== MESSAGE VIEWS =====================
+@query_budget(22, per_shard=2)
 @login_required
 def send_message(request):
     """Send a new message"""
     if request.method == 'POST':
         form = SendMessageForm(request.POST, current_user=request.user)
         if form.is_valid():
+            admission = admit(request.user)
+            if admission.action == REJECT:
+                form.add_error(None, (
+                    'Too many messages are being sent right now. '
+                    f'Please try again in {admission.retry_after} seconds.'
+                ))
+                response = render(request, 'messages/send_message.html', {'form': form}, status=429)
+                response['Retry-After'] = str(admission.retry_after)
+                return response
+
             message = form.save(commit=False)
             message.sender = request.user
             message.encrypt_content(form.cleaned_data['content'])
-            message.status = 'SENT'
-            message.save()
+            message.status = 'QUEUED' if admission.action == DEFER else 'SENT'
+            message.conversation_id = conversation_for(request.user.id, message.receiver_id).id
+            store_message(message, request.user)
+            record_message(message.conversation_id, message)
             
-            # Log the action
-            MessageLog.objects.create(
-                message=message,
-                actor=request.user,
-                log_type='SEND',
-                notes='User sent message'
-            )
+            payload = {'message_id': message.id, 'actor_id': request.user.id}
+            if message.status == 'QUEUED':
+                # Released into SENT (and audited) once the routers catch up
+                enqueue('release_message', payload, priority=50, delay=admission_settings()['RELEASE_DELAY'])
+                messages.info(request, 'The network is busy: your message is queued and will be sent shortly.')
+                return redirect('outbox')
+
+            # The routing rules get their first look in the background
+            enqueue('route_message', {'message_id': message.id}, priority=10)
             
             messages.success(request, 'Message sent successfully!')
             return redirect('inbox')
@@ -147,114 +200,159 @@ def send_message(request):
     return render(request, 'messages/send_message.html', {'form': form})
 
 
-@login_required
-def inbox(request):
+@query_budget(5)
+@read_only
+@async_login_required
+@async_cache_control(private=True, no_cache=True)
+@async_condition(etag_func=inbox_etag)
+async def inbox(request):
     """User inbox - received messages"""
-    messages_list = Message.objects.filter(receiver=request.user).order_by('-timestamp')
+    show_previews = previews_requested(request)
+    messages_list = receiver_messages(request.user.id).filter(
+        receiver_id=request.user.id
+    ).select_related('sender').order_by('-timestamp')
+    if not show_previews:
+        messages_list = messages_list.defer('encrypted_content', 'encryption_key')
     
     # Pagination
-    from django.core.paginator import Paginator
-    paginator = Paginator(messages_list, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = await async_page(messages_list, request.GET.get('page'), 10)
+    if show_previews:
+        page_obj.object_list = await aattach_previews(list(page_obj.object_list))
     
-    return render(request, 'messages/inbox.html', {'page_obj': page_obj})
+    return render(request, 'messages/inbox.html', {'page_obj': page_obj, 'show_previews': show_previews})
 
 
-@login_required
-def outbox(request):
+@query_budget(5, per_shard=3)
+@read_only
+@async_login_required
+@async_cache_control(private=True, no_cache=True)
+@async_condition(etag_func=outbox_etag)
+async def outbox(request):
     """User outbox - sent messages"""
-    messages_list = Message.objects.filter(sender=request.user).order_by('-timestamp')
+    show_previews = previews_requested(request)
+    deferred = () if show_previews else ('encrypted_content', 'encryption_key')
+    messages_list = scatter(
+        lambda messages: messages.filter(sender_id=request.user.id).select_related('receiver')
+        .defer(*deferred).order_by('-timestamp')
+    )
     
-    from django.core.paginator import Paginator
-    paginator = Paginator(messages_list, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = await async_page(messages_list, request.GET.get('page'), 10)
+    if show_previews:
+        page_obj.object_list = await aattach_previews(list(page_obj.object_list))
     
-    return render(request, 'messages/outbox.html', {'page_obj': page_obj})
+    return render(request, 'messages/outbox.html', {'page_obj': page_obj, 'show_previews': show_previews})
 
 
-@login_required
-def view_message(request, message_id):
+@query_budget(5)
+@read_only
+@async_login_required
+@async_cache_control(private=True, no_cache=True)
+@async_condition(etag_func=message_etag)
+async def view_message(request, message_id):
     """View a single message"""
-    message = get_object_or_404(Message, id=message_id)
+    message = await aget_message_or_404(
+        Message.objects.select_related('sender', 'receiver').prefetch_related(
+            Prefetch('logs', queryset=MessageLog.objects.select_related('actor'))
+        ),
+        message_id
+    )
     
     # Check permission
-    if request.user != message.sender and request.user != message.receiver:
+    if request.user.id not in (message.sender_id, message.receiver_id):
         messages.error(request, 'You do not have permission to view this message.')
         return redirect('inbox')
     
-    decrypted_content = message.decrypt_content()
+    decrypted_content = await decrypt_content(message)
+    mark_read([message], request.user)
     
     return render(request, 'messages/view_message.html', {
         'message': message,
         'content': decrypted_content,
+        'certificate': await acertificate_validity(message),
     })
 
 
-# ===================== ROUTER VIEWS =====================
+# ===================== CONVERSATION VIEWS =====================
+@query_budget(3)
+@read_only
 @login_required
+def conversations(request):
+    """The user's conversations, most recently active first"""
+    memberships, next_cursor = conversation_page(request.user, decode_cursor(request.GET.get('before')))
+    return render(request, 'messages/conversations.html', {
+        'memberships': memberships,
+        'next_cursor': next_cursor,
+    })
+
+
+@query_budget(4, per_shard=1)
+@read_only
+@login_required
+def conversation_thread(request, conversation_id):
+    """One conversation's messages, newest first, keyset-paginated"""
+    membership = ConversationMember.objects.select_related('peer').filter(
+        conversation_id=conversation_id, user=request.user
+    ).first()
+    if membership is None:
+        raise Http404('No Conversation matches the given query.')
+    
+    show_previews = previews_requested(request)
+    deferred = () if show_previews else ('encrypted_content', 'encryption_key')
+    thread, next_cursor = thread_page(membership, decode_cursor(request.GET.get('before')), deferred)
+    if show_previews:
+        thread = attach_previews(thread)
+    mark_read(thread, request.user)
+    
+    return render(request, 'messages/conversation_thread.html', {
+        'membership': membership,
+        'thread': thread,
+        'next_cursor': next_cursor,
+        'show_previews': show_previews,
+    })
+
+
+# ===================== ROUTER VIEWS =====================
+@query_budget(11)
+@role_required(UserRole.ROUTER)
 def router_accept_message(request, message_id):
     """Router accepts a message"""
-    if not hasattr(request.user, 'profile') or request.user.profile.role != UserRole.ROUTER:
-        messages.error(request, 'You do not have permission to perform this action.')
-        return redirect('dashboard')
-    
-    message = get_object_or_404(Message, id=message_id, status='SENT')
+    message = get_message_or_404(Message.objects.select_related('sender', 'receiver'), message_id, status='SENT')
     
     if request.method == 'POST':
-        message.status = 'ROUTER_ACCEPTED'
-        message.updated_at = timezone.now()
-        message.save()
-        
-        MessageLog.objects.create(
-            message=message,
-            actor=request.user,
-            log_type='ACCEPT',
-            notes='Router accepted message'
+        # One short transaction that takes the write lock first, so concurrent routers queue instead of failing
+        accepted = transition_messages(
+            message._state.db, [message.id], 'SENT', 'ROUTER_ACCEPTED', 'ACCEPT',
+            actor=request.user, notes='Router accepted message',
         )
-        
-        messages.success(request, 'Message accepted and sent to Cloud Authority.')
+        if accepted:
+            messages.success(request, 'Message accepted and sent to Cloud Authority.')
+        else:
+            messages.error(request, 'This message has already been handled.')
         return redirect('dashboard')
     
     return render(request, 'router/accept_message.html', {'message': message})
 
 
 # ===================== CLOUD AUTHORITY VIEWS =====================
-@login_required
+@query_budget(6)
+@role_required(UserRole.CLOUD_AUTHORITY)
 def ca_create_certificate(request, message_id):
     """Cloud Authority creates certificate for message"""
-    if not hasattr(request.user, 'profile') or request.user.profile.role != UserRole.CLOUD_AUTHORITY:
-        messages.error(request, 'You do not have permission to perform this action.')
-        return redirect('dashboard')
-    
-    message = get_object_or_404(Message, id=message_id, status='ROUTER_ACCEPTED')
+    message = get_message_or_404(
+        Message.objects.select_related('sender', 'receiver'), message_id, status='ROUTER_ACCEPTED'
+    )
     
     if request.method == 'POST':
         form = CAApprovalForm(request.POST)
         if form.is_valid():
-            # Create certificate
-            valid_until = timezone.now() + timedelta(days=365)
-            certificate = Certificate.objects.create(
-                message=message,
-                issued_by=request.user,
-                certificate_data=form.cleaned_data['certificate_data'],
-                valid_until=valid_until
-            )
+            # The certificate, status change and audit log are written by a worker
+            enqueue('issue_certificate', {
+                'message_id': message.id,
+                'actor_id': request.user.id,
+                'notes': form.cleaned_data['notes'],
+            }, priority=10)
             
-            message.status = 'CERTIFICATE_CREATED'
-            message.certificate = certificate.certificate_data
-            message.updated_at = timezone.now()
-            message.save()
-            
-            MessageLog.objects.create(
-                message=message,
-                actor=request.user,
-                log_type='CERTIFICATE',
-                notes='Certificate created by Cloud Authority'
-            )
-            
-            messages.success(request, 'Certificate created successfully!')
+            messages.success(request, 'Certificate issuance queued.')
             return redirect('dashboard')
     else:
         form = CAApprovalForm()
@@ -262,44 +360,108 @@ def ca_create_certificate(request, message_id):
     context = {
         'message': message,
         'decrypted_content': message.decrypt_content(),
-        'form': form
+        'form': form,
+        'signing_key_id': signing_key()[1],
     }
     return render(request, 'ca/create_certificate.html', context)
 
 
 # ===================== API ENDPOINTS =====================
-@login_required
-def api_message_status(request, message_id):
+@query_budget(5)
+@read_only
+@async_login_required
+@async_cache_control(private=True, no_cache=True)
+@async_condition(etag_func=message_status_etag)
+async def api_message_status(request, message_id):
     """Get message status via API"""
-    message = get_object_or_404(Message, id=message_id)
+    message = await aget_message_or_404(Message.objects.all(), message_id)
     
-    if request.user != message.sender and request.user != message.receiver:
+    if request.user.id not in (message.sender_id, message.receiver_id):
         return JsonResponse({'error': 'Permission denied'}, status=403)
     
+    certificate = await acertificate_validity(message)
     return JsonResponse({
         'id': message.id,
         'status': message.status,
         'status_display': message.get_status_display(),
         'timestamp': message.timestamp.isoformat(),
         'updated_at': message.updated_at.isoformat(),
+        'certificate': {
+            'valid': certificate['valid'],
+            'valid_until': certificate['valid_until'].isoformat(),
+        } if certificate else None,
     })
 
 
-@login_required
-def api_user_stats(request):
+@query_budget(7, per_shard=4)
+@read_only
+@async_login_required
+@async_cache_control(private=True, no_cache=True)
+@async_condition(etag_func=user_stats_etag)
+async def api_user_stats(request):
     """Get user statistics"""
-    user = request.user
+    return JsonResponse(await user_stats(request))
+
+
+@query_budget(3)
+@role_required(UserRole.ROUTER, UserRole.CLOUD_AUTHORITY, api=True)
+def api_lifecycle_stats(request):
+    """Per-operator latency report for one lifecycle transition"""
+    log_type = request.GET.get('transition', 'CERTIFICATE')
+    if log_type not in TRACKED_LOG_TYPES:
+        return JsonResponse({'error': f'Unknown transition: {log_type}'}, status=400)
+    try:
+        days = max(int(request.GET.get('days', 7)), 1)
+    except ValueError:
+        return JsonResponse({'error': 'days must be an integer'}, status=400)
+
     return JsonResponse({
-        'username': user.username,
-        'role': user.profile.role,
-        'sent_messages': Message.objects.filter(sender=user).count(),
-        'received_messages': Message.objects.filter(receiver=user).count(),
-        'pending_actions': Message.objects.filter(
-            status__in=['SENT', 'ROUTER_ACCEPTED']
-        ).count() if user.profile.role in [UserRole.ROUTER, UserRole.CLOUD_AUTHORITY] else 0,
+        'transition': log_type,
+        'days': days,
+        'operators': lifecycle_report(log_type, since=timezone.now() - timedelta(days=days)),
     })
 
 
+@query_budget(3, per_shard=1)
+@read_only
+@login_required
+@require_http_methods(["GET", "POST"])
+def api_verify_certificates(request):
+    """Verify the CA signatures of many messages (``ids``: comma-separated message ids)"""
+    raw_ids = request.POST.get('ids') if request.method == 'POST' else request.GET.get('ids')
+    try:
+        message_ids = sorted({int(value) for value in (raw_ids or '').split(',') if value.strip()})
+    except ValueError:
+        return JsonResponse({'error': 'ids must be comma-separated integers'}, status=400)
+    if len(message_ids) > MAX_VERIFY_IDS:
+        return JsonResponse({'error': f'At most {MAX_VERIFY_IDS} ids per request'}, status=400)
+
+    # Routers and the CA may check any message; everyone else only their own
+    operator = request_role(request) in (UserRole.ROUTER, UserRole.CLOUD_AUTHORITY)
+    results = verify_certificates(message_ids, user=None if operator else request.user)
+    return JsonResponse({
+        'key_id': signing_key()[1],
+        'certificates': {str(message_id): results.get(message_id, 'missing') for message_id in message_ids},
+    })
+
+
+@query_budget(3, per_shard=1)
+@read_only
+@login_required
+def api_sync(request):
+    """Messages sent or received that changed since ``token`` (omit it to start over), a page at a time"""
+    try:
+        limit = int(request.GET['limit']) if 'limit' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    try:
+        rows, token, more = changes_since(request.user.id, request.GET.get('token'), limit)
+    except BadSignature:
+        return JsonResponse({'error': 'Invalid sync token'}, status=400)
+    # Rows are arrays in `fields` order; keep requesting with `token` while `more` is true
+    return JsonResponse({'fields': SYNC_FIELDS, 'changes': rows, 'token': token, 'more': more})
+
+
 
 
 #========================= CA / CreateCertificate PAGE =======================================